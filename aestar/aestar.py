@@ -1,26 +1,85 @@
+import contextlib
+import copy
 import errno
 import hashlib
+import io
 import os
+import queue
+import shutil
 import tarfile
+import threading
+import time
 import warnings
 import logging
 
 from collections import deque
-from Crypto.Cipher import AES
+
+from . import mt
+from .cipher import SECTOR_SIZE, SectorCipher
+from .compression import BYPASS_LEVELS, ParallelCompressor, is_incompressible, open_decompressor
+from .fileinfo import HashCacheEntry
 
 logger = logging.getLogger(__name__)
 logger.addHandler(logging.NullHandler())
 
 
+class FlushPolicy:
+    def __init__(self, every_bytes=None, every_files=None, every_seconds=None, sync=False):
+        """
+        Decides when a file object flushes (and optionally fsyncs) its buffered data to the underlying file.
+        A flush is due as soon as any of the given limits has been reached since the last flush.
+        Without any limit every write is flushed.
+        Flushing regularly is what surfaces ENOSPC (end of tape) errors, and only flushed data counts as committed.
+        :param every_bytes: flush after at least this many bytes have been written
+        :param every_files: flush after this many files have been added (see file_added() of the file objects)
+        :param every_seconds: flush on the first write or added file after this many seconds have passed
+        :param sync: whether to fsync the underlying file after flushing
+        """
+        self.every_bytes = every_bytes
+        self.every_files = every_files
+        self.every_seconds = every_seconds
+        self.sync = sync
+        self.bytes = 0
+        self.files = 0
+        self.last_flush = time.monotonic()
+
+    def update(self, num_bytes=0, num_files=0):
+        """
+        Account for written bytes and added files.
+        :return: True if a flush is due
+        """
+        self.bytes += num_bytes
+        self.files += num_files
+        if self.every_bytes is None and self.every_files is None and self.every_seconds is None:
+            return num_bytes > 0
+        return ((self.every_bytes is not None and self.bytes >= self.every_bytes)
+                or (self.every_files is not None and self.files >= self.every_files)
+                or (self.every_seconds is not None and time.monotonic() - self.last_flush >= self.every_seconds))
+
+    def flush(self, fileobj):
+        fileobj.flush()
+        if self.sync:
+            os.fsync(fileobj.fileno())
+        self.reset()
+
+    def reset(self):
+        self.bytes = 0
+        self.files = 0
+        self.last_flush = time.monotonic()
+
+
 class TapeFile:
-    def __init__(self, file=None, fileobj=None, mode='wb', bufsize=-1):
+    def __init__(self, file=None, fileobj=None, mode='wb', bufsize=-1, flush_policy=None):
         """
         File object that abstracts a tape drive (or any other file) and raises zero byte writes as an ENOSPC error.
         :param file: file location
         :param mode: file opening mode
         :param bufsize: explicit size of the underlying buffer
+        :param flush_policy: FlushPolicy deciding when to flush the underlying file. By default nothing is flushed
+                             explicitly.
         """
         self.bufsize = bufsize
+        self.flush_policy = flush_policy
 
         if file and fileobj:
             raise ValueError('Arguments "file" and "fileobj" are exclusive.')
@@ -39,6 +98,18 @@ class TapeFile:
         if result == 0:
             # convert a write return 0 to ENOSPC to detect end of tape
             raise IOError(errno.ENOSPC, os.strerror(errno.ENOSPC))
+        if self.flush_policy and self.flush_policy.update(num_bytes=len(buf)):
+            self.flush()
+
+    def flush(self):
+        if self.flush_policy:
+            self.flush_policy.flush(self.fileobj)
+        else:
+            self.fileobj.flush()
+
+    def file_added(self):
+        if self.flush_policy and self.flush_policy.update(num_files=1):
+            self.flush()
 
     def __enter__(self):
         return self
@@ -47,27 +118,156 @@ class TapeFile:
         self.close()
 
 
+class AsyncWriter:
+    def __init__(self, fileobj, bufsize=131072, num_buffers=4, sync=False):
+        """
+        File object that writes to fileobj on a dedicated thread, so that the device keeps streaming
+        while the calling thread reads, archives and encrypts the next data.
+        Written data is copied into a bounded ring of num_buffers preallocated buffers. Full buffers are
+        handed to the writer thread, a write() blocks while all buffers are in use.
+        An error of the writer thread (e.g. ENOSPC at the end of tape) is raised by the next
+        write(), flush(), wait() or close(). Data handed to the thread after the error is discarded.
+        :param fileobj: file object to write to
+        :param bufsize: size of each buffer, which is also the size of the writes to fileobj (except on flush)
+        :param num_buffers: number of buffers in the ring
+        :param sync: whether the writer thread fsyncs fileobj after flushing it
+        """
+        if num_buffers < 2:
+            raise ValueError(f'At least 2 buffers are required for asynchronous writing, not {num_buffers}')
+        self.fileobj = fileobj
+        self.bufsize = bufsize
+        self.sync = sync
+        # number of bytes written to fileobj and flushed by the writer thread
+        self.committed = 0
+        self.error = None
+        self.closed = False
+        self._written = 0
+        self._free = queue.Queue()
+        for _i in range(num_buffers):
+            self._free.put(bytearray(self.bufsize))
+        # items are (buffer, length) tuples, (None, 0) to request a flush and None to stop the thread
+        self._filled = queue.Queue()
+        self._buffer = self._free.get()
+        self._length = 0
+        self._thread = threading.Thread(target=self._run, name='AsyncWriter', daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        for buffer, length in iter(self._filled.get, None):
+            try:
+                if self.error:
+                    continue
+                if buffer is None:
+                    self.fileobj.flush()
+                    if self.sync:
+                        os.fsync(self.fileobj.fileno())
+                    self.committed = self._written
+                    continue
+                view = memoryview(buffer)[:length]
+                while view:
+                    result = self.fileobj.write(view)
+                    if result == 0:
+                        # convert a write return 0 to ENOSPC to detect end of tape
+                        raise IOError(errno.ENOSPC, os.strerror(errno.ENOSPC))
+                    # raw files may write less than requested
+                    view = view[result:] if result is not None else view[len(view):]
+                self._written += length
+            except BaseException as e:
+                logger.debug(f'AsyncWriter stopped writing after {self.committed} committed bytes: {e}')
+                self.error = e
+            finally:
+                if buffer is not None:
+                    self._free.put(buffer)
+                self._filled.task_done()
+        self._filled.task_done()
+
+    def _raise_error(self):
+        if self.error:
+            raise self.error
+
+    def _hand_off(self):
+        if self._length:
+            self._filled.put((self._buffer, self._length))
+            # blocks until the writer thread has written one of the buffers
+            self._buffer = self._free.get()
+            self._length = 0
+
+    def write(self, buf):
+        self._raise_error()
+        view = memoryview(buf).cast('B')
+        length = len(view)
+        while view:
+            n = min(self.bufsize - self._length, len(view))
+            self._buffer[self._length:self._length + n] = view[:n]
+            self._length += n
+            view = view[n:]
+            if self._length == self.bufsize:
+                self._hand_off()
+                self._raise_error()
+        return length
+
+    def flush(self):
+        """
+        Hand the buffered data to the writer thread and request a flush of fileobj afterwards.
+        This does not wait for the data to be written, see wait().
+        """
+        self._raise_error()
+        self._hand_off()
+        self._filled.put((None, 0))
+
+    def wait(self):
+        """
+        Block until the writer thread has processed all data handed to it.
+        """
+        self._filled.join()
+        self._raise_error()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            if not self.error:
+                self.flush()
+                self.wait()
+        finally:
+            self._filled.put(None)
+            self._thread.join()
+            self.fileobj.close()
+
+
 class AESFile:
-    def __init__(self, passphrase, file=None, fileobj=None, mode='wb', bufsize=512, sync=True, pad=True):
+    def __init__(self, passphrase, file=None, fileobj=None, mode='wb', bufsize=512, sync=True, pad=True, workers=1,
+                 flush_policy=None, async_buffers=0, first_sector=0, seekable=None):
         """
         Python file object for transparent AES encryption compatible with `aespipe` in single-key mode.
-        This class is closely suited for the requirements of the tarfile library and not
-        suited for arbitrary size write operations without respect to the buffer size.
-        :param file: output file or device path to write to
-        :param mode: the output file will be opened with mode
+        Writes of arbitrary size are supported: an incomplete sector at the end of a write is kept in
+        an internal buffer and completed by the following write. Only the last sector is padded on close().
+        In mode 'rb', the file is decrypted while it is read: bufsize bytes of ciphertext are read ahead and
+        decrypted at once, the zero padding of the last sector is returned as part of the data.
+        :param file: output file or device path to write to (to read from in mode 'rb')
+        :param mode: 'wb' or 'rb', the file will be opened with mode
         :param passphrase: bytestring to derive the encryption key from. To be compatible with `aespipe` there may be no newline char at the end!
-        :param bufsize: output buffer size used to buffer sector changes. At the end of each user write() the buffer is flushed if sync=True
-        :param sync: whether to flush and fsync the buffer at the end of each write operation
-        :param pad: whether to pad data to be written with zero bytes to the sector size.
-                    WARNING: this is only useful if the LAST write operation does not align to the sector size
-                    Otherwise there will be many zero-bytes in your written data!
+        :param bufsize: output buffer size used to buffer sector changes
+        :param sync: whether to fsync the file after each flush. Ignored if flush_policy is given.
+        :param pad: whether to pad the last incomplete sector with zero bytes on close().
+                    If False, closing the file with data that does not align to the sector size raises a ValueError.
+        :param workers: number of threads used to encrypt the sectors of a single write in parallel
+        :param flush_policy: FlushPolicy deciding when the output file is flushed. Defaults to flushing every write.
+        :param async_buffers: if > 0, the output file is written by a background thread through an AsyncWriter
+                              with this many buffers of bufsize bytes
+        :param first_sector: mode 'rb': number of the first sector in the file, if it does not start at the
+                             beginning of the encrypted stream, e.g. a tape positioned with `mt fsr`
+        :param seekable: mode 'rb': False to never call seek() of the underlying file, e.g. for tape devices,
+                         whose lseek() succeeds without moving the tape. By default, fileobj.seekable() decides.
         Please note that this implementation uses a constant IV for every sector to be compatible with `aespipe`.
         Therefore, it is recommended to use a different passphrase for every file to avoid leaking information!
 
         """
         self.SECTOR_SIZE = 512  # bytes
-        if mode != 'wb':
-            raise NotImplementedError("Mode must be 'wb' for now.")
+        if mode not in ('wb', 'rb'):
+            raise NotImplementedError("Mode must be 'wb' or 'rb'.")
+        self.mode = mode
         if len(passphrase) < 20:
             msg = f'Passphrase length incompatible with aespipe! {len(passphrase)}<20 characters.'
             warnings.warn(msg)
@@ -77,20 +277,34 @@ class AESFile:
         elif bufsize % self.SECTOR_SIZE:
             raise ValueError(f'Buffer Size has to be a multiple of {self.SECTOR_SIZE} bytes, not {bufsize}')
         self.bufsize = bufsize
-        self.sync = sync
+        self.flush_policy = flush_policy if flush_policy else FlushPolicy(sync=sync)
         self.pad = pad
         # the encryption key is derived from the upper 16 bytes of the SHA256 hash (in case of AES128)
         self.key = hashlib.sha256(passphrase).digest()[:16]
 
         # aespipe in single-key mode uses a 0-byte IV which is incremented for each 512 byte sector
-        self.sector = 0
-        self.bytes = 0
-        self._cipher = self._get_cipher()
-        self._encrypted_buffer = bytes(self.bufsize)
+        self.first_sector = first_sector if mode == 'rb' else 0
+        self._seekable = seekable
+        self.sector = self.first_sector
+        self.bytes = self.sector * self.SECTOR_SIZE
+        # number of bytes that have been passed to the underlying file, excluding the incomplete last sector
+        self.written = 0
+        # number of bytes that have been written AND flushed according to the flush policy
+        self._committed = 0
+        self._cipher = SectorCipher(self.key, workers=workers)
+        # preallocated output buffers that every write encrypts into, to avoid allocations per write
+        self._encrypted_buffer = bytearray(self.bufsize)
+        # the incomplete last sector written so far, it is carried over to the next write
+        self._remainder = bytearray(self.SECTOR_SIZE)
+        self._remainder_length = 0
+        # mode 'rb': decrypted data of the last read ahead and the position of the next byte to return in it
+        self._decrypted = memoryview(bytearray(self.bufsize if mode == 'rb' else 0))
+        self._decrypted_length = 0
+        self._decrypted_position = 0
+        self.closed = False
 
         # actual file we are writing to
-        # turn buffering off, as we are writing buffered chunks anyways
-        # note that the buffer is explicitly flushed after each write()
+        # note that the buffer is explicitly flushed according to the flush policy
         if file and fileobj:
             raise ValueError('Arguments "file" and "fileobj" are exclusive.')
         elif fileobj:
@@ -99,68 +313,321 @@ class AESFile:
             self.fileobj = open(file, mode=mode, buffering=self.bufsize)
         else:
             raise ValueError('Either file or fileobj is required.')
-        logger.debug(f'opened {file} with buffer size {self.bufsize} for writing AES encrypted data.')
+        self._writer = None
+        if async_buffers and mode == 'wb':
+            # the writer thread flushes and fsyncs in order with the data, see flush()
+            self._writer = AsyncWriter(self.fileobj, bufsize=self.bufsize, num_buffers=async_buffers,
+                                       sync=self.flush_policy.sync)
+            self.fileobj = self._writer
+        logger.debug(f'opened {file} with buffer size {self.bufsize} for {"reading" if mode == "rb" else "writing"} '
+                     f'AES encrypted data.')
+
+    def readable(self):
+        return self.mode == 'rb'
+
+    def writable(self):
+        return self.mode == 'wb'
+
+    def _read_ahead(self):
+        """
+        Read and decrypt the next up to bufsize bytes.
+        Devices like tape drives return at most one block per read, so reads are repeated until the ciphertext
+        consists of whole sectors.
+        :return: False at the end of the file
+        """
+        ciphertext = bytearray()
+        while len(ciphertext) < self.bufsize:
+            chunk = self.fileobj.read(self.bufsize - len(ciphertext))
+            if not chunk:
+                break
+            ciphertext += chunk
+            if not len(ciphertext) % self.SECTOR_SIZE:
+                break
+        incomplete = len(ciphertext) % self.SECTOR_SIZE
+        if incomplete:
+            logger.warning(f'Ignoring {incomplete} byte(s) of an incomplete sector at the end of the file')
+            del ciphertext[-incomplete:]
+        self._cipher.decrypt(ciphertext, self.sector, output=self._decrypted[:len(ciphertext)])
+        self.sector += len(ciphertext) // self.SECTOR_SIZE
+        self._decrypted_length = len(ciphertext)
+        self._decrypted_position = 0
+        return bool(ciphertext)
+
+    def read(self, size=-1):
+        """
+        Read and decrypt up to size bytes, all remaining bytes if size is negative.
+        """
+        if self.mode != 'rb':
+            raise io.UnsupportedOperation('File not open for reading')
+        chunks = []
+        remaining = size
+        while remaining:
+            if self._decrypted_position == self._decrypted_length and not self._read_ahead():
+                break
+            end = self._decrypted_length
+            if remaining > 0:
+                end = min(end, self._decrypted_position + remaining)
+                remaining -= end - self._decrypted_position
+            chunks.append(bytes(self._decrypted[self._decrypted_position:end]))
+            self._decrypted_position = end
+        data = b''.join(chunks)
+        self.bytes += len(data)
+        return data
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        """
+        Move to the absolute offset in the decrypted data (mode 'rb'). Seekable files are positioned at the sector
+        containing offset, which is decrypted without reading the preceding data. Other files, like tape devices
+        (see the seekable parameter), can only be skipped forward by reading.
+        """
+        if self.mode != 'rb' or whence != io.SEEK_SET:
+            raise io.UnsupportedOperation('Only absolute seeks are supported in mode "rb"')
+        sector = offset // self.SECTOR_SIZE
+        seekable = self.fileobj.seekable() if self._seekable is None else self._seekable
+        if sector >= self.first_sector and seekable:
+            self.fileobj.seek((sector - self.first_sector) * self.SECTOR_SIZE)
+            self.sector = sector
+            self.bytes = sector * self.SECTOR_SIZE
+            self._decrypted_length = self._decrypted_position = 0
+        elif offset < self.bytes:
+            raise io.UnsupportedOperation(f'Can not seek backwards from {self.bytes} to {offset}')
+        while self.bytes < offset:
+            if not self.read(min(offset - self.bytes, self.bufsize)):
+                break
+        return self.bytes
 
-    def _next_sector(self):
-        self.sector += 1
-        self._cipher = self._get_cipher()
+    def peek(self, size=1):
+        """
+        :return: up to size (at least one, unless at the end of the file) of the next bytes without consuming them
+        """
+        if self._decrypted_position == self._decrypted_length:
+            self._read_ahead()
+        return bytes(self._decrypted[self._decrypted_position:min(self._decrypted_length,
+                                                                  self._decrypted_position + size)])
 
     def write(self, buffer):
-        if len(buffer) % self.SECTOR_SIZE:
-            if not self.pad:
-                raise NotImplementedError(f'Buffer Size has to be a multiple of 512 bytes, not {len(buffer)}')
-            write_buffer = buffer.ljust(len(buffer) + (self.SECTOR_SIZE - (len(buffer) % self.SECTOR_SIZE)), b'\x00')
-        else:
-            write_buffer = buffer
-        for i in range(len(write_buffer) // self.SECTOR_SIZE):
-            result = self.fileobj.write(self._cipher.encrypt(write_buffer[self.SECTOR_SIZE * i: self.SECTOR_SIZE * (i + 1)]))
-            self._next_sector()
+        if self.mode != 'wb':
+            raise io.UnsupportedOperation('File not open for writing')
+        view = memoryview(buffer).cast('B')
+        length_written = len(view)
+        encrypted = memoryview(self._encrypted_buffer)
+        # number of bytes in the encrypted buffer that still have to be written
+        filled = 0
+        if self._remainder_length:
+            # complete the sector carried over from the last write first
+            length = min(self.SECTOR_SIZE - self._remainder_length, len(view))
+            self._remainder[self._remainder_length:self._remainder_length + length] = view[:length]
+            self._remainder_length += length
+            view = view[length:]
+            if self._remainder_length == self.SECTOR_SIZE:
+                self._cipher.encrypt(self._remainder, self.sector, output=encrypted[:self.SECTOR_SIZE])
+                self.sector += 1
+                self._remainder_length = 0
+                filled = self.SECTOR_SIZE
+        # whole sectors are encrypted into the preallocated buffer and written in chunks of up to bufsize bytes
+        aligned = len(view) - len(view) % self.SECTOR_SIZE
+        start = 0
+        while start < aligned:
+            length = min(self.bufsize - filled, aligned - start)
+            self._cipher.encrypt(view[start:start + length], self.sector, output=encrypted[filled:filled + length])
+            self.sector += length // self.SECTOR_SIZE
+            filled += length
+            start += length
+            if filled == self.bufsize:
+                self._write(encrypted[:filled])
+                filled = 0
+        if filled:
+            self._write(encrypted[:filled])
+        if aligned < len(view):
+            self._remainder[:len(view) - aligned] = view[aligned:]
+            self._remainder_length = len(view) - aligned
+        self.bytes += length_written
         # flush the buffer explicitly to catch write errors earlier
-        # TODO: disable?
-        self.fileobj.flush()
-        if self.sync:
-            os.fsync(self.fileobj.fileno())
+        if self.flush_policy.update(num_bytes=length_written):
+            self.flush()
+        return length_written
 
-        self.bytes += len(buffer)
-        return len(buffer)
+    def _write(self, encrypted):
+        self.fileobj.write(encrypted)
+        self.written += len(encrypted)
+
+    def flush(self):
+        """
+        Flush the underlying file. An incomplete last sector is kept until the next write or close().
+        With an AsyncWriter, the flush is only requested and committed is updated once the writer thread has done it.
+        """
+        if self._writer:
+            self._writer.flush()
+            self.flush_policy.reset()
+        else:
+            self.flush_policy.flush(self.fileobj)
+            self._committed = self.written
+
+    @property
+    def committed(self):
+        """
+        :return: Number of bytes that have been written to the underlying file AND flushed.
+        """
+        if self._writer:
+            # the ciphertext contains the padding of the last sector, which is not counted in self.written
+            return min(self.written, self._writer.committed)
+        return self._committed
+
+    def file_added(self):
+        """
+        Notify the file that a complete file has been written to it, which may cause a flush.
+        """
+        if self.flush_policy.update(num_files=1):
+            self.flush()
+
+    def _write_remainder(self):
+        """
+        Pad the incomplete last sector with zero bytes and write it.
+        """
+        if not self._remainder_length:
+            return
+        if not self.pad:
+            raise ValueError(f'{self._remainder_length} byte(s) do not align to the sector size and padding is disabled')
+        self._remainder[self._remainder_length:] = bytes(self.SECTOR_SIZE - self._remainder_length)
+        self.fileobj.write(self._cipher.encrypt(self._remainder, self.sector,
+                                                output=memoryview(self._encrypted_buffer)[:self.SECTOR_SIZE]))
+        self.sector += 1
+        # padding bytes are not counted
+        self.written += self._remainder_length
+        self._remainder_length = 0
 
     def close(self):
+        if self.closed:
+            return
+        try:
+            if self.mode == 'wb':
+                self._write_remainder()
+                self.flush()
+        finally:
+            self.closed = True
+            self._cipher.close()
+            self.fileobj.close()
+
+    def close_early(self):
+        """
+        Close the underlying file (e.g. at the end of tape) without writing any further data.
+        An incomplete last sector is discarded.
+        """
+        self.closed = True
+        self._cipher.close()
         self.fileobj.close()
 
     def tell(self):
         """
         This method is not entirely accurate in case a write operation has failed.
-        :return: Number of bytes written. With the current implementation the amount of
-        data written to disk and written to this file is identical except when padding is applied.
+        :return: Number of bytes written to this file, including an incomplete last sector that has not been
+        passed to the underlying file yet. See self.written for the number of bytes that have been and
+        self.committed for the number of bytes that have also been flushed.
+        In mode 'rb', the position in the decrypted data.
         """
         return self.bytes
 
-    def _get_cipher(self):
-        return AES.new(self.key, AES.MODE_CBC, IV=self.sector.to_bytes(16, byteorder='little'))
-
 
 class AESTarFile:
-    def __init__(self, passphrase, file=None, fileobj=None, mode='wb', bufsize=131072, compression=None, sync=False):
-        if mode != 'wb':
-            raise NotImplementedError('Mode must be "wb"')
-
-        self.aesfile = AESFile(passphrase=passphrase, file=file, fileobj=fileobj, mode=mode, bufsize=bufsize, sync=sync, pad=True)
-        self.tarfile = tarfile.open(fileobj=self.aesfile, mode=f'w|{compression if compression else ""}',
-                                    bufsize=bufsize)
-        self.pending_files = []
+    def __init__(self, passphrase, file=None, fileobj=None, mode='wb', bufsize=131072, compression=None, sync=False,
+                 workers=1, flush_policy=None, async_buffers=0, compression_workers=1, adaptive_compression=False,
+                 adaptive_min_size=65536, offset=0, first_sector=0, seekable=None):
+        """
+        :param compression_workers: with more than one, the tar stream is compressed in independent blocks
+                                    on this many threads, see compression.ParallelCompressor
+        :param adaptive_compression: store the contents of regular files that do not compress (by extension,
+                                     magic bytes or a compressed sample, see compression.is_incompressible)
+                                     with gzip level 0 instead of compressing them. Only for compression 'gz',
+                                     bz2 and xz have no stored mode and compress every file.
+                                     Implies a ParallelCompressor, the archive is still a standard compressed tar.
+        :param adaptive_min_size: smaller files are always compressed
+        :param offset: mode 'rb': start reading at this offset of the uncompressed archive, which has to be the
+                       offset of a tar header (see last_location). Only possible for uncompressed archives.
+        :param first_sector: mode 'rb': see AESFile
+        :param seekable: mode 'rb': see AESFile
+        In mode 'rb', the archive is decrypted and read as a stream in a single pass, see extract().
+        The compression is detected unless it is given, only passphrase, file, fileobj, bufsize,
+        compression, workers, offset, first_sector and seekable are used.
+        """
+        if mode not in ('wb', 'rb'):
+            raise NotImplementedError('Mode must be "wb" or "rb"')
+        self.mode = mode
+        # files in the order they were added, their end offsets in the output stream never decrease
+        self.pending_files = deque()
         self.num_files = 0  # includes directories and special files
         self.previous_pending_length = 0
+        self.last_checksum = None
+        # (tar offset, AES sector) of the header of the last added file, the sector is None if compressed
+        self.last_location = None
+        self.compression = compression
         self.closed = False
+        self.compressor = None
+        if mode == 'rb':
+            self.aesfile = AESFile(passphrase=passphrase, file=file, fileobj=fileobj, mode=mode, bufsize=bufsize,
+                                   workers=workers, first_sector=first_sector, seekable=seekable)
+            if offset:
+                if compression:
+                    raise ValueError('Compressed archives can only be read from the start')
+                self.aesfile.seek(offset)
+                compression = ''
+            self.decompressor = open_decompressor(self.aesfile, compression)
+            self.tarfile = tarfile.open(fileobj=self.decompressor, mode='r|', bufsize=bufsize)
+            if hasattr(tarfile, 'tar_filter'):
+                # restore everything a backup can contain, but nothing outside of the destination
+                self.tarfile.extraction_filter = tarfile.tar_filter
+            return
+
+        self.aesfile = AESFile(passphrase=passphrase, file=file, fileobj=fileobj, mode=mode, bufsize=bufsize, sync=sync,
+                               pad=True, workers=workers, flush_policy=flush_policy, async_buffers=async_buffers)
+        if adaptive_compression and compression and compression not in BYPASS_LEVELS:
+            msg = f'Adaptive compression is only possible with gz, {compression} compresses every file.'
+            warnings.warn(msg)
+            logger.warning(msg)
+            adaptive_compression = False
+        self.adaptive_compression = bool(compression) and adaptive_compression
+        self.adaptive_min_size = adaptive_min_size
+        if compression and (compression_workers > 1 or self.adaptive_compression):
+            self.compressor = ParallelCompressor(self.aesfile, compression, workers=compression_workers)
+            compression = None
+        # the file object the tar stream is written to, its tell() and committed are offsets in the tar stream
+        # (compressed unless a ParallelCompressor is used)
+        self.sink = self.compressor or self.aesfile
+        self.tarfile = tarfile.open(fileobj=self.sink, mode=f'w|{compression if compression else ""}',
+                                    bufsize=bufsize)
         # TODO: force PAX as default format independent of python version
 
-    def add(self, name, arcname=None):
+    def add(self, name, arcname=None, fileobj=None, checksum=None):
+        """
+        Add a single file (not recursively) to the archive.
+        :param fileobj: optional file object with the contents of a regular file, e.g. prefetched data.
+                        It is only used if its size matches the size of the file, otherwise the file is read.
+        :param checksum: optional hash constructor (e.g. hashlib.sha1). The contents of a regular file are hashed
+                         while they are archived, so the file is only read once. The digest is stored in
+                         self.last_checksum, which is None if the file was not archived as a regular file.
+        """
         # always treat a file as pending after it has been added, therefore call purge first
         # this only makes a difference if you happen to exactly fill the buffer size with the new file
         # (and then cause a buffer flush)
         self.purge_pending()
         logging.debug(f'tarfile has {len(self.pending_files)} pending files, now adding {name}')
+        self.last_checksum = None
+        # the header of the file starts at the current end of the tar stream
+        offset = self.tarfile.offset
         try:
-            self.tarfile.add(name, arcname=arcname, recursive=False)
+            tarinfo = None
+            if fileobj is not None or checksum is not None or self.adaptive_compression:
+                tarinfo = self.tarfile.gettarinfo(name, arcname=arcname)
+                if tarinfo is not None and not tarinfo.isreg():
+                    tarinfo = None
+            if tarinfo is not None:
+                if fileobj is not None and tarinfo.size != _remaining_size(fileobj):
+                    # the file has been changed since fileobj was read
+                    fileobj = None
+                self._add_regular(name, tarinfo, fileobj, checksum)
+            else:
+                self.tarfile.add(name, arcname=arcname, recursive=False)
+            # may flush according to the flush policy and thereby raise ENOSPC, too
+            self.aesfile.file_added()
         except OSError as e:
             self.purge_pending()
             if e.errno == errno.ENOSPC:
@@ -168,10 +635,28 @@ class AESTarFile:
                 self.close_early()
             raise
         self.num_files += 1
+        # without compression, the tar stream is the plaintext of the aesfile
+        self.last_location = (offset, None if self.compression else offset // self.aesfile.SECTOR_SIZE)
         self.pending_files.append(
-            (self.num_files, len(self.tarfile.fileobj.buf), self.aesfile.tell(), self.tarfile.offset))
+            (self.num_files, len(self.tarfile.fileobj.buf), self.sink.tell(), self.tarfile.offset))
         return self.pending_files[-1]
 
+    def _add_regular(self, name, tarinfo, fileobj, checksum):
+        with contextlib.ExitStack() as stack:
+            if fileobj is None:
+                fileobj = stack.enter_context(open(name, 'rb'))
+            if self.adaptive_compression and tarinfo.size >= self.adaptive_min_size \
+                    and is_incompressible(name, fileobj):
+                # the contents follow the header, which addfile() builds the same way
+                start = self.tarfile.offset + len(tarinfo.tobuf(self.tarfile.format, self.tarfile.encoding,
+                                                                self.tarfile.errors))
+                self.compressor.mark_incompressible(start, start + tarinfo.size)
+            if checksum is not None:
+                fileobj = HashingReader(fileobj, checksum())
+            self.tarfile.addfile(tarinfo, fileobj)
+            if checksum is not None:
+                self.last_checksum = fileobj.hash.digest()
+
     def purge_pending(self):
         """
         Update self.pending_files to the current state. files that remain pending after the purge are not
@@ -181,22 +666,23 @@ class AESTarFile:
         # i is the index in self.pending_files, stats[0] is the index (starting with 1)
         # of the file in all added files so far
         # stats[1] is the number of bytes currently in the (compressed) tarfile output buffer
-        # stats[2] is the number of bytes written to disk with the aesfile
+        # stats[2] is the number of bytes written to the sink (the aesfile or the parallel compressor)
         # stats[3] is the tarfile byte offset (uncompressed)
         # both AFTER the file in question has been added
         # I am not 100% sure this will work correctly for all corner-cases of *compressed* tarfiles
         # because the tarfile.fileobj.buf is not filled when a very small file is added
         # and is instead buffered in the compressor buffer
         # tarfile.fileobj.cmp.flush(zlib.Z_FULL_FLUSH) might be needed to be safe.
-        # TODO: this could probably be optimized by using two separate lists and calling .index() instead
+        # stats[1] + stats[2] is the end of the file in the stream written to the sink, the file is only committed
+        # once the aesfile has passed all of it to the underlying file and flushed it. A parallel compressor
+        # maps this to the uncompressed offset of the last block whose compressed data has been committed.
+        # The end offsets increase monotonically, so the committed files are always at the front of the deque
+        # and every file is removed exactly once.
         self.previous_pending_length = len(self.pending_files)
-        remove_indices = [i for i, stats in enumerate(self.pending_files) if
-                          (stats[1] + stats[2]) <= self.aesfile.tell()]
-
-        if len(remove_indices) > 0:
-            # all files up to and including the last index in remove_indices have been added
-            # and can be removed from the pending list
-            self.pending_files = self.pending_files[(remove_indices[-1] + 1):]
+        committed = self.sink.committed
+        pending_files = self.pending_files
+        while pending_files and pending_files[0][1] + pending_files[0][2] <= committed:
+            pending_files.popleft()
 
     @property
     def num_committed(self):
@@ -205,12 +691,77 @@ class AESTarFile:
     def stats(self):
         return self.tarfile.offset, self.aesfile.tell()
 
+    def __iter__(self):
+        """
+        Iterate over the members in archive order (mode 'rb'). The contents of a member can be read
+        with extractfile() until the next member is requested.
+        """
+        return iter(self.tarfile)
+
+    def extractfile(self, member):
+        return self.tarfile.extractfile(member)
+
+    def extract_member(self, member, path='.', names=None, set_attrs=True):
+        """
+        Extract a member (mode 'rb'), by default under its own name.
+        :param names: names to extract the member as instead, e.g. the paths of deduplicated copies of its content.
+                      The contents are read once, the member is extracted as the first name and copied to the others.
+        :return: list of the extracted members, one per name
+        """
+        if not names:
+            names = [member.name]
+        extracted = []
+        for name in names:
+            target = member
+            if name != member.name:
+                target = copy.copy(member)
+                target.name = name
+            if extracted and member.isreg():
+                logger.debug(f'Copying {extracted[0].name} to {name}')
+                os.makedirs(os.path.dirname(os.path.join(path, name)), exist_ok=True)
+                shutil.copy2(os.path.join(path, extracted[0].name), os.path.join(path, name))
+            else:
+                logger.debug(f'Extracting {member.name} as {name}')
+                self.tarfile.extract(target, path, set_attrs=set_attrs)
+            extracted.append(target)
+            self.num_files += 1
+        return extracted
+
+    def extract(self, path='.', select=None, targets=None):
+        """
+        Extract the members in a single pass over the archive (mode 'rb').
+        :param path: destination directory
+        :param select: optional function of a TarInfo returning whether to extract the member
+        :param targets: optional dict mapping member names to the names to extract them as, see extract_member()
+        :return: list of the extracted members
+        """
+        targets = targets or {}
+        extracted = []
+        for member in self.tarfile:
+            if select is None or select(member):
+                extracted += self.extract_member(member, path, names=targets.get(member.name),
+                                                 set_attrs=not member.isdir())
+        # directories are extracted before their contents, their attributes (mtime) are set afterwards
+        for member in reversed(extracted):
+            if member.isdir():
+                self.tarfile.extract(member, path)
+        return extracted
+
     def close(self):
+        if self.mode == 'rb':
+            self.closed = True
+            self.tarfile.close()
+            if self.decompressor is not self.aesfile:
+                self.decompressor.close()
+            self.aesfile.close()
+            return
         # you could also call purge_pending twice because in theory writing the last 1024 zero bytes
         # as end of archive may fail, though all file contents have been written
         # self.purge_pending()
         self.closed = True
         self.tarfile.close()
+        if self.compressor:
+            self.compressor.close()
         self.aesfile.close()
         self.purge_pending()
 
@@ -228,7 +779,9 @@ class AESTarFile:
         self.tarfile.closed = True
         self.tarfile.fileobj.closed = True
         self.closed = True
-        self.aesfile.fileobj.close()
+        if self.compressor:
+            self.compressor.close_early()
+        self.aesfile.close_early()
 
     def __enter__(self):
         return self
@@ -242,19 +795,46 @@ class AESTarFile:
             self.close_early()
 
 
+class HashingReader:
+    def __init__(self, fileobj, hash):
+        """
+        Read-only file object that updates hash with all data read from fileobj.
+        """
+        self.fileobj = fileobj
+        self.hash = hash
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.hash.update(data)
+        return data
+
+
+def _remaining_size(fileobj):
+    position = fileobj.tell()
+    size = fileobj.seek(0, io.SEEK_END) - position
+    fileobj.seek(position)
+    return size
+
+
 class PendingQueue:
     def __init__(self, queue):
         self.queue = queue
         self.restore_queue = deque()
+        # items that were pending when restore was set and have to be handed out again
+        self.replay_queue = None
         self.restore = False
 
     def get(self):
         if self.restore:
+            if self.replay_queue is None:
+                # every pending item is replayed exactly once, in its original order
+                self.replay_queue, self.restore_queue = self.restore_queue, deque()
             try:
-                item = self.restore_queue.pop()
+                item = self.replay_queue.pop()
             except IndexError:
                 logger.debug('Restore finished!')
                 self.restore = False
+                self.replay_queue = None
                 item = self.queue.get()
         else:
             item = self.queue.get()
@@ -266,14 +846,29 @@ class PendingQueue:
     def confirm(self, num=1):
         return [self.restore_queue.pop() for _i in range(num)]
 
+    def discard(self):
+        """
+        Forget the item returned by the last get(), e.g. because it is not written to the archive.
+        """
+        return self.restore_queue.popleft()
+
     def qsize(self):
-        return self.queue.qsize() + len(self.restore_queue)
+        return self.queue.qsize() + len(self.restore_queue) + len(self.replay_queue or ())
 
     def __len__(self):
         return self.qsize()
 
 
-def save_to_archive(pending_queue, archive, pre_add_callback=None, commit_callback=None):
+def save_to_archive(pending_queue, archive, pre_add_callback=None, commit_callback=None, checksum=None):
+    """
+    Add the items of pending_queue to archive until the queue is exhausted or the end of tape is reached.
+    :param pre_add_callback: called with every item before it is added, the item is skipped if it returns True.
+                             It also receives the fileinfo.HashCacheEntry side records, which are never added.
+    :param commit_callback: called with every item once it has been entirely written to the archive
+    :param checksum: hash constructor, e.g. hashlib.sha1. Regular files without a 'sha1' in their info_dict are
+                     hashed while they are archived and the digest is stored in the info_dict before committing.
+    :return: 0 if all items have been archived, 1 in case of EOT
+    """
     for item in iter(pending_queue.get, None):
         # insert the new file into the database
         # if it exists, update the record, because e.g. the mtime might have been changed
@@ -283,10 +878,25 @@ def save_to_archive(pending_queue, archive, pre_add_callback=None, commit_callba
             # if the return value evaluates to True, the current item is skipped
             if pre_add_callback(item):
                 logger.debug(f'Skipping {item} because of insert callback result.')
-                # skip current item
+                # skip current item, it is never committed and must not be replayed after EOT
+                pending_queue.discard()
                 continue
+        if isinstance(item, HashCacheEntry):
+            pending_queue.discard()
+            continue
         try:
-            archive.add(item.info_dict['path'])
+            # contents read ahead of time by a prefetch.Prefetcher are only used once
+            prefetched = getattr(item, 'prefetched', None)
+            fileobj = None
+            if prefetched is not None:
+                item.prefetched = None
+                fileobj = io.BytesIO(prefetched)
+            hash_item = checksum is not None and item.info_dict.get('sha1') is None
+            archive.add(item.info_dict['path'], fileobj=fileobj, checksum=checksum if hash_item else None)
+            if hash_item and archive.last_checksum is not None:
+                item.info_dict['sha1'] = archive.last_checksum
+            # recorded in the catalogue for restoring the file without reading the archive from the start
+            item.info_dict['tar_offset'], item.info_dict['sector'] = archive.last_location
         except OSError as e:
             if e.errno != errno.ENOSPC:
                 logger.error(f'Could not write {item}, got OSError {e.errno}.')
@@ -311,5 +921,60 @@ def save_to_archive(pending_queue, archive, pre_add_callback=None, commit_callba
             if commit_callback:
                 for committed in items:
                     commit_callback(committed)
+    prev_committed = archive.num_committed
     archive.close()
+    # the files that were still pending are committed by closing the archive
+    items = pending_queue.confirm(archive.num_committed - prev_committed)
+    if commit_callback:
+        for committed in items:
+            commit_callback(committed)
     return 0
+
+
+def extract_at(passphrase, file, tar_offset, path='.', names=None, record_size=None, bufsize=131072, workers=1,
+               fileobj=None, targets=None):
+    """
+    Extract files from an uncompressed archive starting at a tar header, without reading or decrypting the data
+    before it. The sectors are encrypted independently, so decryption can start at any sector.
+    :param file: archive file, or non-rewinding tape device (/dev/nst*) positioned at the start of the tape file
+                 holding the archive. A rewinding device loses the position between `mt fsr` and opening it.
+    :param tar_offset: offset of the header of the first file to extract, from the `backed_up_files` catalogue table
+    :param names: member names to extract, reading stops once all of them have been extracted.
+                  By default, only the member at tar_offset is extracted.
+    :param record_size: fixed block size of the tape drive. The tape is spaced forward with `mt fsr` to the record
+                        containing tar_offset, the rest of the record is skipped by reading whole records.
+                        The device is never positioned with seek(). Without it, file is a regular file
+                        and is positioned with seek().
+    :param fileobj: optional file object to read instead of opening file, which is still used for `mt`
+    :param targets: optional dict mapping member names to the names to extract them as, see
+                    AESTarFile.extract_member()
+    :return: list of the extracted members
+    """
+    first_sector = 0
+    seekable = None
+    if record_size:
+        if record_size % SECTOR_SIZE:
+            raise ValueError(f'Record size has to be a multiple of {SECTOR_SIZE} bytes, not {record_size}')
+        records = tar_offset // record_size
+        mt.forward_records(records, device=file)
+        first_sector = records * record_size // SECTOR_SIZE
+        # every read is a multiple of the record size, which unbuffered reads of a fixed block device require
+        bufsize = max(bufsize - bufsize % record_size, record_size)
+        seekable = False
+        if fileobj is None:
+            fileobj = open(file, 'rb', buffering=0)
+    remaining = None if names is None else set(names)
+    targets = targets or {}
+    extracted = []
+    with AESTarFile(passphrase, file=None if fileobj is not None else file, fileobj=fileobj, mode='rb',
+                    bufsize=bufsize, workers=workers, offset=tar_offset, first_sector=first_sector,
+                    seekable=seekable) as archive:
+        for member in archive:
+            if remaining is None or member.name in remaining:
+                extracted += archive.extract_member(member, path, names=targets.get(member.name))
+            if remaining is None:
+                break
+            remaining.discard(member.name)
+            if not remaining:
+                break
+    return extracted
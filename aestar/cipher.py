@@ -0,0 +1,205 @@
+import sys
+import threading
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+
+from Crypto.Cipher import AES
+from Crypto.Util.strxor import strxor
+
+SECTOR_SIZE = 512  # bytes
+BLOCK_SIZE = AES.block_size  # bytes
+BLOCKS_PER_SECTOR = SECTOR_SIZE // BLOCK_SIZE
+# number of 8 byte words per block and per sector, used to address blocks with strided memoryviews
+_WORDS_PER_BLOCK = BLOCK_SIZE // 8
+_WORDS_PER_SECTOR = SECTOR_SIZE // 8
+# read-only zero words for the upper halves of the IVs, shared by all threads and grown on demand
+_zero_words = memoryview(bytes(8 * 2048)).cast('Q')
+
+
+def _zeros(count):
+    global _zero_words
+    if len(_zero_words) < count:
+        _zero_words = memoryview(bytes(8 * count)).cast('Q')
+    return _zero_words[:count]
+
+
+class SectorCipher:
+    def __init__(self, key, workers=1, min_sectors_per_worker=64):
+        """
+        Batched AES-CBC encryption and decryption of 512 byte sectors compatible with `aespipe` in single-key mode.
+        Every sector is its own CBC chain with the little endian sector number as IV.
+        Instead of creating a new CBC cipher for every sector, the n-th block of all sectors in a buffer
+        is encrypted with a single ECB call after XORing it with the (n-1)-th ciphertext block (or IV).
+        :param key: AES key
+        :param workers: number of threads to spread the sectors of a buffer over.
+                        The AES and XOR primitives release the GIL, so sector ranges are encrypted concurrently.
+        :param min_sectors_per_worker: buffers are only split if every worker gets at least this many sectors
+        """
+        if workers < 1:
+            raise ValueError(f'Number of workers has to be at least 1, not {workers}')
+        self.key = key
+        self.workers = workers
+        self.min_sectors_per_worker = min_sectors_per_worker
+        # cipher objects are not shared between threads
+        self._local = threading.local()
+        self._executor = None
+        if self.workers > 1:
+            self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='SectorCipher')
+
+    @property
+    def _ecb(self):
+        try:
+            return self._local.ecb
+        except AttributeError:
+            self._local.ecb = AES.new(self.key, AES.MODE_ECB)
+            return self._local.ecb
+
+    @staticmethod
+    def ivs(first_sector, num_sectors, output=None, stride=BLOCK_SIZE):
+        """
+        :param output: optional writable buffer of at least num_sectors * stride bytes to store the IVs in
+        :param stride: distance between the IVs in output in bytes, a multiple of BLOCK_SIZE.
+                       The bytes between the IVs are left unchanged.
+        :return: IVs for num_sectors consecutive sectors starting with first_sector (output, if given)
+        """
+        if output is None:
+            output = bytearray(num_sectors * stride)
+        step = stride // 8
+        words = memoryview(output).cast('B')[:num_sectors * stride].cast('Q')
+        numbers = array('Q', range(first_sector, first_sector + num_sectors))
+        if sys.byteorder != 'little':
+            numbers.byteswap()
+        words[0::step] = numbers
+        # the upper 8 bytes of every IV are zero
+        words[1::step] = _zeros(num_sectors)
+        return output
+
+    def encrypt(self, buffer, first_sector, output=None):
+        """
+        Encrypt a buffer of whole sectors.
+        :param buffer: plaintext, its length has to be a multiple of the sector size
+        :param first_sector: sector number of the first sector in buffer
+        :param output: optional preallocated writable buffer of the same length to encrypt into
+        :return: ciphertext (output, if given)
+        """
+        if len(buffer) % SECTOR_SIZE:
+            raise ValueError(f'Buffer length has to be a multiple of {SECTOR_SIZE} bytes, not {len(buffer)}')
+        num_sectors = len(buffer) // SECTOR_SIZE
+        plaintext = memoryview(buffer).cast('B')
+        ciphertext = bytearray(len(buffer)) if output is None else output
+        out = memoryview(ciphertext).cast('B')
+        if len(out) != len(plaintext):
+            raise ValueError(f'Output buffer length {len(out)} does not match the input length {len(plaintext)}')
+        ranges = self._split(num_sectors)
+        if len(ranges) > 1:
+            # sectors are independent CBC chains, every worker writes its range into its slice of the output
+            futures = [self._executor.submit(self._encrypt_sectors,
+                                             plaintext[start * SECTOR_SIZE:stop * SECTOR_SIZE],
+                                             first_sector + start,
+                                             out[start * SECTOR_SIZE:stop * SECTOR_SIZE])
+                       for start, stop in ranges]
+            for future in futures:
+                future.result()
+        else:
+            self._encrypt_sectors(plaintext, first_sector, out)
+        return ciphertext
+
+    def decrypt(self, buffer, first_sector, output=None):
+        """
+        Decrypt a buffer of whole sectors.
+        CBC decryption does not chain, so all blocks are decrypted with a single ECB call
+        and XORed with the preceding ciphertext block, or the IV for the first block of every sector.
+        :param buffer: ciphertext, its length has to be a multiple of the sector size
+        :param first_sector: sector number of the first sector in buffer
+        :param output: optional preallocated writable buffer of the same length to decrypt into
+        :return: plaintext (output, if given)
+        """
+        if len(buffer) % SECTOR_SIZE:
+            raise ValueError(f'Buffer length has to be a multiple of {SECTOR_SIZE} bytes, not {len(buffer)}')
+        num_sectors = len(buffer) // SECTOR_SIZE
+        ciphertext = memoryview(buffer).cast('B')
+        plaintext = bytearray(len(buffer)) if output is None else output
+        out = memoryview(plaintext).cast('B')
+        if len(out) != len(ciphertext):
+            raise ValueError(f'Output buffer length {len(out)} does not match the input length {len(ciphertext)}')
+        ranges = self._split(num_sectors)
+        if len(ranges) > 1:
+            futures = [self._executor.submit(self._decrypt_sectors,
+                                             ciphertext[start * SECTOR_SIZE:stop * SECTOR_SIZE],
+                                             first_sector + start,
+                                             out[start * SECTOR_SIZE:stop * SECTOR_SIZE])
+                       for start, stop in ranges]
+            for future in futures:
+                future.result()
+        else:
+            self._decrypt_sectors(ciphertext, first_sector, out)
+        return plaintext
+
+    def _decrypt_sectors(self, ciphertext, first_sector, out):
+        num_sectors = len(ciphertext) // SECTOR_SIZE
+        if not num_sectors:
+            return
+        previous = self._previous_blocks(len(ciphertext))
+        # the previous block of every block is the ciphertext shifted by one block ...
+        previous[BLOCK_SIZE:] = ciphertext[:-BLOCK_SIZE]
+        # ... except for the first block of every sector, which is XORed with the IV
+        self.ivs(first_sector, num_sectors, output=previous, stride=SECTOR_SIZE)
+        self._ecb.decrypt(ciphertext, output=out)
+        strxor(out, previous, output=out)
+
+    def _previous_blocks(self, size):
+        """
+        :return: per-thread scratch buffer of size bytes, reused between calls like _scratch()
+        """
+        previous = getattr(self._local, 'previous', None)
+        if previous is None or len(previous) < size:
+            previous = bytearray(size)
+            self._local.previous = previous
+        return memoryview(previous)[:size]
+
+    def _split(self, num_sectors):
+        """
+        :return: list of (start, stop) sector ranges, one per worker
+        """
+        parts = min(self.workers, num_sectors // self.min_sectors_per_worker)
+        if parts <= 1:
+            return [(0, num_sectors)]
+        bounds = [num_sectors * i // parts for i in range(parts + 1)]
+        return list(zip(bounds[:-1], bounds[1:]))
+
+    def _encrypt_sectors(self, plaintext, first_sector, out):
+        num_sectors = len(plaintext) // SECTOR_SIZE
+        plaintext_words = plaintext.cast('Q')
+        out_words = out.cast('Q')
+        chain, column = self._scratch(num_sectors)
+        # chain holds the previous ciphertext block of every sector, starting with the IVs
+        self.ivs(first_sector, num_sectors, output=chain)
+        chain_words = chain.cast('Q')
+        column_words = column.cast('Q')
+        ecb = self._ecb
+        for block in range(BLOCKS_PER_SECTOR):
+            for word in range(_WORDS_PER_BLOCK):
+                offset = block * _WORDS_PER_BLOCK + word
+                column_words[word::_WORDS_PER_BLOCK] = plaintext_words[offset::_WORDS_PER_SECTOR]
+            strxor(column, chain, output=column)
+            ecb.encrypt(column, output=chain)
+            for word in range(_WORDS_PER_BLOCK):
+                offset = block * _WORDS_PER_BLOCK + word
+                out_words[offset::_WORDS_PER_SECTOR] = chain_words[word::_WORDS_PER_BLOCK]
+
+    def _scratch(self, num_sectors):
+        """
+        :return: two per-thread scratch buffers holding one block of num_sectors sectors each.
+        The buffers are reused between calls and only grow when a larger buffer is encrypted.
+        """
+        size = num_sectors * BLOCK_SIZE
+        scratch = getattr(self._local, 'scratch', None)
+        if scratch is None or len(scratch[0]) < size:
+            scratch = (bytearray(size), bytearray(size))
+            self._local.scratch = scratch
+        return memoryview(scratch[0])[:size], memoryview(scratch[1])[:size]
+
+    def close(self):
+        if self._executor:
+            self._executor.shutdown()
+            self._executor = None
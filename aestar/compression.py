@@ -0,0 +1,285 @@
+import bz2
+import gzip
+import logging
+import lzma
+import os
+import struct
+import time
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+# the same default levels as tarfile's stream modes
+DEFAULT_LEVELS = {'gz': 9, 'bz2': 9, 'xz': 6}
+# levels for data that does not compress: gzip level 0 stores it without compressing. bz2 and xz have no stored
+# mode, bz2 level 1 costs about as much CPU as level 9 and xz preset 0 still runs the match finder.
+BYPASS_LEVELS = {'gz': 0}
+
+# extensions and magic bytes of formats that are already compressed or encrypted
+INCOMPRESSIBLE_EXTENSIONS = frozenset([
+    '.jpg', '.jpeg', '.png', '.gif', '.webp', '.heic', '.mp3', '.aac', '.ogg', '.opus', '.flac', '.mp4', '.m4a',
+    '.m4v', '.mkv', '.mov', '.avi', '.webm', '.zip', '.jar', '.docx', '.xlsx', '.pptx', '.odt', '.gz', '.tgz',
+    '.bz2', '.xz', '.txz', '.zst', '.lz4', '.7z', '.rar', '.gpg', '.aes',
+])
+INCOMPRESSIBLE_MAGIC = (
+    (0, b'\xff\xd8\xff'),  # JPEG
+    (0, b'\x89PNG'),
+    (0, b'GIF8'),
+    (0, b'PK\x03\x04'),  # zip and the formats based on it
+    (0, b'\x1f\x8b'),  # gzip
+    (0, b'BZh'),
+    (0, b'\xfd7zXZ\x00'),
+    (0, b'\x28\xb5\x2f\xfd'),  # zstd
+    (0, b'7z\xbc\xaf\x27\x1c'),
+    (0, b'Rar!'),
+    (0, b'OggS'),
+    (0, b'fLaC'),
+    (4, b'ftyp'),  # MP4, MOV, HEIC
+)
+
+
+def is_incompressible(name, fileobj=None, sample_size=65536, min_ratio=0.95):
+    """
+    Guess whether compressing a file is a waste of time by its extension, its magic bytes or, failing that,
+    by compressing a sample of its beginning with the fastest zlib level.
+    :param fileobj: seekable file object with the contents, its position is restored
+    :param min_ratio: files whose sample compresses to more than this fraction of its size are incompressible
+    """
+    if os.path.splitext(os.fspath(name))[1].lower() in INCOMPRESSIBLE_EXTENSIONS:
+        return True
+    if fileobj is None:
+        return False
+    position = fileobj.tell()
+    try:
+        sample = fileobj.read(sample_size)
+    finally:
+        fileobj.seek(position)
+    if not sample:
+        return False
+    if any(sample[offset:offset + len(magic)] == magic for offset, magic in INCOMPRESSIBLE_MAGIC):
+        return True
+    return len(zlib.compress(sample, 1)) > min_ratio * len(sample)
+
+
+# magic bytes at the start of the compressed streams
+MAGIC = {'gz': b'\x1f\x8b', 'bz2': b'BZh', 'xz': b'\xfd7zXZ\x00'}
+
+
+def open_decompressor(fileobj, compression=None):
+    """
+    Open a file object that reads the decompressed data of fileobj sequentially.
+    Unlike tarfile's stream modes, this reads all streams of the concatenated bz2 and xz output of a
+    ParallelCompressor, and ignores the zero padding that follows the compressed data.
+    :param fileobj: readable file object, it needs a peek() method to detect the compression
+    :param compression: 'gz', 'bz2', 'xz', '' for uncompressed data or None to detect it by the magic bytes
+    :return: decompressing file object, or fileobj if the data is not compressed
+    """
+    if compression is None:
+        head = fileobj.peek(max(len(magic) for magic in MAGIC.values()))
+        compression = next((name for name, magic in MAGIC.items() if head.startswith(magic)), '')
+        logger.debug(f'Detected compression "{compression}"')
+    if compression == 'gz':
+        return gzip.GzipFile(fileobj=fileobj, mode='rb')
+    if compression == 'bz2':
+        return bz2.BZ2File(fileobj, mode='rb')
+    if compression == 'xz':
+        return lzma.LZMAFile(fileobj, mode='rb')
+    if compression:
+        raise ValueError(f'Unknown compression "{compression}"')
+    return fileobj
+
+
+# size of the deflate window, the end of the previous block is used as dictionary for the next one
+_DEFLATE_WINDOW = 32768
+
+
+def _deflate_block(block, level, zdict):
+    if zdict:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS, zlib.DEF_MEM_LEVEL,
+                                      zlib.Z_DEFAULT_STRATEGY, zdict)
+    else:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    # a sync flush ends the block on a byte boundary without ending the deflate stream,
+    # so the compressed blocks can simply be concatenated
+    return compressor.compress(block) + compressor.flush(zlib.Z_SYNC_FLUSH)
+
+
+def _bz2_block(block, level, zdict):
+    return bz2.compress(block, level)
+
+
+def _xz_block(block, level, zdict):
+    return lzma.compress(block, format=lzma.FORMAT_XZ, preset=level)
+
+
+class ParallelCompressor:
+    def __init__(self, fileobj, compression, level=None, block_size=1048576, workers=4, bypass_level=None):
+        """
+        Write-only file object that compresses blocks of block_size bytes independently on a thread pool
+        (zlib, bz2 and lzma release the GIL) and writes the compressed blocks to fileobj in order.
+        'gz' produces a single gzip member, like pigz: every block is a raw deflate segment ending with a sync flush
+        that uses the last 32 KiB of the previous block as dictionary.
+        'bz2' and 'xz' produce one stream per block. Concatenated streams are read by bzip2/xz and Python's
+        bz2/lzma modules, but not by tarfile's stream modes ('r|bz2', 'r|xz').
+        :param fileobj: file object to write the compressed data to, e.g. an AESFile
+        :param compression: 'gz', 'bz2' or 'xz'
+        :param level: compression level (preset for xz), defaults to the level tarfile uses
+        :param block_size: number of uncompressed bytes per block
+        :param workers: number of compression threads
+        :param bypass_level: level for the ranges marked by mark_incompressible(), defaults to BYPASS_LEVELS.
+                             Only gzip has a level that bypasses compression.
+        """
+        if compression not in DEFAULT_LEVELS:
+            raise ValueError(f'Unknown compression "{compression}"')
+        self.fileobj = fileobj
+        self.compression = compression
+        self.level = DEFAULT_LEVELS[compression] if level is None else level
+        self.block_size = block_size
+        self.bypass_level = BYPASS_LEVELS.get(compression) if bypass_level is None else bypass_level
+        self.closed = False
+        # (start, end) uncompressed offsets of incompressible data in ascending order
+        self._incompressible = deque()
+        # number of uncompressed bytes compressed with the bypass level
+        self.bytes_bypassed = 0
+        # uncompressed bytes written to this file and handed to the thread pool
+        self.bytes = 0
+        self._submitted = 0
+        self._block = bytearray()
+        self._compress = {'gz': _deflate_block, 'bz2': _bz2_block, 'xz': _xz_block}[compression]
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='ParallelCompressor')
+        # blocks that are being compressed, (future, uncompressed end offset, block) tuples in stream order
+        self._in_flight = deque()
+        self._max_in_flight = 2 * workers
+        # (uncompressed end offset, end offset in fileobj) of the blocks that have been passed to fileobj
+        self._written = deque()
+        self._committed = 0
+        self._crc = 0
+        self._zdict = None
+        if self.compression == 'gz':
+            self.fileobj.write(b'\037\213\010\000' + struct.pack('<L', int(time.time())) + b'\000\377')
+
+    def mark_incompressible(self, start, end):
+        """
+        Compress the data between the uncompressed offsets start and end with the bypass level.
+        Blocks are cut at both offsets, so that a block is either compressed or bypassed entirely.
+        The ranges have to be marked in ascending order before their data is written.
+        """
+        if self.bypass_level is None:
+            raise ValueError(f'Compression "{self.compression}" has no level that bypasses compression')
+        if end > start:
+            self._incompressible.append((max(start, self.bytes), end))
+
+    def _next_boundary(self, offset):
+        """
+        :return: (offset of the next range boundary after offset or None, whether offset is in a marked range)
+        """
+        while self._incompressible and self._incompressible[0][1] <= offset:
+            self._incompressible.popleft()
+        if not self._incompressible:
+            return None, False
+        start, end = self._incompressible[0]
+        if offset < start:
+            return start, False
+        return end, True
+
+    def write(self, data):
+        view = memoryview(data).cast('B')
+        length = len(view)
+        while view:
+            offset = self._submitted + len(self._block)
+            boundary, bypass = self._next_boundary(offset)
+            n = min(self.block_size - len(self._block), len(view))
+            if boundary is not None:
+                n = min(n, boundary - offset)
+            self._block += view[:n]
+            view = view[n:]
+            if len(self._block) == self.block_size or offset + n == boundary:
+                self._submit(bypass)
+        self.bytes += length
+        return length
+
+    def _submit(self, bypass=False):
+        if not self._block:
+            return
+        block = bytes(self._block)
+        self._block = bytearray()
+        self._submitted += len(block)
+        level = self.level
+        if bypass:
+            level = self.bypass_level
+            self.bytes_bypassed += len(block)
+        self._in_flight.append((self._executor.submit(self._compress, block, level, self._zdict),
+                                self._submitted, block))
+        if self.compression == 'gz':
+            self._zdict = block[-_DEFLATE_WINDOW:]
+        self._write_finished(wait=len(self._in_flight) > self._max_in_flight)
+
+    def _write_finished(self, wait=False, all_blocks=False):
+        """
+        Write the compressed blocks at the front of the queue to fileobj, as long as they are finished
+        :param wait: wait for at least one block
+        :param all_blocks: wait for all blocks
+        """
+        while self._in_flight and (wait or all_blocks or self._in_flight[0][0].done()):
+            future, end, block = self._in_flight.popleft()
+            compressed = future.result()
+            if self.compression == 'gz':
+                self._crc = zlib.crc32(block, self._crc)
+            self.fileobj.write(compressed)
+            self._written.append((end, self.fileobj.tell()))
+            wait = False
+
+    def tell(self):
+        """
+        :return: number of uncompressed bytes written to this file
+        """
+        return self.bytes
+
+    @property
+    def committed(self):
+        """
+        :return: number of uncompressed bytes whose compressed data has been committed by fileobj
+        """
+        fileobj_committed = self.fileobj.committed
+        while self._written and self._written[0][1] <= fileobj_committed:
+            self._committed = self._written.popleft()[0]
+        return self._committed
+
+    def flush(self):
+        """
+        Compress the buffered data as a (shorter) block and write all blocks to fileobj
+        """
+        self._submit(self._next_boundary(self._submitted)[1])
+        self._write_finished(all_blocks=True)
+        self.fileobj.flush()
+
+    def close(self):
+        """
+        Write all data and the end of the compressed stream to fileobj, which is not closed
+        """
+        if self.closed:
+            return
+        self._submit(self._next_boundary(self._submitted)[1])
+        self._write_finished(all_blocks=True)
+        self.closed = True
+        self._executor.shutdown()
+        if self.compression == 'gz':
+            # an empty final deflate block and the gzip trailer
+            self.fileobj.write(zlib.compressobj(self.level, zlib.DEFLATED, -zlib.MAX_WBITS).flush(zlib.Z_FINISH) +
+                               struct.pack('<LL', self._crc, self.bytes & 0xFFFFFFFF))
+            # the last file is only committed once the stream is complete
+            if self._written:
+                self._written[-1] = (self._written[-1][0], self.fileobj.tell())
+
+    def close_early(self):
+        """
+        Stop without writing any further data, e.g. at the end of tape
+        """
+        self.closed = True
+        for future, _end, _block in self._in_flight:
+            future.cancel()
+        self._in_flight.clear()
+        self._executor.shutdown(wait=False)
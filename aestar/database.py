@@ -1,5 +1,8 @@
 import sqlite3
 import logging
+import queue
+import threading
+from concurrent.futures import Future
 from datetime import datetime
 
 stat_fields = ['mode', 'dev', 'nlink', 'uid', 'gid', 'size', 'atime', 'mtime', 'ctime']
@@ -62,22 +65,60 @@ def create_tables(cursor):
         file_id	INTEGER NOT NULL,
         partial_backup_id	INTEGER NOT NULL,
         deduplication_file_id INTEGER,
+        /* offset of the tar header in the uncompressed tar stream and
+           the AES sector it starts in, NULL for compressed archives and deduplicated files */
+        tar_offset INTEGER,
+        sector INTEGER,
         FOREIGN KEY(partial_backup_id) REFERENCES partial_backup(id),
         FOREIGN KEY(file_id) REFERENCES files(id) ON UPDATE CASCADE,
         FOREIGN KEY(deduplication_file_id) REFERENCES files(id),
         PRIMARY KEY(file_id, partial_backup_id)
     );
+    /* checksums of regular files, reused as long as the stat results of the file do not change */
+    CREATE TABLE IF NOT EXISTS hash_cache (
+        st_dev	INTEGER NOT NULL,
+        st_ino	INTEGER NOT NULL,
+        st_size	INTEGER NOT NULL,
+        st_mtime_ns	INTEGER NOT NULL,
+        st_ctime_ns	INTEGER NOT NULL,
+        sha1	BLOB NOT NULL,
+        PRIMARY KEY(st_dev, st_ino)
+    );
     PRAGMA foreign_keys = ON;
     """
     logger.debug(f'Creating DB tables if they do not already exist. Using stat fields: {", ".join(stat_fields)}.')
     cursor.executescript(sql)
+    migrate_tables(cursor)
+
+
+# columns that have been added to existing tables, (name, type) by table
+added_columns = {'backed_up_files': [('tar_offset', 'INTEGER'), ('sector', 'INTEGER')]}
+
+
+def migrate_tables(cursor):
+    """
+    Add the columns that catalogues created by earlier versions are missing
+    """
+    for table, columns in added_columns.items():
+        existing = {row[1] for row in cursor.execute(f'PRAGMA table_info({table})')}
+        for name, column_type in columns:
+            if name not in existing:
+                logger.info(f'Adding column {name} to table {table}.')
+                cursor.execute(f'ALTER TABLE {table} ADD COLUMN {name} {column_type}')
 
 
-def init_db(db_file):
+def init_db(db_file, wal=True):
     logger.info(f'Initializing sqlite database {db_file}.')
     conn = sqlite3.connect(db_file)
     conn.row_factory = sqlite3.Row
     c = conn.cursor()
+    if wal:
+        # readers do not block the writer and commits only append to the log.
+        # With synchronous=NORMAL a power loss can only lose the latest transactions, which is safe for the
+        # catalogue: a file on tape may be missing from it, but it never lists a file that is not on tape.
+        c.execute('PRAGMA journal_mode=WAL')
+        c.execute('PRAGMA synchronous=NORMAL')
+    c.execute('PRAGMA temp_store=MEMORY')
     create_tables(c)
     logger.debug('Done initializing sqlite database.')
     return conn
@@ -101,9 +142,59 @@ def select(data, table, cursor, selection='*', chain_operator='AND', suffix=''):
     return cursor.execute(select_str, values)
 
 
+class FileIndex:
+    def __init__(self, rows=()):
+        """
+        In-memory index of the latest backed up version of every file, so that checking a file does not need a query.
+        :param rows: iterable of (path, st_ino, st_size, st_mtime, sha1) tuples, later rows replace earlier ones
+        """
+        self.entries = {(path, st_ino): (st_size, st_mtime, sha1) for path, st_ino, st_size, st_mtime, sha1 in rows}
+
+    def __len__(self):
+        return len(self.entries)
+
+    def contains(self, info_dict):
+        """
+        :return: True if the latest backed up version of the file (same path and inode) has the same checksum,
+                 or the same size and mtime
+        """
+        entry = self.entries.get((info_dict['path'], info_dict['st_ino']))
+        if entry is None:
+            return False
+        st_size, st_mtime, sha1 = entry
+        if info_dict.get('sha1') is not None and sha1 is not None:
+            return info_dict['sha1'] == sha1
+        return st_size == info_dict['st_size'] and st_mtime == info_dict['st_mtime']
+
+
+# columns of `files` written by BackupDatabase.add_backed_up_file()
+file_columns = ['path', 'st_ino', 'sha1', 'is_dir'] + [f'st_{field}' for field in stat_fields]
+
+
+def member_targets(rows):
+    """
+    :param rows: located catalogue rows, see BackupDatabase.locate_files()
+    :return: dict mapping the names of the archive members holding the contents to the names to extract them as,
+             which differ for deduplicated files
+    """
+    targets = {}
+    for row in rows:
+        # tarfile stores the paths without the leading slash
+        targets.setdefault(row['content_path'].strip('/'), []).append(row['path'].strip('/'))
+    return targets
+
+
 class BackupDatabase:
-    def __init__(self, db_file):
-        self.connection = init_db(db_file)
+    def __init__(self, db_file, batch_size=1000, wal=True):
+        """
+        :param batch_size: number of buffered catalogue rows that are written and committed together,
+                           see add_backed_up_file()
+        :param wal: use the write-ahead log journal mode
+        """
+        self.connection = init_db(db_file, wal=wal)
+        self.batch_size = batch_size
+        self._backed_up_files = []
+        self._hash_cache_entries = []
 
     def insert(self, data, table, **kwargs):
         cursor = self.connection.cursor()
@@ -114,6 +205,76 @@ class BackupDatabase:
         cursor = self.connection.cursor()
         return select(data, table, cursor, **kwargs)
 
+    def load_hash_cache(self):
+        """
+        :return: dict mapping (st_dev, st_ino) to (st_size, st_mtime_ns, st_ctime_ns, sha1), see fileinfo.FileInfo
+        """
+        logger.info('Loading hash cache.')
+        cursor = self.connection.cursor()
+        # plain tuples are considerably faster than sqlite3.Row for many rows
+        cursor.row_factory = None
+        cursor.execute('SELECT st_dev, st_ino, st_size, st_mtime_ns, st_ctime_ns, sha1 FROM hash_cache')
+        hash_cache = {(row[0], row[1]): row[2:] for row in cursor}
+        logger.info(f'Loaded {len(hash_cache)} hash cache entries.')
+        return hash_cache
+
+    def update_hash_cache(self, entries):
+        """
+        :param entries: iterable of (st_dev, st_ino, st_size, st_mtime_ns, st_ctime_ns, sha1) tuples
+        """
+        self.connection.executemany('INSERT OR REPLACE INTO hash_cache '
+                                    '(st_dev, st_ino, st_size, st_mtime_ns, st_ctime_ns, sha1) VALUES (?, ?, ?, ?, ?, ?)',
+                                    entries)
+
+    def add_backed_up_file(self, info_dict, partial_backup_id, deduplicated=None):
+        """
+        Buffer a file that has been committed to tape, together with its `backed_up_files` row.
+        Buffered rows are written with one executemany per table and committed once batch_size rows are buffered,
+        or by commit(). Only files that are already on tape may be added, so a crash loses at most the latest
+        catalogue entries but never records a file that is not on tape.
+        The location of the file in the archive is taken from the 'tar_offset' and 'sector' keys of info_dict,
+        see save_to_archive().
+        :param deduplicated: (path, st_ino, sha1) of the file holding the content, if the file is deduplicated
+        """
+        row = tuple(info_dict.get(column) for column in file_columns)
+        location = (info_dict.get('tar_offset'), info_dict.get('sector'))
+        self._backed_up_files.append((row, partial_backup_id, deduplicated or (None, None, None), location))
+        if len(self._backed_up_files) >= self.batch_size:
+            self.commit()
+
+    def add_hash_cache_entry(self, entry):
+        """
+        Buffer a hash cache row, see update_hash_cache()
+        """
+        self._hash_cache_entries.append(entry)
+        if len(self._hash_cache_entries) >= self.batch_size:
+            self.commit()
+
+    def flush(self):
+        """
+        Write the buffered rows in the current transaction
+        """
+        if self._backed_up_files:
+            self.connection.executemany(f"INSERT OR IGNORE INTO files ({','.join(file_columns)}) "
+                                        f"VALUES ({','.join(['?'] * len(file_columns))})",
+                                        (row for row, _partial_backup_id, _deduplicated, _location
+                                         in self._backed_up_files))
+            # the ids are looked up by the unique columns, lastrowid is not available for executemany.
+            # UNIQUE does not hold for a NULL sha1 (directories, links), such files get a new row in every backup
+            # and the newest one is the row that has just been inserted.
+            file_id = 'SELECT id FROM files WHERE path=? AND st_ino=? AND sha1 IS ? ORDER BY id DESC LIMIT 1'
+            # a file that is added twice to the same partial backup keeps its latest location
+            self.connection.executemany('INSERT OR REPLACE INTO backed_up_files (file_id, partial_backup_id, '
+                                        'deduplication_file_id, tar_offset, sector) '
+                                        f'VALUES (({file_id}), ?, ({file_id}), ?, ?)',
+                                        ((row[0], row[1], row[2], partial_backup_id) + tuple(deduplicated) + location
+                                         for row, partial_backup_id, deduplicated, location in self._backed_up_files))
+            logger.debug(f'Wrote {len(self._backed_up_files)} backed up files to the catalogue.')
+            self._backed_up_files.clear()
+        if self._hash_cache_entries:
+            self.update_hash_cache(self._hash_cache_entries)
+            self._hash_cache_entries.clear()
+
     def create_backup(self, path, level='full'):
         data = {'path': path.as_posix(),
                 'level': level,
@@ -121,6 +282,105 @@ class BackupDatabase:
                 }
         return self.insert(data, 'backup').lastrowid
 
+    def complete_backup(self, backup_id):
+        self.connection.execute('UPDATE backup SET completed=1, timestamp_completed=? WHERE id=?',
+                                (int(datetime.timestamp(datetime.now())), backup_id))
+
+    def reference_backups(self, path, level):
+        """
+        :param level: 'incremental' or 'differential'
+        :return: ids of the backups of path an incremental or differential backup is based on,
+                 or None if there is no completed full backup of path
+        """
+        full = self.connection.execute("SELECT id FROM backup WHERE path=? AND level='full' AND completed=1 "
+                                       "ORDER BY id DESC LIMIT 1", (path.as_posix(),)).fetchone()
+        if full is None:
+            return None
+        if level == 'differential':
+            return [full['id']]
+        elif level == 'incremental':
+            # everything that has been written to tape since the full backup, even by incomplete backups
+            return [row['id'] for row in self.connection.execute('SELECT id FROM backup WHERE path=? AND id>=?',
+                                                                 (path.as_posix(), full['id']))]
+        raise ValueError(f'Unknown backup level "{level}"')
+
+    def load_file_index(self, backup_ids):
+        """
+        :return: FileIndex of all files backed up by the given backups
+        """
+        cursor = self.connection.cursor()
+        cursor.row_factory = None
+        cursor.execute(f"""SELECT files.path, files.st_ino, files.st_size, files.st_mtime, files.sha1 FROM files
+                           JOIN backed_up_files ON backed_up_files.file_id = files.id
+                           JOIN partial_backup ON backed_up_files.partial_backup_id = partial_backup.id
+                           WHERE partial_backup.parent_id IN ({','.join(['?'] * len(backup_ids))})
+                           ORDER BY partial_backup.id""",
+                       backup_ids)
+        file_index = FileIndex(cursor)
+        logger.info(f'Loaded {len(file_index)} files of backups {backup_ids} into the file index.')
+        return file_index
+
+    def load_dedup_index(self):
+        """
+        :return: dict mapping the checksums of files backed up on readable volumes to (path, st_ino) of their
+                 `files` row. Volumes that are not in the `volumes` table are assumed to be readable.
+        """
+        cursor = self.connection.cursor()
+        cursor.row_factory = None
+        cursor.execute("""SELECT files.sha1, files.path, files.st_ino FROM files
+                          JOIN backed_up_files ON backed_up_files.file_id = files.id
+                          JOIN partial_backup ON backed_up_files.partial_backup_id = partial_backup.id
+                          LEFT JOIN volumes ON partial_backup.volume = volumes.voltag
+                          WHERE files.sha1 IS NOT NULL AND backed_up_files.deduplication_file_id IS NULL
+                          AND coalesce(volumes.error, 0) = 0 AND coalesce(volumes.access, 1) = 1""")
+        dedup_index = {row[0]: row[1:] for row in cursor}
+        logger.info(f'Loaded {len(dedup_index)} checksums into the deduplication index.')
+        return dedup_index
+
+    def locate_files(self, paths):
+        """
+        Find the latest backed up copy of every path. Deduplicated files are located by the copy holding their content.
+        :return: list of sqlite3.Row with path, st_size, volume, tape_file_index, partial_backup_id, tar_offset,
+                 sector and content_path, in the order of paths. Paths that have never been backed up are missing.
+                 content_path is the path of the archive member holding the content, which differs from path for
+                 deduplicated files.
+        """
+        located = []
+        for path in paths:
+            row = self.connection.execute(
+                """SELECT files.path, files.st_size, partial_backup.volume, partial_backup.tape_file_index,
+                          partial_backup.id AS partial_backup_id, content.tar_offset, content.sector,
+                          content_files.path AS content_path
+                   FROM files
+                   JOIN backed_up_files ON backed_up_files.file_id = files.id
+                   JOIN backed_up_files AS content
+                        ON content.file_id = coalesce(backed_up_files.deduplication_file_id, files.id)
+                        AND content.deduplication_file_id IS NULL
+                   JOIN files AS content_files ON content_files.id = content.file_id
+                   JOIN partial_backup ON content.partial_backup_id = partial_backup.id
+                   WHERE files.path = ?
+                   ORDER BY backed_up_files.partial_backup_id DESC, content.partial_backup_id DESC LIMIT 1""",
+                (path,)).fetchone()
+            if row is None:
+                logger.warning(f'{path} has not been backed up.')
+            else:
+                located.append(row)
+        return located
+
+    def partial_backup_sizes(self, partial_backup_ids):
+        """
+        :return: dict mapping the partial backup ids to the total size of the files archived by them
+        """
+        cursor = self.connection.cursor()
+        cursor.row_factory = None
+        cursor.execute(f"""SELECT backed_up_files.partial_backup_id, sum(coalesce(files.st_size, 0)) FROM files
+                           JOIN backed_up_files ON backed_up_files.file_id = files.id
+                           WHERE backed_up_files.partial_backup_id IN ({','.join(['?'] * len(partial_backup_ids))})
+                           AND backed_up_files.deduplication_file_id IS NULL
+                           GROUP BY backed_up_files.partial_backup_id""",
+                       list(partial_backup_ids))
+        return dict(cursor)
+
     def create_partial_backup(self, parent_id, volume, **kwargs):
         kwargs.update({'parent_id': parent_id,
                        'volume': volume,
@@ -129,10 +389,109 @@ class BackupDatabase:
         return self.insert(kwargs, 'partial_backup').lastrowid
 
     def commit(self):
+        self.flush()
         self.connection.commit()
 
     def close(self):
+        self.commit()
         self.connection.close()
 
     def __del__(self):
-        self.connection.close()
+        try:
+            self.connection.close()
+        except sqlite3.ProgrammingError:
+            # collected on another thread than the one that created it, e.g. by a CatalogueWriter,
+            # the connection is closed when it is deallocated
+            pass
+
+
+class CatalogueWriter:
+    def __init__(self, db_file, batch_size=1000, wal=True, max_pending=None):
+        """
+        Owns a BackupDatabase on a dedicated thread, so that catalogue writes do not delay the archiving thread.
+        Buffered rows (add_backed_up_file(), add_hash_cache_entry()) are handed to the thread through a queue
+        without waiting, other BackupDatabase methods are run on the thread by call().
+        barrier() returns once everything handed over before has been committed.
+        An error of the writer thread is raised by the next method call, later operations are discarded.
+        :param batch_size: see BackupDatabase
+        :param max_pending: maximum number of queued operations, a call blocks while the queue is full.
+                            Defaults to 4 * batch_size.
+        """
+        self.error = None
+        self.closed = False
+        # items are (method name, args, kwargs, future or None) tuples and None to stop the thread
+        self._queue = queue.Queue(maxsize=max_pending or 4 * batch_size)
+        self._thread = threading.Thread(target=self._run, args=(db_file, batch_size, wal), name='CatalogueWriter',
+                                        daemon=True)
+        self._thread.start()
+
+    def _run(self, db_file, batch_size, wal):
+        db = None
+        try:
+            # sqlite connections can only be used by the thread that created them
+            db = BackupDatabase(db_file, batch_size=batch_size, wal=wal)
+        except BaseException as e:
+            self.error = e
+        for method, args, kwargs, future in iter(self._queue.get, None):
+            if self.error:
+                if future is not None:
+                    future.set_exception(self.error)
+                continue
+            try:
+                result = getattr(db, method)(*args, **kwargs)
+            except BaseException as e:
+                logger.error(f'CatalogueWriter stopped after {method} failed: {e}')
+                self.error = e
+                if future is not None:
+                    future.set_exception(e)
+            else:
+                if future is not None:
+                    future.set_result(result)
+        if db is not None:
+            if not self.error:
+                db.commit()
+            db.connection.close()
+
+    def _raise_error(self):
+        if self.error:
+            raise self.error
+
+    def submit(self, method, *args, **kwargs):
+        """
+        Run a BackupDatabase method on the writer thread without waiting for it
+        """
+        self._raise_error()
+        self._queue.put((method, args, kwargs, None))
+
+    def call(self, method, *args, **kwargs):
+        """
+        Run a BackupDatabase method on the writer thread
+        :return: its return value
+        """
+        self._raise_error()
+        future = Future()
+        self._queue.put((method, args, kwargs, future))
+        return future.result()
+
+    def add_backed_up_file(self, info_dict, partial_backup_id, deduplicated=None):
+        self.submit('add_backed_up_file', info_dict, partial_backup_id, deduplicated=deduplicated)
+
+    def add_hash_cache_entry(self, entry):
+        self.submit('add_hash_cache_entry', entry)
+
+    def barrier(self):
+        """
+        Block until everything handed to the writer thread has been written and committed.
+        """
+        self.call('commit')
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            if not self.error:
+                self.barrier()
+        finally:
+            self._queue.put(None)
+            self._thread.join()
@@ -10,6 +10,7 @@ class FakeFile:
         self.closed = False
         self.size = size
         self.written = 0
+        self.flushes = 0
         self.failure_mode = failure_mode
 
     def close(self):
@@ -27,9 +28,10 @@ class FakeFile:
                 return 0
         else:
             # normal write operation, returns length of written bytes
-            self.buffer.append(buffer)
+            # the caller may reuse its buffer, so keep a copy
+            self.buffer.append(bytes(buffer))
             self.written += len(buffer)
             return len(buffer)
 
     def flush(self):
-        pass
+        self.flushes += 1
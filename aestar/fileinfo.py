@@ -1,12 +1,22 @@
+import fnmatch
 import hashlib
+import logging
 import os
+import queue
+import re
 import stat
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
 from multiprocessing import Process
 from threading import Thread
 from pathlib import Path
 
 from . import database
 
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
 
 def checksum(file, hash=hashlib.sha1, chunksize=4096, hex=True):
     h = hash()
@@ -20,64 +30,375 @@ def checksum(file, hash=hashlib.sha1, chunksize=4096, hex=True):
 
 
 class FileInfo:
+    # keys of info_dict in the order they are pickled in, see __reduce__()
+    fields = ('path', 'is_dir', 'sha1', 'st_ino') + tuple(f'st_{field}' for field in database.stat_fields)
+    _field_set = frozenset(fields)
+    __slots__ = ('info_dict', 'prefetched', 'stat_key', 'hash_cached')
+
     def __init__(self, info_dict=None):
         if info_dict:
             self.info_dict = info_dict
         else:
             self.info_dict = {}
+        # file contents read ahead of time, see prefetch.Prefetcher
+        self.prefetched = None
+        # (st_dev, st_ino, st_size, st_mtime_ns, st_ctime_ns) of regular files, the key of the hash cache
+        self.stat_key = None
+        # whether the checksum has been taken from the hash cache
+        self.hash_cached = False
 
     def __repr__(self):
         return '<{} of "{}" at {:#x}>'.format(self.__class__.__name__, self.info_dict.get('path'), id(self))
 
+    def to_record(self):
+        """
+        :return: tuple of the info_dict values in the order of FileInfo.fields, followed by a dict of additional
+                 keys (or None), stat_key and hash_cached. Prefetched contents are not included.
+        """
+        info_dict = self.info_dict
+        values = tuple(map(info_dict.get, self.fields))
+        extra = None
+        if len(info_dict) != len(values) - values.count(None):
+            extra = {key: value for key, value in info_dict.items() if key not in self._field_set}
+        return values + (extra, self.stat_key, self.hash_cached)
+
+    @classmethod
+    def from_record(cls, record):
+        num_fields = len(cls.fields)
+        values = record[:num_fields]
+        if None in values:
+            # missing keys are stored as None
+            info_dict = {key: value for key, value in zip(cls.fields, values) if value is not None}
+        else:
+            info_dict = dict(zip(cls.fields, values))
+        extra, stat_key, hash_cached = record[num_fields:]
+        if extra:
+            info_dict.update(extra)
+        # bypasses __init__, this is called once for every file sent between processes
+        file_info = cls.__new__(cls)
+        file_info.info_dict = info_dict
+        file_info.prefetched = None
+        file_info.stat_key = stat_key
+        file_info.hash_cached = hash_cached
+        return file_info
+
+    @staticmethod
+    def encode(item):
+        """
+        Encoder for queues.BatchQueue, FileInfo objects are sent as plain tuples which are pickled
+        much faster and smaller than objects holding a dict with string keys. Other items are sent unchanged.
+        """
+        return item.to_record() if type(item) is FileInfo else item
+
+    @staticmethod
+    def decode(item):
+        return FileInfo.from_record(item) if type(item) is tuple else item
+
+    def __reduce__(self):
+        return _file_info_from_record, (self.__class__, self.to_record())
+
+    @property
+    def hash_cache_entry(self):
+        """
+        :return: row for the hash cache table or None if the file has no checksum
+        """
+        if self.stat_key is None or self.info_dict.get('sha1') is None:
+            return None
+        return self.stat_key + (self.info_dict['sha1'],)
+
     @classmethod
-    def from_file(cls, path):
-        # TODO: option to enable/disable checksum calculation
-        # this would be useful for quick check by mtime only
+    def from_file(cls, path, calculate_checksum=True, hash_cache=None, stat_result=None):
+        """
+        :param calculate_checksum: whether to read regular files to calculate their SHA-1.
+                                   Without, the 'sha1' key is missing and the checksum can e.g. be
+                                   calculated while archiving the file (see aestar.save_to_archive)
+        :param hash_cache: dict as returned by database.BackupDatabase.load_hash_cache(). The cached checksum
+                           is used if device, inode, size, mtime and ctime of the file are unchanged.
+        :param stat_result: result of os.stat(path) if it is already known, e.g. from os.DirEntry.stat()
+        """
         if not isinstance(path, str):
             path = path.as_posix()
-        stat_result = os.stat(path)
+        if stat_result is None:
+            stat_result = os.stat(path)
 
         info_dict = {f'st_{key}': int(getattr(stat_result, f'st_{key}')) for key in database.stat_fields + ['ino']}
         info_dict['path'] = path
-        if stat.S_ISREG(stat_result.st_mode):
-            info_dict['sha1'] = checksum(path, hex=False)
         info_dict['is_dir'] = int(stat.S_ISDIR(stat_result.st_mode))
-        return cls(info_dict)
+        file_info = cls(info_dict)
+        if stat.S_ISREG(stat_result.st_mode):
+            file_info.stat_key = (stat_result.st_dev, stat_result.st_ino, stat_result.st_size,
+                                  stat_result.st_mtime_ns, stat_result.st_ctime_ns)
+            cached = hash_cache.get(file_info.stat_key[:2]) if hash_cache else None
+            if cached is not None and tuple(cached[:3]) == file_info.stat_key[2:]:
+                info_dict['sha1'] = cached[3]
+                file_info.hash_cached = True
+            elif calculate_checksum:
+                info_dict['sha1'] = checksum(path, hex=False)
+        return file_info
+
+
+def _file_info_from_record(cls, record):
+    return cls.from_record(record)
+
+
+def compile_globs(patterns):
+    """
+    :return: compiled regular expression matching any of the glob patterns, or None if there are none
+    """
+    if not patterns:
+        return None
+    return re.compile('|'.join(f'(?:{fnmatch.translate(pattern)})' for pattern in patterns))
+
+
+class Walker:
+    def __init__(self, path, pattern='*', excludes=(), one_file_system=False):
+        """
+        Recursive directory walk with os.scandir that yields (path, stat_result) for every entry below path,
+        directory by directory in the same order as Path.rglob().
+        Excluded directories and directories on other file systems are pruned before descending into them.
+        The stat_result is that of os.DirEntry.stat(), or None if it could not be determined.
+        Symbolic links to directories are not followed.
+        :param pattern: glob pattern the names of the yielded entries have to match, directories are walked regardless
+        :param excludes: glob patterns of entries to skip, including everything below excluded directories.
+                         Patterns without a slash are matched against the name of the entry, patterns with a slash
+                         against its path relative to path.
+        :param one_file_system: do not descend into directories on other file systems than path.
+                                The mount points themselves are still yielded.
+        """
+        self.path = os.fspath(path)
+        self.one_file_system = one_file_system
+        # all patterns are compiled once instead of being matched with fnmatch for every entry
+        self.pattern = None if pattern == '*' else compile_globs([pattern])
+        self.exclude_names = compile_globs([exclude for exclude in excludes if '/' not in exclude])
+        self.exclude_paths = compile_globs([exclude.strip('/') for exclude in excludes if '/' in exclude])
+
+    def excluded(self, name, relative_path):
+        return bool((self.exclude_names and self.exclude_names.match(name)) or
+                    (self.exclude_paths and self.exclude_paths.match(relative_path)))
+
+    def list_directory(self, directory, relative_directory, root_dev):
+        """
+        :param relative_directory: path of directory relative to the root, ending with a slash (or empty for the root)
+        :param root_dev: device of the root, for one_file_system
+        :return: list of the (path, stat_result) tuples to yield and list of the (path, relative path)
+                 tuples of the subdirectories to descend into, both in directory order
+        """
+        try:
+            with os.scandir(directory) as entries:
+                entries = list(entries)
+        except OSError as e:
+            logger.warning(f'Could not list directory {directory}: {e}')
+            return [], []
+        items = []
+        subdirectories = []
+        for entry in entries:
+            relative_path = f'{relative_directory}{entry.name}'
+            if self.excluded(entry.name, relative_path):
+                logger.debug(f'Excluding {entry.path}')
+                continue
+            try:
+                stat_result = entry.stat()
+            except OSError:
+                # e.g. a broken symbolic link, the error is raised again when the entry is processed
+                stat_result = None
+            if entry.is_dir(follow_symlinks=False) and \
+                    not (self.one_file_system and stat_result is not None and stat_result.st_dev != root_dev):
+                subdirectories.append((entry.path, f'{relative_path}/'))
+            if self.pattern is None or self.pattern.match(entry.name):
+                items.append((entry.path, stat_result))
+        return items, subdirectories
+
+    def __iter__(self):
+        root_dev = os.stat(self.path).st_dev
+        # stack of (path, path relative to the root) of the directories that still have to be listed
+        stack = [(self.path, '')]
+        while stack:
+            items, subdirectories = self.list_directory(*stack.pop(), root_dev)
+            yield from items
+            stack.extend(reversed(subdirectories))
+
+
+class ParallelWalker(Walker):
+    def __init__(self, path, workers=4, **kwargs):
+        """
+        Walker that lists directories on several threads, for file systems where the latency of metadata
+        operations limits the walk (e.g. NFS). scandir() and stat() release the GIL.
+        Every thread takes directories from the end of its own deque and pushes the subdirectories it finds there,
+        so it walks its subtree depth first. An idle thread steals the oldest directory of the longest other deque,
+        which is the root of the largest unvisited subtree.
+        The same entries as with Walker are yielded, but in no particular order.
+        :param workers: number of walker threads
+        :param kwargs: see Walker
+        """
+        super().__init__(path, **kwargs)
+        if workers < 1:
+            raise ValueError(f'Number of workers has to be at least 1, not {workers}')
+        self.workers = workers
+
+    def __iter__(self):
+        root_dev = os.stat(self.path).st_dev
+        deques = [deque() for _i in range(self.workers)]
+        deques[0].append((self.path, ''))
+        # number of directories that have been found but not yet listed, guarded by condition
+        state = {'outstanding': 1, 'stopped': False}
+        condition = threading.Condition()
+        # listed directories, bounded so that the walk does not run far ahead of the consumer
+        results = queue.Queue(maxsize=4 * self.workers)
+
+        def next_directory(own):
+            with condition:
+                while True:
+                    if state['stopped']:
+                        return None
+                    if own:
+                        return own.pop()
+                    victim = max(deques, key=len)
+                    if victim:
+                        return victim.popleft()
+                    if not state['outstanding']:
+                        return None
+                    condition.wait()
+
+        def work(own):
+            try:
+                for directory in iter(lambda: next_directory(own), None):
+                    subdirectories = []
+                    try:
+                        items, subdirectories = self.list_directory(*directory, root_dev)
+                        results.put(items)
+                    finally:
+                        with condition:
+                            own.extend(reversed(subdirectories))
+                            state['outstanding'] += len(subdirectories) - 1
+                            condition.notify_all()
+            except BaseException as e:
+                results.put(e)
+                with condition:
+                    state['stopped'] = True
+                    condition.notify_all()
+            finally:
+                results.put(None)
+
+        threads = [threading.Thread(target=work, args=(own,), name=f'ParallelWalker-{i}', daemon=True)
+                   for i, own in enumerate(deques)]
+        for thread in threads:
+            thread.start()
+        running = len(threads)
+        try:
+            while running:
+                items = results.get()
+                if items is None:
+                    running -= 1
+                elif isinstance(items, BaseException):
+                    raise items
+                else:
+                    yield from items
+        finally:
+            # stop the threads if the walk is not exhausted and unblock threads waiting for space in results
+            with condition:
+                state['stopped'] = True
+                condition.notify_all()
+            while running:
+                if results.get() is None:
+                    running -= 1
 
 
 class FileProcessor(Process):
-    def __init__(self, queue, path, pattern='*'):
+    def __init__(self, queue, path, pattern='*', calculate_checksum=True, hash_workers=1, hash_cache=None,
+                 excludes=(), one_file_system=False, walk_workers=1):
+        """
+        Process that walks path and puts a FileInfo for every entry into queue, followed by a single None sentinel.
+        Exceptions are put into the queue instead of the FileInfo, with the path in their filepath attribute.
+        :param pattern: see Walker
+        :param excludes: see Walker
+        :param one_file_system: see Walker
+        :param hash_workers: number of threads that stat and hash the walked files. With more than one,
+                             the FileInfo objects are put into the queue out of order.
+        :param hash_cache: preloaded hash cache, see FileInfo.from_file()
+        :param walk_workers: number of threads listing directories, see ParallelWalker.
+                             With more than one, the FileInfo objects are put into the queue out of order.
+        """
         super().__init__()
         self.name = f'FileProcessor for {path}'
         self.queue = queue
         self.path = Path(path)
         self.pattern = pattern
+        self.calculate_checksum = calculate_checksum
+        self.hash_workers = hash_workers
+        self.hash_cache = hash_cache
+        if walk_workers > 1:
+            self.walker = ParallelWalker(self.path, workers=walk_workers, pattern=pattern, excludes=excludes,
+                                         one_file_system=one_file_system)
+        else:
+            self.walker = Walker(self.path, pattern=pattern, excludes=excludes, one_file_system=one_file_system)
         self.daemon = True
 
+    def process(self, item, stat_result=None):
+        try:
+            return FileInfo.from_file(item, calculate_checksum=self.calculate_checksum, hash_cache=self.hash_cache,
+                                      stat_result=stat_result)
+        except Exception as e:
+            e.filepath = item
+            return e
+
     def run(self):
-        for item in self.path.rglob(self.pattern):
-            try:
-                self.queue.put(FileInfo.from_file(item))
-            except Exception as e:
-                e.filepath = item
-                self.queue.put(e)
+        if self.hash_workers > 1:
+            # the process is daemonic and can not have child processes, hashlib and file reads release the GIL
+            with ThreadPoolExecutor(max_workers=self.hash_workers, thread_name_prefix='FileProcessor') as executor:
+                in_flight = set()
+                for item, stat_result in self.walker:
+                    in_flight.add(executor.submit(self.process, item, stat_result))
+                    # limit the number of walked paths that wait for a worker
+                    if len(in_flight) >= 4 * self.hash_workers:
+                        done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                        for future in done:
+                            self.queue.put(future.result())
+                for future in in_flight:
+                    self.queue.put(future.result())
+        else:
+            for item, stat_result in self.walker:
+                self.queue.put(self.process(item, stat_result))
         # Sentinel value
         self.queue.put(None)
 
 
+class HashCacheEntry:
+    __slots__ = ('entry',)
+
+    def __init__(self, entry):
+        """
+        Side record for a file that is not archived, e.g. skipped by an incremental backup, but has been hashed.
+        It is passed on instead of the file so that its checksum is cached nevertheless, see FileInfo.hash_cache_entry.
+        It is never added to an archive.
+        """
+        self.entry = entry
+
+    def __repr__(self):
+        return f'<{self.__class__.__name__} {self.entry[:2]}>'
+
+
 class FileFilter(Process):
-    def __init__(self, queue_in, queue_out, callback=lambda x: False):
+    def __init__(self, queue_in, queue_out, callback=lambda x: False, cache_hashes=False):
+        """
+        :param callback: function of an item returning whether to pass it on
+        :param cache_hashes: pass a HashCacheEntry on for a dropped file whose checksum has been calculated,
+                             otherwise a file whose metadata changed is hashed again in every backup
+        """
         super().__init__()
         self.name = f'FileFilter'
         self.queue_in = queue_in
         self.queue_out = queue_out
         self.callback = callback
+        self.cache_hashes = cache_hashes
         self.daemon = True
 
     def run(self):
         for item in iter(self.queue_in.get, None):
             if self.callback(item):
                 self.queue_out.put(item)
+            elif self.cache_hashes and isinstance(item, FileInfo) and not item.hash_cached \
+                    and item.hash_cache_entry:
+                self.queue_out.put(HashCacheEntry(item.hash_cache_entry))
 
         # put back the stolen sentinel value before exiting
         self.queue_out.put(None)
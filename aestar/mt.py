@@ -0,0 +1,69 @@
+import re
+import subprocess
+import logging
+
+MT_CMD = 'mt'
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+
+def mt_options(device=None):
+    options = [MT_CMD]
+    if device:
+        options += ['-f', device]
+    return options
+
+
+def run(operation, count=None, device=None):
+    logger.debug(f'Running mt {operation} {count if count is not None else ""} on device {device}')
+    result = subprocess.run(mt_options(device) + [operation] + ([str(count)] if count is not None else []),
+                            capture_output=True)
+    logger.debug(f'mt {operation} exited with code {result.returncode}: {result.stderr}')
+    result.check_returncode()
+    return result.stdout.decode('utf-8')
+
+
+def rewind(device=None):
+    run('rewind', device=device)
+
+
+def forward_files(count, device=None):
+    """
+    Space forward count file marks, the tape is positioned at the start of the next tape file
+    """
+    if count:
+        run('fsf', count, device=device)
+
+
+def forward_records(count, device=None):
+    """
+    Space forward count records (tape blocks) within the current tape file
+    """
+    if count:
+        run('fsr', count, device=device)
+
+
+def parse_tell(output):
+    """
+    :param output: output of `mt tell`, e.g. "At block 1234."
+    :return: block number
+    """
+    match = re.search(r'At block (\d+)', output)
+    if not match:
+        raise ValueError(f'"{output}" is not a valid mt tell output.')
+    return int(match.group(1))
+
+
+def tell(device=None):
+    """
+    :return: current logical block number of the drive
+    """
+    return parse_tell(run('tell', device=device))
+
+
+def seek(block, device=None):
+    """
+    Locate the logical block number, drives with block addressing (e.g. LTO) do this at high speed
+    """
+    run('seek', block, device=device)
@@ -0,0 +1,113 @@
+import array
+import errno
+import fcntl
+import logging
+import os
+import stat
+import struct
+from queue import Empty
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+# from linux/fiemap.h and linux/fs.h
+FS_IOC_FIEMAP = 0xC020660B
+_FIEMAP_HEADER = struct.Struct('=QQLLLL')  # fm_start, fm_length, fm_flags, fm_mapped_extents, fm_extent_count
+_FIEMAP_EXTENT = struct.Struct('=QQQQQLLLL')  # fe_logical, fe_physical, fe_length, 2 reserved, fe_flags, 3 reserved
+
+
+def first_physical_offset(path):
+    """
+    :return: physical byte offset of the first extent of the file on its device according to FIEMAP,
+             or None if the file has no extents
+    :raises OSError: if the file can not be opened or the file system does not support FIEMAP
+    """
+    buffer = array.array('B', _FIEMAP_HEADER.pack(0, 0xFFFFFFFFFFFFFFFF, 0, 0, 1, 0) + bytes(_FIEMAP_EXTENT.size))
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        fcntl.ioctl(fd, FS_IOC_FIEMAP, buffer)
+    finally:
+        os.close(fd)
+    mapped_extents = _FIEMAP_HEADER.unpack_from(buffer)[3]
+    if not mapped_extents:
+        return None
+    return _FIEMAP_EXTENT.unpack_from(buffer, _FIEMAP_HEADER.size)[1]
+
+
+class ReorderingQueue:
+    def __init__(self, queue, window=1024, key='inode'):
+        """
+        Queue adapter that reads windows of up to `window` items from queue and hands them out sorted by their
+        location on disk, so that reading the files causes less seeking on rotating disks.
+        Items that are not regular files (directories, exceptions) keep their relative order and are handed
+        out before the files of their window.
+        :param queue: queue of FileInfo items with a None sentinel, only get() and qsize() are used
+        :param window: number of items sorted at once, larger windows sort better but delay the first item
+        :param key: 'inode' to sort by inode number, which most file systems allocate close to the data,
+                    or 'extent' to sort by the physical offset of the first extent (FIEMAP, Linux only).
+                    Files that FIEMAP does not work for are sorted by inode after all other files.
+        """
+        if key not in ('inode', 'extent'):
+            raise ValueError(f'Unknown sort key "{key}"')
+        self.queue = queue
+        self.window = window
+        self.key = key
+        # sorted items of the current window, in reverse order
+        self.sorted = []
+        self.finished = False
+        # FIEMAP is not tried again once the file system has rejected it
+        self._fiemap = key == 'extent'
+
+    def _sort_key(self, item):
+        try:
+            info_dict = item.info_dict
+            regular = stat.S_ISREG(info_dict['st_mode'])
+        except (AttributeError, KeyError):
+            regular = False
+        if not regular:
+            return 0, 0
+        if self._fiemap:
+            try:
+                offset = first_physical_offset(info_dict['path'])
+                if offset is not None:
+                    return 1, offset
+            except OSError as e:
+                if e.errno in (errno.ENOTTY, errno.EOPNOTSUPP):
+                    logger.info(f'FIEMAP is not supported for {info_dict["path"]}, sorting by inode: {e}')
+                    self._fiemap = False
+        return 2, info_dict['st_ino']
+
+    def _fill(self):
+        items = []
+        while len(items) < self.window:
+            item = self.queue.get()
+            if item is None:
+                self.finished = True
+                break
+            items.append(item)
+        # sorted() is stable, items with equal keys stay in queue order. The list is reversed to pop from its end.
+        self.sorted = sorted(items, key=self._sort_key)
+        self.sorted.reverse()
+
+    def get(self):
+        if not self.sorted:
+            if self.finished:
+                return None
+            self._fill()
+            if not self.sorted:
+                return None
+        return self.sorted.pop()
+
+    def get_nowait(self):
+        if self.sorted:
+            return self.sorted.pop()
+        if self.finished:
+            return None
+        # filling the next window would block
+        raise Empty
+
+    def qsize(self):
+        return self.queue.qsize() + len(self.sorted)
+
+    def __len__(self):
+        return self.qsize()
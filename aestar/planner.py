@@ -0,0 +1,208 @@
+import logging
+from datetime import timedelta
+
+from . import mt
+from .aestar import AESTarFile, extract_at
+from .database import member_targets
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+# approximate size of a member in the tar stream without its contents: its header and a PAX extended header
+MEMBER_HEADER_SIZE = 1536
+
+
+def archived_size(st_size):
+    """
+    :return: approximate number of bytes a file of st_size bytes takes in the uncompressed tar stream
+    """
+    return MEMBER_HEADER_SIZE + -(-(st_size or 0) // 512) * 512
+
+
+class Run:
+    def __init__(self, tape_file_index, start, files, num_bytes):
+        """
+        Files of a single tape file that are restored in one forward pass.
+        :param start: tar offset the pass starts at, None if the tape file has to be read from its beginning
+                      because the offsets of its files are unknown (compressed archives)
+        :param files: located catalogue rows, see database.BackupDatabase.locate_files(), in archive order
+        :param num_bytes: estimated number of bytes read
+        """
+        self.tape_file_index = tape_file_index
+        self.start = start
+        self.files = files
+        self.num_bytes = num_bytes
+
+    @property
+    def names(self):
+        """
+        Names of the archive members holding the contents of the files
+        """
+        return list(self.targets)
+
+    @property
+    def targets(self):
+        return member_targets(self.files)
+
+
+class VolumePass:
+    def __init__(self, volume, runs):
+        """
+        A single linear pass over a volume: the runs are in tape order, tape files by index and runs by offset.
+        """
+        self.volume = volume
+        self.runs = runs
+
+    @property
+    def num_files(self):
+        return sum(len(run.files) for run in self.runs)
+
+    @property
+    def num_bytes(self):
+        return sum(run.num_bytes for run in self.runs)
+
+
+class RestorePlan:
+    def __init__(self, located, tape_file_sizes=None, load_seconds=180, locate_seconds=30, read_rate=300000000):
+        """
+        Order the restore of many files so that every volume is loaded once and read in a single forward pass.
+        The files of a tape file are split into runs: a gap between two files is read through if that is faster
+        than locating the next file, otherwise a new run starts with a locate.
+        :param located: catalogue rows of the files to restore, see database.BackupDatabase.locate_files()
+        :param tape_file_sizes: dict mapping partial backup ids to the size of their archive, used to estimate
+                                reading tape files without offsets, see database.BackupDatabase.partial_backup_sizes()
+        :param load_seconds: time to unload the previous volume and load the next one with the changer
+        :param locate_seconds: time to locate a position within a volume
+        :param read_rate: bytes per second read from tape
+        """
+        self.load_seconds = load_seconds
+        self.locate_seconds = locate_seconds
+        self.read_rate = read_rate
+        tape_file_sizes = tape_file_sizes or {}
+        # reading through a shorter gap is faster than locating the next file
+        self.max_gap = locate_seconds * read_rate
+        # volumes in the order they have been written, tape files in the order they are on the volume
+        volumes = {}
+        for row in sorted(located, key=lambda row: row['partial_backup_id']):
+            tape_file = (row['tape_file_index'] or 0, row['partial_backup_id'])
+            volumes.setdefault(row['volume'], {}).setdefault(tape_file, []).append(row)
+        self.passes = []
+        for volume, tape_files in volumes.items():
+            runs = []
+            for (tape_file_index, partial_backup_id), rows in sorted(tape_files.items()):
+                # files of compressed archives have no sector and can not be located
+                if any(row['sector'] is None for row in rows):
+                    num_bytes = tape_file_sizes.get(partial_backup_id)
+                    if num_bytes is None:
+                        num_bytes = sum(archived_size(row['st_size']) for row in rows)
+                    runs.append(Run(tape_file_index, None, rows, num_bytes))
+                    continue
+                runs.extend(self._runs(tape_file_index, sorted(rows, key=lambda row: row['tar_offset'])))
+            self.passes.append(VolumePass(volume, runs))
+
+    def _runs(self, tape_file_index, rows):
+        runs = []
+        end = None
+        for row in rows:
+            if end is None or row['tar_offset'] - end > self.max_gap:
+                runs.append(Run(tape_file_index, row['tar_offset'], [], 0))
+            run = runs[-1]
+            run.files.append(row)
+            end = row['tar_offset'] + archived_size(row['st_size'])
+            run.num_bytes = end - run.start
+        return runs
+
+    @property
+    def num_files(self):
+        return sum(volume_pass.num_files for volume_pass in self.passes)
+
+    @property
+    def num_runs(self):
+        return sum(len(volume_pass.runs) for volume_pass in self.passes)
+
+    def pass_seconds(self, volume_pass):
+        """
+        :return: estimated seconds for loading the volume, locating the runs and reading them
+        """
+        return self.load_seconds + len(volume_pass.runs) * self.locate_seconds + volume_pass.num_bytes / self.read_rate
+
+    def estimate(self):
+        """
+        :return: dict with the number of loads, locates and bytes read and the estimated seconds for each of them
+        """
+        num_bytes = sum(volume_pass.num_bytes for volume_pass in self.passes)
+        estimate = {'loads': len(self.passes),
+                    'locates': self.num_runs,
+                    'bytes': num_bytes,
+                    'load_seconds': len(self.passes) * self.load_seconds,
+                    'locate_seconds': self.num_runs * self.locate_seconds,
+                    'read_seconds': num_bytes / self.read_rate}
+        estimate['seconds'] = estimate['load_seconds'] + estimate['locate_seconds'] + estimate['read_seconds']
+        return estimate
+
+    def report(self):
+        """
+        :return: human readable summary of the plan and its estimated duration
+        """
+        lines = []
+        for volume_pass in self.passes:
+            lines.append(f'Volume {volume_pass.volume}: {volume_pass.num_files} files in {len(volume_pass.runs)} '
+                         f'runs, {volume_pass.num_bytes} bytes, '
+                         f'{timedelta(seconds=round(self.pass_seconds(volume_pass)))}')
+        estimate = self.estimate()
+        lines.append(f'Total: {self.num_files} files, {estimate["loads"]} loads '
+                     f'({timedelta(seconds=round(estimate["load_seconds"]))}), {estimate["locates"]} locates '
+                     f'({timedelta(seconds=round(estimate["locate_seconds"]))}), {estimate["bytes"]} bytes read '
+                     f'({timedelta(seconds=round(estimate["read_seconds"]))}), '
+                     f'estimated {timedelta(seconds=round(estimate["seconds"]))}')
+        return '\n'.join(lines)
+
+    def execute(self, passphrase, device, load, path='.', record_size=None, bufsize=1048576, workers=1,
+                open_device=None):
+        """
+        Restore the files pass by pass.
+        :param device: non-rewinding tape device (/dev/nst*), a rewinding one loses the position after every `mt`
+        :param load: function of a volume name that loads the volume into the drive, e.g. using chio.load()
+        :param record_size: fixed block size of the drive, required to locate files by their offset
+        :param open_device: function returning a file object reading from the device at its current position,
+                            defaults to opening it unbuffered, so that every read is a multiple of the record size
+        :return: list of the extracted members
+        """
+        if open_device is None:
+            def open_device():
+                return open(device, 'rb', buffering=0)
+        if record_size:
+            bufsize = max(bufsize - bufsize % record_size, record_size)
+        extracted = []
+        for volume_pass in self.passes:
+            logger.info(f'Loading volume {volume_pass.volume}')
+            load(volume_pass.volume)
+            mt.rewind(device=device)
+            # block numbers of the start of the current tape file, starting at the beginning of tape
+            tape_file_index, tape_file_block = 0, 0
+            for run in volume_pass.runs:
+                # the position after reading is unknown, tape files are found from the start of the previous one
+                mt.seek(tape_file_block, device=device)
+                if run.tape_file_index != tape_file_index:
+                    mt.forward_files(run.tape_file_index - tape_file_index, device=device)
+                    tape_file_index, tape_file_block = run.tape_file_index, mt.tell(device=device)
+                logger.info(f'Restoring {len(run.files)} files from tape file {run.tape_file_index} '
+                            f'of volume {volume_pass.volume}')
+                targets = run.targets
+                if run.start is None or not record_size:
+                    with AESTarFile(passphrase, fileobj=open_device(), mode='rb', bufsize=bufsize, workers=workers,
+                                    seekable=False) as archive:
+                        restored = archive.extract(path, select=lambda member: member.name in targets,
+                                                   targets=targets)
+                else:
+                    # spaces forward from the start of the tape file and never seeks the device
+                    restored = extract_at(passphrase, device, run.start, path=path, names=list(targets),
+                                          record_size=record_size, bufsize=bufsize, workers=workers,
+                                          fileobj=open_device(), targets=targets)
+                missing = {name for names in targets.values() for name in names} - \
+                    {member.name for member in restored}
+                if missing:
+                    logger.warning(f'{len(missing)} files have not been found in tape file {run.tape_file_index} '
+                                   f'of volume {volume_pass.volume}: {", ".join(sorted(missing))}')
+                extracted += restored
+        return extracted
@@ -0,0 +1,110 @@
+import os
+import stat
+import logging
+from collections import deque
+from queue import Empty
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+
+def read_file(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def advise_willneed(path):
+    """
+    Ask the kernel to read the file into the page cache asynchronously.
+    """
+    if not hasattr(os, 'posix_fadvise'):
+        return
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+    finally:
+        os.close(fd)
+
+
+class Prefetcher:
+    def __init__(self, queue, num_files=64, max_bytes=67108864, max_file_size=8388608, workers=4):
+        """
+        Queue adapter that reads the contents of the next num_files regular files from queue in background threads,
+        so the data is already in memory when the file is archived.
+        Files larger than max_file_size, or that do not fit into the memory budget, are not read but only
+        announced to the kernel with posix_fadvise(POSIX_FADV_WILLNEED).
+        The data of a prefetched file is stored in the `prefetched` attribute of the item returned by get().
+        :param queue: queue of FileInfo items with a None sentinel, only get() and qsize() are used
+        :param num_files: number of items to look ahead
+        :param max_bytes: memory budget for file contents that have been read but not yet handed out by get()
+        :param max_file_size: largest file to read into memory
+        :param workers: number of reader threads
+        """
+        self.queue = queue
+        self.num_files = num_files
+        self.max_bytes = max_bytes
+        self.max_file_size = max_file_size
+        # (item, future, reserved bytes) tuples in queue order
+        self.window = deque()
+        self.reserved_bytes = 0
+        self.finished = False
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='Prefetcher')
+
+    def _submit(self, item):
+        try:
+            path = item.info_dict['path']
+            regular = stat.S_ISREG(item.info_dict['st_mode'])
+            size = item.info_dict['st_size']
+        except (AttributeError, KeyError):
+            # exceptions and incomplete items are passed on untouched
+            return None, 0
+        if not regular or not size:
+            return None, 0
+        if size <= self.max_file_size and self.reserved_bytes + size <= self.max_bytes:
+            self.reserved_bytes += size
+            return self._executor.submit(read_file, path), size
+        return self._executor.submit(advise_willneed, path), 0
+
+    def _fill(self, block):
+        while not self.finished and len(self.window) < self.num_files:
+            if block and not self.window:
+                item = self.queue.get()
+            else:
+                try:
+                    item = self.queue.get_nowait()
+                except Empty:
+                    return
+            if item is None:
+                self.finished = True
+                self.window.append((None, None, 0))
+            else:
+                self.window.append((item,) + self._submit(item))
+
+    def get(self):
+        if self.finished and not self.window:
+            # the sentinel has already been handed out
+            return self.queue.get()
+        self._fill(block=True)
+        item, future, reserved = self.window.popleft()
+        if future is not None:
+            try:
+                data = future.result()
+            except OSError as e:
+                # the file is read again (and the error raised) when it is archived
+                logger.debug(f'Could not prefetch {item}: {e}')
+                data = None
+            if reserved:
+                self.reserved_bytes -= reserved
+                item.prefetched = data
+        self._fill(block=False)
+        return item
+
+    def qsize(self):
+        return self.queue.qsize() + len(self.window)
+
+    def __len__(self):
+        return self.qsize()
+
+    def close(self):
+        self._executor.shutdown(wait=False)
@@ -0,0 +1,151 @@
+import os
+import pickle
+import threading
+import time
+from collections import deque
+from multiprocessing import Condition, Queue, Value
+
+
+class BatchQueue:
+    def __init__(self, batch_size=256, max_delay=0.1, max_items=0, max_bytes=0, encode=None, decode=None):
+        """
+        multiprocessing.Queue that transfers items in batches, so that pickling and the queue lock
+        are paid once per batch instead of once per item.
+        Every process buffers the items it puts until batch_size items are buffered, max_delay seconds have passed
+        since the last batch was sent, flush() is called or None (the sentinel used by the pipeline) is put.
+        The delay is also enforced by a thread of the putting process, so that buffered items are sent while the
+        process is busy (e.g. hashing a large file) or has nothing to put.
+        Items are received in the order they were put by each process.
+        The items and bytes that have been sent but not yet received are limited by max_items and max_bytes,
+        sending a batch blocks until the receiver has caught up. A batch is always sent into an empty queue,
+        even if it exceeds the limits on its own.
+        :param batch_size: maximum number of items per message
+        :param max_delay: maximum number of seconds an item is buffered (approximately, up to twice as long)
+        :param max_items: maximum number of items in transit, 0 for no limit
+        :param max_bytes: maximum size of the pickled batches in transit, 0 for no limit
+        :param encode: function converting an item into a form that is cheaper to pickle, applied by put()
+        :param decode: inverse of encode, applied by get() to one item at a time
+        """
+        self.batch_size = batch_size
+        self.max_delay = max_delay
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.encode = encode
+        self.decode = decode
+        self.queue = Queue()
+        # shared between all processes using the queue:
+        # items and bytes sent but not yet received, guarded by _lock
+        self._items_in_transit = Value('q', 0, lock=False)
+        self._bytes_in_transit = Value('q', 0, lock=False)
+        self._lock = Condition()
+        # both buffers are local to the process using them
+        self._outgoing = []
+        self._incoming = deque()
+        self._last_sent = time.monotonic()
+        # the thread flushing after max_delay, started by the first put() of every process
+        self._flusher_pid = None
+        self._flusher_stop = None
+        self._outgoing_lock = None
+
+    def __getstate__(self):
+        # buffered items and the flusher thread stay in the process that buffered them
+        state = self.__dict__.copy()
+        state['_outgoing'] = []
+        state['_incoming'] = deque()
+        state['_flusher_pid'] = None
+        state['_flusher_stop'] = None
+        state['_outgoing_lock'] = None
+        return state
+
+    def _start_flusher(self):
+        # a forked process inherits the attributes, but neither the thread nor the state of the lock
+        self._flusher_pid = os.getpid()
+        self._outgoing_lock = threading.RLock()
+        self._flusher_stop = threading.Event()
+        if self.max_delay and self.batch_size > 1:
+            threading.Thread(target=self._flush_delayed, args=(self._flusher_stop,), name='BatchQueueFlusher',
+                             daemon=True).start()
+
+    def _buffer_lock(self):
+        """
+        :return: lock of the outgoing buffer of this process, which is shared with the flusher thread
+        """
+        if self._flusher_pid != os.getpid():
+            self._start_flusher()
+        return self._outgoing_lock
+
+    def _flush_delayed(self, stop):
+        while not stop.wait(self.max_delay):
+            with self._outgoing_lock:
+                if self._outgoing and time.monotonic() - self._last_sent >= self.max_delay:
+                    self._flush()
+
+    def put(self, item):
+        with self._buffer_lock():
+            self._outgoing.append(item if self.encode is None or item is None else self.encode(item))
+            if item is None or len(self._outgoing) >= self.batch_size \
+                    or time.monotonic() - self._last_sent >= self.max_delay:
+                self._flush()
+        if item is None:
+            # nothing is put after the sentinel
+            self._flusher_stop.set()
+
+    def put_many(self, items):
+        for item in items:
+            self.put(item)
+
+    def _over_budget(self, num_items, num_bytes):
+        if not self._items_in_transit.value:
+            return False
+        return (self.max_items and self._items_in_transit.value + num_items > self.max_items) or \
+            (self.max_bytes and self._bytes_in_transit.value + num_bytes > self.max_bytes)
+
+    def flush(self):
+        with self._buffer_lock():
+            self._flush()
+
+    def _flush(self):
+        if self._outgoing:
+            payload = pickle.dumps(self._outgoing, protocol=pickle.HIGHEST_PROTOCOL)
+            # sentinels are not counted
+            num_items = len(self._outgoing) - self._outgoing.count(None)
+            with self._lock:
+                # backpressure, blocks the sender while the receiver is behind
+                self._lock.wait_for(lambda: not self._over_budget(num_items, len(payload)))
+                self._items_in_transit.value += num_items
+                self._bytes_in_transit.value += len(payload)
+            self.queue.put(payload)
+            self._outgoing = []
+        self._last_sent = time.monotonic()
+
+    def get(self, block=True, timeout=None):
+        if not self._incoming:
+            payload = self.queue.get(block, timeout)
+            batch = pickle.loads(payload)
+            with self._lock:
+                self._items_in_transit.value -= len(batch) - batch.count(None)
+                self._bytes_in_transit.value -= len(payload)
+                self._lock.notify_all()
+            self._incoming.extend(batch)
+        item = self._incoming.popleft()
+        return item if self.decode is None or item is None else self.decode(item)
+
+    def get_nowait(self):
+        return self.get(block=False)
+
+    def qsize(self):
+        """
+        :return: number of items sent to this process but not yet returned by get(), excluding sentinels.
+                 Items that are still buffered by a sender are not included.
+        """
+        return self._items_in_transit.value + len(self._incoming) - self._incoming.count(None)
+
+    def in_transit(self):
+        """
+        :return: (items, bytes) that have been sent but not yet received
+        """
+        with self._lock:
+            return self._items_in_transit.value, self._bytes_in_transit.value
+
+    def close(self):
+        self.queue.close()
@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+"""
+Compare the source read throughput of the scan order with the orders of aestar.ordering.ReorderingQueue.
+
+The files are created in shuffled name order and written in interleaved chunks, so their names, inodes and
+extents are scattered like in an aged file system. Before every run the page cache is dropped, which needs root
+(without it the files are only evicted with posix_fadvise(POSIX_FADV_DONTNEED)).
+
+Run it on an existing ext4/xfs mount:
+    python benchmarks/read_order.py --directory /mnt/hdd/bench
+or let it create and loop mount a file system image (needs root and mkfs):
+    python benchmarks/read_order.py --image /var/tmp/bench.img --fs ext4
+Results on an SSD or a loop device backed by the page cache do not show the seek savings of a rotating disk.
+"""
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import click
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from aestar.fileinfo import FileInfo, Walker  # noqa: E402
+from aestar.ordering import ReorderingQueue  # noqa: E402
+
+
+class ListQueue:
+    def __init__(self, items):
+        self.items = list(items) + [None]
+
+    def get(self):
+        return self.items.pop(0)
+
+    def qsize(self):
+        return len(self.items)
+
+
+def create_files(directory, num_files, file_size, chunk_size=65536, seed=0):
+    rng = random.Random(seed)
+    names = [f'file{i:07d}' for i in range(num_files)]
+    rng.shuffle(names)
+    paths = [os.path.join(directory, name) for name in names]
+    for path in paths:
+        open(path, 'wb').close()
+    chunk = os.urandom(chunk_size)
+    # interleaved writes of all files scatter their extents over the disk. Every chunk is appended with its own
+    # open(), so that the number of files is not limited by the open file limit (ulimit -n).
+    for _offset in range(0, file_size, chunk_size):
+        rng.shuffle(paths)
+        for path in paths:
+            with open(path, 'ab') as f:
+                f.write(chunk)
+    os.sync()
+
+
+def drop_caches(paths):
+    os.sync()
+    try:
+        with open('/proc/sys/vm/drop_caches', 'w') as f:
+            f.write('3\n')
+    except OSError:
+        for path in paths:
+            fd = os.open(path, os.O_RDONLY)
+            try:
+                os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+            finally:
+                os.close(fd)
+
+
+def read_all(items, bufsize=1048576):
+    total = 0
+    for item in items:
+        with open(item.info_dict['path'], 'rb', buffering=0) as f:
+            for chunk in iter(lambda: f.read(bufsize), b''):
+                total += len(chunk)
+    return total
+
+
+def run(directory, num_files, file_size, window, repeat):
+    if not any(os.scandir(directory)):
+        print(f'Creating {num_files} files of {file_size} bytes in {directory}')
+        create_files(directory, num_files, file_size)
+    scanned = [FileInfo.from_file(path, calculate_checksum=False, stat_result=stat_result)
+               for path, stat_result in Walker(directory)]
+    orders = {'scan': lambda: scanned,
+              'inode': lambda: iter(ReorderingQueue(ListQueue(scanned), window=window, key='inode').get, None),
+              'extent': lambda: iter(ReorderingQueue(ListQueue(scanned), window=window, key='extent').get, None)}
+    for name, order in orders.items():
+        for _i in range(repeat):
+            drop_caches(item.info_dict['path'] for item in scanned)
+            start = time.perf_counter()
+            total = read_all(order())
+            elapsed = time.perf_counter() - start
+            print(f'{name:>6}: {total / elapsed / 1e6:8.1f} MB/s ({total} bytes in {elapsed:.2f} s)')
+
+
+@click.command()
+@click.option('--directory', type=click.Path(file_okay=False), help='Directory on the file system to test.')
+@click.option('--image', type=click.Path(dir_okay=False), help='Create and loop mount a file system image instead.')
+@click.option('--image-size', default='4G', help='Size of the image.')
+@click.option('--fs', default='ext4', type=click.Choice(['ext4', 'xfs']))
+@click.option('--num-files', default=2000, type=int)
+@click.option('--file-size', default=262144, type=int)
+@click.option('--window', default=1024, type=int, help='Sort window of the ReorderingQueue.')
+@click.option('--repeat', default=1, type=int)
+def main(directory, image, image_size, fs, num_files, file_size, window, repeat):
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+        run(directory, num_files, file_size, window, repeat)
+        return
+    if not image:
+        raise click.UsageError('Either --directory or --image is required.')
+    subprocess.run(['truncate', '-s', image_size, image], check=True)
+    subprocess.run([f'mkfs.{fs}', '-q', '-F' if fs == 'ext4' else '-f', image], check=True)
+    with tempfile.TemporaryDirectory() as mount_point:
+        subprocess.run(['mount', '-o', 'loop', image, mount_point], check=True)
+        try:
+            bench_directory = Path(mount_point) / 'bench'
+            bench_directory.mkdir()
+            run(str(bench_directory), num_files, file_size, window, repeat)
+        finally:
+            subprocess.run(['umount', mount_point], check=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,6 @@
 #!/usr/bin/env python3
+import hashlib
 import logging
-from multiprocessing import Queue
 from pathlib import Path
 
 import click
@@ -8,8 +8,11 @@ from tqdm import tqdm
 
 from aestar import chio
 from aestar import database
-from aestar.aestar import AESTarFile, PendingQueue, save_to_archive
-from aestar.fileinfo import FileProcessor, FileFilter
+from aestar.aestar import AESTarFile, FlushPolicy, PendingQueue, save_to_archive
+from aestar.fileinfo import FileInfo, FileProcessor, FileFilter, HashCacheEntry
+from aestar.ordering import ReorderingQueue
+from aestar.prefetch import Prefetcher
+from aestar.queues import BatchQueue
 
 import uuid
 import time
@@ -19,41 +22,100 @@ logger.addHandler(logging.NullHandler())
 
 
 class Backup:
-    def __init__(self, root_dir, file, database_file, passphrase, compression):
+    def __init__(self, root_dir, file, database_file, passphrase, compression, flush_policy=None, async_buffers=0,
+                 prefetch_files=0, prefetch_bytes=67108864, prehash=True, hash_workers=1, hash_cache=True,
+                 level='full', dedup=False, catalogue_batch_size=1000, queue_batch_size=256, queue_max_files=100000,
+                 queue_max_bytes=67108864, excludes=(), one_file_system=False, walk_workers=1, read_order=None,
+                 read_order_window=1024, compression_workers=1, adaptive_compression=False):
         self.root_dir = root_dir
         self.file = file
         self.passphrase = passphrase
         self.compression = compression
-        self.db = database.BackupDatabase(database_file)
-        self.backup_id = self.db.create_backup(root_dir, level='full')
-        self.unfiltered_file_queue = Queue()
-        self.file_queue = Queue()
-        self.file_processor = FileProcessor(self.unfiltered_file_queue, root_dir)
-        self.file_filter = FileFilter(self.unfiltered_file_queue, self.file_queue, self.filter_item)
-        self.pending_queue = PendingQueue(self.file_queue)
+        self.flush_policy = flush_policy
+        self.async_buffers = async_buffers
+        self.compression_workers = compression_workers
+        self.adaptive_compression = adaptive_compression
+        # without pre-hashing, files are hashed while they are archived
+        self.prehash = prehash
+        # the catalogue is written on its own thread, the archiving thread only hands over the rows
+        self.db = database.CatalogueWriter(database_file, batch_size=catalogue_batch_size)
+        self.file_index = None
+        if level != 'full':
+            reference_backups = self.db.call('reference_backups', root_dir, level)
+            if reference_backups is None:
+                logger.warning(f'No completed full backup of {root_dir} found, creating a full backup instead.')
+                level = 'full'
+            else:
+                # load everything the skip decision needs once, FileFilter then checks files without queries
+                self.file_index = self.db.call('load_file_index', reference_backups)
+        self.level = level
+        self.backup_id = self.db.call('create_backup', root_dir, level=self.level)
+        # checksum -> (path, inode) of content that is already on a readable volume, only files with a known checksum
+        # before archiving (pre-hashed or from the hash cache) can be deduplicated
+        self.dedup_index = self.db.call('load_dedup_index') if dedup else None
+        # checksums of unchanged files are reused instead of reading the files again
+        self.hash_cache = self.db.call('load_hash_cache') if hash_cache else None
+        # FileInfo objects are sent between the processes in batches. Both queues are bounded, so that scanning
+        # does not run arbitrarily far ahead of the tape, and share the memory budget.
+        queue_options = dict(batch_size=queue_batch_size, max_items=queue_max_files, max_bytes=queue_max_bytes // 2,
+                             encode=FileInfo.encode, decode=FileInfo.decode)
+        self.unfiltered_file_queue = BatchQueue(**queue_options)
+        self.file_queue = BatchQueue(**queue_options)
+        self.file_processor = FileProcessor(self.unfiltered_file_queue, root_dir, calculate_checksum=self.prehash,
+                                            hash_workers=hash_workers, hash_cache=self.hash_cache, excludes=excludes,
+                                            one_file_system=one_file_system, walk_workers=walk_workers)
+        self.file_filter = FileFilter(self.unfiltered_file_queue, self.file_queue, self.filter_item,
+                                      cache_hashes=self.hash_cache is not None)
+        # the queue the files are archived from, each optional stage wraps the previous one
+        self.source_queue = self.file_queue
+        if read_order:
+            # files are read in the order of their location on disk instead of the scan order
+            self.source_queue = ReorderingQueue(self.source_queue, window=read_order_window, key=read_order)
+        self.prefetcher = None
+        if prefetch_files:
+            self.prefetcher = Prefetcher(self.source_queue, num_files=prefetch_files, max_bytes=prefetch_bytes)
+            self.source_queue = self.prefetcher
+        self.pending_queue = PendingQueue(self.source_queue)
         self.written_bytes_bar = tqdm(position=0, unit_scale=True, unit='B', miniters=1, smoothing=0)
-        self.num_files_bar = tqdm(total=self.file_queue.qsize(), position=1, leave=True, miniters=1, unit='files')
+        self.num_files_bar = tqdm(total=self.remaining_files(), position=1, leave=True, miniters=1, unit='files')
         self.partial_backup_id = None  # is updated to the current id during run()
         self.archive = None
         self.i = 0
 
     def _setup_archive(self):
-        self.archive = AESTarFile(passphrase=self.passphrase, file=self.file, mode='wb', compression=self.compression)
+        self.archive = AESTarFile(passphrase=self.passphrase, file=self.file, mode='wb', compression=self.compression,
+                                  flush_policy=self.flush_policy, async_buffers=self.async_buffers,
+                                  compression_workers=self.compression_workers,
+                                  adaptive_compression=self.adaptive_compression)
+
+    def remaining_files(self):
+        """
+        :return: estimate of the number of files that have been found but not yet archived.
+                 Files that have not been scanned yet are unknown, files that are still to be filtered are included.
+        """
+        return self.source_queue.qsize() + self.unfiltered_file_queue.qsize()
 
     def filter_item(self, item):
-        return True
+        return not self.check_skip(item)
+
+    def check_skip(self, item):
+        if self.file_index is None or not isinstance(item, FileInfo):
+            return False
+        return self.file_index.contains(item.info_dict)
 
     def next_volume(self):
         volume_name = uuid.uuid4().hex
         print(f'Using Volume {volume_name}')
-        self.partial_backup_id = self.db.create_partial_backup(self.backup_id, volume_name)
+        # the files of the previous volume are on tape, record all of them before the new volume is used
+        self.db.barrier()
+        self.partial_backup_id = self.db.call('create_partial_backup', self.backup_id, volume_name)
         print(self.partial_backup_id)
+        self.db.barrier()
         self._setup_archive()
 
     def run(self):
         #  commit the partial backup before starting to add files
         self.next_volume()
-        self.db.commit()
         self.file_processor.start()
         self.file_filter.start()
 
@@ -61,14 +123,18 @@ class Backup:
         while archive_save_result:
             archive_save_result = save_to_archive(self.pending_queue, self.archive,
                                                   pre_add_callback=self.insert_callback,
-                                                  commit_callback=self.commit_callback
+                                                  commit_callback=self.commit_callback,
+                                                  checksum=None if self.prehash else hashlib.sha1
                                                   )
             if archive_save_result:
                 # open the archive again with the new volume
                 self.next_volume()
 
-        self.db.commit()
         self.archive.close()
+        self.db.call('complete_backup', self.backup_id)
+        self.db.close()
+        if self.prefetcher:
+            self.prefetcher.close()
 
     def insert_callback(self, item):
         # this implementation ignores metadata changes
@@ -76,26 +142,48 @@ class Backup:
         # this is by design, because otherwise the catalogue does not match the metadata in the backup on tape
         # it's not a good design though, because in case of a second full backup, the metadata in the catalogue will not be correct!
         # it would be better to just have the primary keys in `files` and metadata in `backed_up_files`
-        # files could also be inserted earlier by the FileFilter (?)
-        row_id = self.db.insert(item.info_dict, 'files', cmd='INSERT OR IGNORE').lastrowid
-        print('row', row_id)
-        item.id = row_id
-        logger.info(f'Inserted file {item} with id {row_id}')
-        self.num_files_bar.total = self.num_files_bar.n + self.file_queue.qsize()
+        # files are inserted in commit_callback, once the checksum is known even if it is calculated while archiving
+        if isinstance(item, HashCacheEntry):
+            # a file skipped by FileFilter, only its checksum is recorded
+            self.db.add_hash_cache_entry(item.entry)
+            return True
+        self.num_files_bar.total = self.num_files_bar.n + self.remaining_files()
         self.num_files_bar.update(1)
-        self.written_bytes_bar.update(item.info_dict['st_size'])
         self.written_bytes_bar.set_postfix({'file': item.info_dict['path']})
-        # check if the file is in backed_up_files not if it is inserted in files!
-        # return True if not rowcount else False
+        if self.deduplicate(item):
+            return True
+        self.written_bytes_bar.update(item.info_dict['st_size'])
+
+    def deduplicate(self, item):
+        """
+        Catalogue a file whose content is already on tape as a reference to the existing copy instead of archiving it.
+        :return: True if the file has been deduplicated and must not be archived
+        """
+        sha1 = item.info_dict.get('sha1')
+        if self.dedup_index is None or sha1 is None or not item.info_dict['st_size']:
+            return False
+        original = self.dedup_index.get(sha1)
+        if original is None:
+            return False
+        logger.info(f'Deduplicated file {item} against {original[0]}')
+        self.db.add_backed_up_file(item.info_dict, self.partial_backup_id, deduplicated=original + (sha1,))
+        if self.hash_cache is not None and not item.hash_cached and item.hash_cache_entry:
+            self.db.add_hash_cache_entry(item.hash_cache_entry)
+        return True
 
     def commit_callback(self, item):
         # PROBLEM: the INSERT or IGNORE insertion might lead to an empty result
         # when querying the whole info_dict (e.g. when atime changes)
-        # file_id = self.db.select(item.info_dict, 'files', selection='id').fetchone()['id']
-        file_id = item.id
-        print('item', item.id)
-        d = {'file_id': file_id, 'partial_backup_id': self.partial_backup_id}
-        self.db.insert(d, 'backed_up_files')
+        # therefore the row is looked up by its unique columns only
+        # the rows are buffered and written in batches, the file is already on tape at this point
+        logger.info(f'Committed file {item}')
+        self.db.add_backed_up_file(item.info_dict, self.partial_backup_id)
+        if self.hash_cache is not None and not item.hash_cached and item.hash_cache_entry:
+            self.db.add_hash_cache_entry(item.hash_cache_entry)
+        sha1 = item.info_dict.get('sha1')
+        if self.dedup_index is not None and sha1 is not None:
+            # later copies within this backup refer to the one that is now on tape
+            self.dedup_index.setdefault(sha1, (item.info_dict['path'], item.info_dict['st_ino']))
 
 
 def import_volumes(cursor, device=None):
@@ -106,23 +194,56 @@ def import_volumes(cursor, device=None):
         database.insert(vol, 'volumes', cursor)
 
 
-def check_skip(item):
-    # if level is not full:
-    # return True if item in files and backed_up_files
-    # if deduplication is enabled:
-    # return True if sha1 in files and that file in backed_up_files
-    pass
-
-
 @click.command()
 @click.argument('directory', required=True, type=click.Path(exists=True))
 @click.option('--file', '-f', required=True, type=click.Path())
 @click.option('--passphrase-file', '-P', required=True, type=click.Path(exists=True))
 @click.option('--database-file', default='catalogue.sqlite', type=click.Path())
 @click.option('--compression', '-z', default='')
+@click.option('--compression-workers', default=1, type=int,
+              help='Compress independent blocks on this many threads. With bz2 and xz the archive then consists of '
+                   'several compressed streams.')
+@click.option('--adaptive-compression/--no-adaptive-compression', default=False,
+              help='Store files that do not compress (media, archives, encrypted data) instead of compressing them. '
+                   'Only with gz compression, bz2 and xz have no stored mode.')
+@click.option('--level', '-l', default='full', type=click.Choice(['full', 'incremental', 'differential']))
+@click.option('--flush-bytes', default=None, type=int, help='Flush the output after this many bytes.')
+@click.option('--flush-files', default=None, type=int, help='Flush the output after this many files.')
+@click.option('--flush-interval', default=None, type=float, help='Flush the output after this many seconds.')
+@click.option('--sync/--no-sync', default=False, help='fsync the output on every flush.')
+@click.option('--async-buffers', default=0, type=int, help='Write the output on a background thread with this many buffers.')
+@click.option('--prefetch-files', default=0, type=int, help='Read ahead the contents of this many files.')
+@click.option('--prefetch-bytes', default=67108864, type=int, help='Memory budget for read ahead file contents.')
+@click.option('--prehash/--no-prehash', default=True,
+              help='Hash files while scanning, or while archiving them to read every file only once.')
+@click.option('--hash-workers', default=1, type=int, help='Number of threads hashing files while scanning.')
+@click.option('--hash-cache/--no-hash-cache', default=True,
+              help='Reuse the checksums of files with unchanged stat results from the catalogue.')
+@click.option('--dedup/--no-dedup', default=False,
+              help='Only catalogue files whose content is already on a readable volume instead of archiving them.')
+@click.option('--catalogue-batch-size', default=1000, type=int,
+              help='Number of archived files that are written to the catalogue in one transaction.')
+@click.option('--queue-max-files', default=100000, type=int,
+              help='Maximum number of scanned files waiting in each queue of the pipeline, 0 for no limit.')
+@click.option('--queue-max-bytes', default=67108864, type=int,
+              help='Memory budget for the scanned files waiting in the pipeline, 0 for no limit.')
+@click.option('--exclude', '-e', 'excludes', multiple=True,
+              help='Glob pattern of files and directories to skip, matched against the name or, if it contains '
+                   'a slash, the path relative to the backup directory. Can be given multiple times.')
+@click.option('--one-file-system', '-x', is_flag=True, help='Do not descend into directories on other file systems.')
+@click.option('--walk-workers', default=1, type=int,
+              help='Number of threads listing directories, for file systems with a high metadata latency.')
+@click.option('--read-order', default=None, type=click.Choice(['inode', 'extent']),
+              help='Archive the files of each window sorted by inode or by their first physical extent (FIEMAP) '
+                   'to reduce seeking on rotating disks.')
+@click.option('--read-order-window', default=1024, type=int, help='Number of files sorted at once for --read-order.')
 @click.option('-v', '--verbose', count=True)
 @click.option('--logfile', default=None)
-def do_backup(directory, file, database_file, passphrase_file, compression, verbose, logfile):
+def do_backup(directory, file, database_file, passphrase_file, compression, compression_workers, adaptive_compression,
+              level, flush_bytes, flush_files,
+              flush_interval, sync, async_buffers, prefetch_files, prefetch_bytes, prehash, hash_workers, hash_cache,
+              dedup, catalogue_batch_size, queue_max_files, queue_max_bytes, excludes, one_file_system, walk_workers,
+              read_order, read_order_window, verbose, logfile):
     if verbose > 1:
         logging.basicConfig(filename=logfile if logfile else None, level=logging.DEBUG)
     elif verbose:
@@ -138,8 +259,16 @@ def do_backup(directory, file, database_file, passphrase_file, compression, verb
     if not root.is_absolute():
         raise ValueError(f'Backup directory {directory} has to be given as an absolute path.')
 
+    # without any limit, every write is flushed
+    flush_policy = FlushPolicy(every_bytes=flush_bytes, every_files=flush_files, every_seconds=flush_interval, sync=sync)
     backup = Backup(root_dir=root, file=file, database_file=database_file, passphrase=passphrase,
-                    compression=compression)
+                    compression=compression, flush_policy=flush_policy, async_buffers=async_buffers,
+                    prefetch_files=prefetch_files, prefetch_bytes=prefetch_bytes, prehash=prehash,
+                    hash_workers=hash_workers, hash_cache=hash_cache, level=level, dedup=dedup,
+                    catalogue_batch_size=catalogue_batch_size, queue_max_files=queue_max_files,
+                    queue_max_bytes=queue_max_bytes, excludes=excludes, one_file_system=one_file_system,
+                    walk_workers=walk_workers, read_order=read_order, read_order_window=read_order_window,
+                    compression_workers=compression_workers, adaptive_compression=adaptive_compression)
     backup.run()
 
     print('Done!')
@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+import logging
+import subprocess
+
+import click
+
+from aestar import chio
+from aestar import database
+from aestar.aestar import AESTarFile, extract_at
+from aestar.planner import RestorePlan
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+
+def member_selector(paths):
+    """
+    :param paths: paths of files or directories as given when backing up, empty to select every member
+    :return: function of a TarInfo returning whether it is one of the paths or inside of one of them
+    """
+    # tarfile stores the paths without the leading slash
+    names = tuple(path.strip('/') for path in paths)
+    if not names:
+        return None
+    return lambda member: any(member.name == name or member.name.startswith(name + '/') for name in names)
+
+
+def volume_loader(changer=None, drive_index=0):
+    """
+    :return: function loading a volume into the drive with the changer, or asking for it without a changer
+    """
+    if changer is None:
+        return lambda volume: click.pause(f'Insert volume {volume} and press any key to continue.')
+
+    def load(volume):
+        try:
+            chio.unload(device=changer, drive_index=drive_index)
+        except subprocess.CalledProcessError:
+            logger.debug(f'Drive {drive_index} was empty')
+        chio.load(volume, device=changer, drive_index=drive_index)
+    return load
+
+
+def restore_located(paths, file, passphrase, directory, database_file, record_size, bufsize, workers, plan_options,
+                    changer=None, drive_index=0, dry_run=False):
+    """
+    Restore files whose location is in the catalogue, without reading the archives from the start.
+    From tape, every volume is loaded once and read in a single forward pass, see planner.RestorePlan.
+    Files of compressed archives can not be located and are restored by reading the archive from the start.
+    :param plan_options: keyword arguments of RestorePlan for the estimate
+    """
+    catalogue = database.BackupDatabase(database_file)
+    located = catalogue.locate_files(paths)
+    tape_file_sizes = catalogue.partial_backup_sizes({row['partial_backup_id'] for row in located})
+    catalogue.close()
+    plan = RestorePlan(located, tape_file_sizes=tape_file_sizes, **plan_options)
+    print(plan.report())
+    if dry_run:
+        return []
+    if record_size or changer:
+        return plan.execute(passphrase, file, volume_loader(changer, drive_index), path=directory,
+                            record_size=record_size, bufsize=bufsize, workers=workers)
+    # a single archive file. Deduplicated files are extracted from the member holding their content.
+    seekable = {}
+    rest = []
+    for row in located:
+        if row['sector'] is None:
+            rest.append(row)
+        else:
+            seekable.setdefault(row['tar_offset'], []).append(row)
+    extracted = []
+    for tar_offset, rows in sorted(seekable.items()):
+        extracted += extract_at(passphrase, file, tar_offset, path=directory, bufsize=bufsize, workers=workers,
+                                targets=database.member_targets(rows))
+    if rest:
+        with AESTarFile(passphrase=passphrase, file=file, mode='rb', bufsize=bufsize, workers=workers) as archive:
+            extracted += archive.extract(directory, select=member_selector([row['content_path'] for row in rest]),
+                                         targets=database.member_targets(rest))
+    missing = {row['path'].strip('/') for row in located} - {member.name for member in extracted}
+    if missing:
+        logger.warning(f'{len(missing)} files have not been found in {file}: {", ".join(sorted(missing))}')
+    return extracted
+
+
+@click.command()
+@click.argument('paths', nargs=-1)
+@click.option('--file', '-f', required=True, type=click.Path(exists=True),
+              help='Archive file or tape device, which has to be non-rewinding (/dev/nst*) with --record-size.')
+@click.option('--passphrase-file', '-P', required=True, type=click.Path(exists=True))
+@click.option('--directory', '-C', default='.', type=click.Path(file_okay=False),
+              help='Directory to restore the files to.')
+@click.option('--compression', '-z', default=None, type=click.Choice(['', 'gz', 'bz2', 'xz']),
+              help='Compression of the archive, detected by default.')
+@click.option('--database-file', default=None, type=click.Path(exists=True),
+              help='Catalogue to look up the location of PATHS in, so that the archive is not read from the start.')
+@click.option('--record-size', default=None, type=int,
+              help='Fixed block size of the tape drive. With --database-file, the files are restored from tape '
+                   'volume by volume, each file is located with mt seek and mt fsr.')
+@click.option('--changer', default=None, help='Changer device to load the volumes with, otherwise they are asked for.')
+@click.option('--drive-index', default=0, type=int, help='Index of the drive in the changer.')
+@click.option('--dry-run', is_flag=True, help='Only print the restore plan and its estimated duration.')
+@click.option('--load-seconds', default=180, type=float, help='Estimated time to change a volume.')
+@click.option('--locate-seconds', default=30, type=float, help='Estimated time to locate a file on a volume.')
+@click.option('--read-rate', default=300000000, type=float, help='Estimated bytes per second read from tape.')
+@click.option('--bufsize', default=1048576, type=int, help='Number of bytes read and decrypted at once.')
+@click.option('--workers', default=1, type=int, help='Number of threads decrypting the sectors of a buffer.')
+@click.option('-v', '--verbose', count=True)
+@click.option('--logfile', default=None)
+def do_restore(paths, file, passphrase_file, directory, compression, database_file, record_size, changer, drive_index,
+               dry_run, load_seconds, locate_seconds, read_rate, bufsize, workers, verbose, logfile):
+    """
+    Restore PATHS (everything by default) from an archive in a single pass.
+    """
+    if verbose > 1:
+        logging.basicConfig(filename=logfile if logfile else None, level=logging.DEBUG)
+    elif verbose:
+        logging.basicConfig(filename=logfile if logfile else None, level=logging.INFO)
+
+    with open(passphrase_file, 'rb') as f:
+        passphrase = f.readline().strip()
+
+    logger.info(f'Restoring {", ".join(paths) if paths else "everything"} from {file} to {directory}')
+    if database_file and paths:
+        plan_options = {'load_seconds': load_seconds, 'locate_seconds': locate_seconds, 'read_rate': read_rate}
+        extracted = restore_located(paths, file, passphrase, directory, database_file, record_size, bufsize, workers,
+                                    plan_options, changer=changer, drive_index=drive_index, dry_run=dry_run)
+        if not dry_run:
+            print(f'Restored {len(extracted)} files.')
+        return
+    with AESTarFile(passphrase=passphrase, file=file, mode='rb', bufsize=bufsize, compression=compression,
+                    workers=workers) as archive:
+        extracted = archive.extract(directory, select=member_selector(paths))
+    print(f'Restored {len(extracted)} files.')
+
+
+if __name__ == '__main__':
+    do_restore()
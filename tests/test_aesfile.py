@@ -1,9 +1,12 @@
+import io
 import subprocess
 
 import pytest
 
 from aestar import aestar
-from .utils import aespipe_decrypt
+from aestar import fakefile
+from aestar.cipher import SECTOR_SIZE, SectorCipher
+from .utils import aespipe_decrypt, aes_encrypt_reference
 
 # These tests require the program `aespipe` to be available on your system
 
@@ -56,6 +59,122 @@ def test_encrypt_decrypt_aespipe(aesfile, passphrase_file, plaintext, tmp_path):
     assert plaintext == decrypted
 
 
+def test_batched_encryption_matches_reference(aesfile, passphrase, plaintext, tmp_path):
+    # two writes to make sure the sector number is carried over between batches
+    aesfile.write(plaintext)
+    aesfile.write(plaintext)
+    aesfile.close()
+    with open(tmp_path / 'aesfile.tmp', 'rb') as f:
+        ciphertext_bytes = f.read()
+    assert ciphertext_bytes == aes_encrypt_reference(plaintext * 2, passphrase)
+
+
+@pytest.mark.parametrize('workers', [2, 3, 8])
+def test_parallel_encryption_matches_reference(passphrase, workers, tmp_path):
+    with open('test_archive_folder/random1MB', 'rb') as f:
+        plaintext = f.read()
+    aesfile = aestar.AESFile(passphrase=passphrase, file=tmp_path / 'aesfile.tmp', bufsize=131072, workers=workers)
+    aesfile.write(plaintext[:131072])
+    aesfile.write(plaintext[131072:])
+    aesfile.close()
+    with open(tmp_path / 'aesfile.tmp', 'rb') as f:
+        ciphertext_bytes = f.read()
+    assert ciphertext_bytes == aes_encrypt_reference(plaintext, passphrase)
+
+
+@pytest.mark.parametrize('workers', [1, 3])
+def test_read_matches_reference(passphrase, workers):
+    with open('test_archive_folder/random1MB', 'rb') as f:
+        plaintext = f.read(100000)
+    ciphertext = aes_encrypt_reference(plaintext, passphrase)
+
+    class ShortReads(io.BytesIO):
+        # like a tape drive, return at most one block of 1000 bytes per read
+        def read(self, size=-1):
+            return super().read(min(size, 1000) if size >= 0 else 1000)
+
+    aesfile = aestar.AESFile(passphrase=passphrase, fileobj=ShortReads(ciphertext), mode='rb', bufsize=65536,
+                             workers=workers)
+    assert aesfile.peek(3) == plaintext[:3]
+    assert aesfile.read(10) == plaintext[:10]
+    rest = aesfile.read()
+    # the last sector is padded with zero bytes
+    assert plaintext[10:] + bytes(len(ciphertext) - len(plaintext)) == rest
+    assert aesfile.tell() == len(ciphertext)
+    assert aesfile.read(1) == b''
+    with pytest.raises(io.UnsupportedOperation):
+        aesfile.write(b'abc')
+    aesfile.close()
+
+
+def test_sector_ivs():
+    reference = b''.join(sector.to_bytes(16, byteorder='little') for sector in range(2 ** 40, 2 ** 40 + 100))
+    assert SectorCipher.ivs(2 ** 40, 100) == reference
+    # only the IVs of a reused buffer are overwritten
+    output = bytearray(b'\xff' * 100 * SECTOR_SIZE)
+    assert SectorCipher.ivs(2 ** 40, 100, output=output, stride=SECTOR_SIZE) is output
+    for i in range(100):
+        assert output[i * SECTOR_SIZE:i * SECTOR_SIZE + 16] == reference[i * 16:(i + 1) * 16]
+        assert output[i * SECTOR_SIZE + 16:(i + 1) * SECTOR_SIZE] == b'\xff' * (SECTOR_SIZE - 16)
+
+
+def test_write_chunks_reuse_buffer(passphrase):
+    with open('test_archive_folder/random10240', 'rb') as f:
+        plaintext = f.read(4196)
+    ff = fakefile.FakeFile()
+    written = ff.buffer
+    aesfile = aestar.AESFile(passphrase=passphrase, fileobj=ff, bufsize=1024, sync=False)
+    aesfile.write(bytearray(plaintext))
+    # writes are split into chunks of at most bufsize bytes
+    assert [len(chunk) for chunk in written] == [1024, 1024, 1024, 1024]
+    assert aesfile.tell() == len(plaintext)
+    assert aesfile.committed == 4096
+    # the last incomplete sector is padded and written on close
+    aesfile.close()
+    assert [len(chunk) for chunk in written] == [1024, 1024, 1024, 1024, 512]
+    assert aesfile.committed == len(plaintext)
+    assert b''.join(written) == aes_encrypt_reference(plaintext, passphrase)
+
+
+def test_unaligned_writes_carry_over(passphrase):
+    with open('test_archive_folder/random10240', 'rb') as f:
+        plaintext = f.read()
+    ff = fakefile.FakeFile()
+    written = ff.buffer
+    aesfile = aestar.AESFile(passphrase=passphrase, fileobj=ff, bufsize=2048, sync=False)
+    for start, stop in [(0, 1), (1, 511), (511, 1500), (1500, 1536), (1536, 5000), (5000, 10000)]:
+        aesfile.write(plaintext[start:stop])
+        assert aesfile.committed == stop - stop % 512
+    aesfile.close()
+    # only the final sector is padded
+    assert b''.join(written) == aes_encrypt_reference(plaintext[:10000], passphrase)
+
+
+def test_unaligned_close_without_padding(passphrase):
+    aesfile = aestar.AESFile(passphrase=passphrase, fileobj=fakefile.FakeFile(), sync=False, pad=False)
+    aesfile.write(b'a' * 513)
+    with pytest.raises(ValueError):
+        aesfile.close()
+
+
+def test_flush_policy_every_bytes(passphrase):
+    ff = fakefile.FakeFile()
+    policy = aestar.FlushPolicy(every_bytes=2048)
+    aesfile = aestar.AESFile(passphrase=passphrase, fileobj=ff, flush_policy=policy)
+    for i in range(3):
+        aesfile.write(b'a' * 512)
+    assert ff.flushes == 0
+    assert aesfile.written == 1536
+    assert aesfile.committed == 0
+    aesfile.write(b'a' * 512)
+    assert ff.flushes == 1
+    assert aesfile.committed == 2048
+    aesfile.write(b'a' * 512)
+    assert aesfile.committed == 2048
+    aesfile.close()
+    assert aesfile.committed == 2560
+
+
 def test_fileobj(passphrase, tmp_path):
     with open(tmp_path / 'aesfile_obj.tmp', 'wb') as f:
         aesfile = aestar.AESFile(passphrase, fileobj=f)
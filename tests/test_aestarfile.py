@@ -1,11 +1,21 @@
 from aestar import aestar
 from aestar import fakefile
+from aestar import mt
+from aestar.fileinfo import FileInfo, checksum
+from aestar.prefetch import Prefetcher
 import time
 import os
 import pytest
 import errno
+import filecmp
+import gzip
+import hashlib
+import io
+import queue
+import tarfile
 from pathlib import Path
-from .utils import aespipe_decrypt, untar, tar_diff, diff
+from collections import deque
+from .utils import aespipe_decrypt, untar, tar_diff, diff, aes_decrypt_reference
 
 
 @pytest.fixture(params=[r'passwords/ascii.txt', r'passwords/numeric.txt'])
@@ -103,3 +113,291 @@ def test_num_committed(passphrase):
     aestarfile.close()
     assert aestarfile.num_committed == 3
 
+
+
+def test_flush_policy_every_files(passphrase):
+    ff = fakefile.FakeFile(size=-1, failure_mode='ENOSPC')
+    aestarfile = aestar.AESTarFile(passphrase=passphrase, fileobj=ff, bufsize=512,
+                                   flush_policy=aestar.FlushPolicy(every_files=2))
+    aestarfile.add('test_archive_folder/random512')
+    assert ff.flushes == 0
+    aestarfile.add('test_archive_folder/random2048')
+    assert ff.flushes == 1
+    aestarfile.add('test_archive_folder/random512')
+    # data that has been written but not flushed yet does not count as committed
+    assert aestarfile.aesfile.written > aestarfile.aesfile.committed
+    aestarfile.purge_pending()
+    assert aestarfile.num_committed == 1
+    aestarfile.close()
+    assert aestarfile.num_committed == 3
+
+
+def test_async_writer_EOT(passphrase):
+    ff = fakefile.FakeFile(size=4096, failure_mode='ENOSPC')
+    aestarfile = aestar.AESTarFile(passphrase=passphrase, fileobj=ff, bufsize=1024, async_buffers=2)
+    # end offset of every added file in the output, by file number
+    end_offsets = {}
+
+    class RecordingDeque(deque):
+        def append(self, entry):
+            num, buffer_length, position, offset = entry
+            end_offsets[num] = buffer_length + position
+            super().append(entry)
+
+    aestarfile.pending_files = RecordingDeque()
+    with pytest.raises(IOError) as e_info:
+        for _i in range(10):
+            aestarfile.add('test_archive_folder/random512')
+    assert e_info.value.errno == errno.ENOSPC
+    assert aestarfile.closed is True
+    # committed files have to be entirely written to the device
+    assert aestarfile.aesfile.committed <= ff.written
+    for num, buffer_length, position, offset in aestarfile.pending_files:
+        assert buffer_length + position > aestarfile.aesfile.committed
+    assert 0 < aestarfile.num_committed < len(end_offsets)
+    for num in range(1, aestarfile.num_committed + 1):
+        assert end_offsets[num] <= ff.written
+
+
+def test_purge_pending_many_files(passphrase):
+    aestarfile = aestar.AESTarFile(passphrase=passphrase, fileobj=fakefile.FakeFile(), bufsize=131072)
+    added = []
+    for _i in range(300):
+        added.append(aestarfile.add('test_archive_folder/123.txt'))
+        aestarfile.purge_pending()
+        committed = aestarfile.aesfile.committed
+        # exactly the files that end before the committed offset have been removed, in order
+        assert aestarfile.num_committed == sum(1 for stats in added if stats[1] + stats[2] <= committed)
+        assert list(aestarfile.pending_files) == added[aestarfile.num_committed:]
+    assert 0 < aestarfile.num_committed < 300
+    aestarfile.close()
+    assert aestarfile.num_committed == 300
+
+
+def test_save_to_archive_restore(passphrase):
+    paths = ['test_archive_folder/random512', 'test_archive_folder/random1024', 'test_archive_folder/random2048',
+             'test_archive_folder/random10240', 'test_archive_folder/lorem.txt', 'test_archive_folder/123.txt']
+    file_queue = queue.Queue()
+    for path in paths:
+        file_queue.put(FileInfo({'path': path}))
+    file_queue.put(None)
+    pending_queue = aestar.PendingQueue(file_queue)
+    committed = []
+    archive = aestar.AESTarFile(passphrase=passphrase, fileobj=fakefile.FakeFile(size=6144), bufsize=2048)
+    assert aestar.save_to_archive(pending_queue, archive, commit_callback=committed.append) == 1
+    assert 0 < len(committed) < len(paths)
+    archive = aestar.AESTarFile(passphrase=passphrase, fileobj=fakefile.FakeFile(), bufsize=2048)
+    assert aestar.save_to_archive(pending_queue, archive, commit_callback=committed.append) == 0
+    # every file is committed exactly once and in order
+    assert [item.info_dict['path'] for item in committed] == paths
+
+
+def test_save_to_archive_skip(passphrase):
+    paths = ['test_archive_folder/random512', 'test_archive_folder/random1024', 'test_archive_folder/random2048',
+             'test_archive_folder/random10240', 'test_archive_folder/lorem.txt', 'test_archive_folder/123.txt']
+    skipped = {'test_archive_folder/random1024', 'test_archive_folder/lorem.txt'}
+    file_queue = queue.Queue()
+    for path in paths:
+        file_queue.put(FileInfo({'path': path}))
+    file_queue.put(None)
+    pending_queue = aestar.PendingQueue(file_queue)
+    committed = []
+    skip = lambda item: item.info_dict['path'] in skipped
+    archive = aestar.AESTarFile(passphrase=passphrase, fileobj=fakefile.FakeFile(size=6144), bufsize=2048)
+    assert aestar.save_to_archive(pending_queue, archive, pre_add_callback=skip, commit_callback=committed.append) == 1
+    archive = aestar.AESTarFile(passphrase=passphrase, fileobj=fakefile.FakeFile(), bufsize=2048)
+    assert aestar.save_to_archive(pending_queue, archive, pre_add_callback=skip, commit_callback=committed.append) == 0
+    # skipped items are neither committed nor replayed
+    assert [item.info_dict['path'] for item in committed] == [path for path in paths if path not in skipped]
+
+
+def test_save_to_archive_prefetch(passphrase, tmp_path):
+    files = [p for p in Path('test_archive_folder').rglob('*')]
+    file_queue = queue.Queue()
+    for file in files:
+        file_queue.put(FileInfo.from_file(file))
+    file_queue.put(None)
+    # the budget only allows some of the files to be read into memory
+    prefetcher = Prefetcher(file_queue, num_files=4, max_bytes=20000, max_file_size=10240, workers=2)
+    committed = []
+    archive = aestar.AESTarFile(passphrase=passphrase, file=tmp_path / 'aestarfile.tar.aes')
+    assert aestar.save_to_archive(aestar.PendingQueue(prefetcher), archive, commit_callback=committed.append) == 0
+    prefetcher.close()
+    assert [item.info_dict['path'] for item in committed] == [file.as_posix() for file in files]
+    assert all(item.prefetched is None for item in committed)
+    assert prefetcher.reserved_bytes == 0
+
+
+def test_save_to_archive_checksum(passphrase):
+    files = [p for p in Path('test_archive_folder').rglob('*')]
+    file_queue = queue.Queue()
+    for file in files:
+        file_queue.put(FileInfo.from_file(file, calculate_checksum=False))
+    file_queue.put(None)
+    committed = []
+    archive = aestar.AESTarFile(passphrase=passphrase, fileobj=fakefile.FakeFile())
+    assert aestar.save_to_archive(aestar.PendingQueue(file_queue), archive, commit_callback=committed.append,
+                                  checksum=hashlib.sha1) == 0
+    assert len(committed) == len(files)
+    for item in committed:
+        if item.info_dict['is_dir']:
+            assert 'sha1' not in item.info_dict
+        else:
+            assert item.info_dict['sha1'] == checksum(item.info_dict['path'], hex=False)
+
+
+@pytest.mark.parametrize('compression', ['gz', 'bz2', 'xz'])
+def test_parallel_compression(passphrase, compression):
+    files = sorted(Path('test_archive_folder').rglob('*'))
+    ff = fakefile.FakeFile()
+    with aestar.AESTarFile(passphrase=passphrase, fileobj=ff, compression=compression, compression_workers=4) as f:
+        for file in files:
+            f.add(file)
+            # the files are pending until their compressed block has been written
+            assert f.num_committed < f.num_files
+        # closing the FakeFile discards its buffer list
+        written = ff.buffer
+    assert f.num_committed == len(files)
+    plaintext = aes_decrypt_reference(b''.join(written), passphrase)
+    # bz2 and xz consist of several streams, which only the file modes of tarfile read
+    with tarfile.open(fileobj=io.BytesIO(plaintext), mode='r:*') as tar:
+        members = tar.getmembers()
+        assert [member.name for member in members] == [file.as_posix() for file in files]
+        for member in members:
+            if member.isfile():
+                assert tar.extractfile(member).read() == Path(member.name).read_bytes()
+
+
+def test_adaptive_compression(passphrase, tmp_path):
+    random_file = tmp_path / 'random'
+    random_file.write_bytes(os.urandom(200000))
+    text_file = tmp_path / 'text'
+    text_file.write_bytes(b'0123456789' * 20000)
+    ff = fakefile.FakeFile()
+    with aestar.AESTarFile(passphrase=passphrase, fileobj=ff, compression='gz', adaptive_compression=True) as f:
+        f.add(text_file)
+        f.add(random_file)
+        f.add(text_file)
+        written = ff.buffer
+        # only the contents of the random file are stored
+        assert f.compressor.bytes_bypassed == 200000
+    plaintext = gzip.decompress(aes_decrypt_reference(b''.join(written), passphrase))
+    assert plaintext.count(random_file.read_bytes()) == 1
+
+
+@pytest.mark.parametrize('compression', ['bz2', 'xz'])
+def test_adaptive_compression_gz_only(passphrase, compression):
+    with pytest.warns(UserWarning, match='only possible with gz'):
+        f = aestar.AESTarFile(passphrase=passphrase, fileobj=fakefile.FakeFile(), compression=compression,
+                              adaptive_compression=True)
+    assert not f.adaptive_compression
+    # tarfile compresses the stream as without adaptive compression
+    assert f.compressor is None
+    f.close()
+
+
+@pytest.mark.parametrize('compression, compression_workers', [(None, 1), ('gz', 1), ('bz2', 4), ('xz', 4)])
+def test_read_extract(passphrase, compression, compression_workers, tmp_path):
+    files = sorted(Path('test_archive_folder').rglob('*'))
+    with aestar.AESTarFile(passphrase=passphrase, file=tmp_path / 'aestarfile.tar.aes', compression=compression,
+                           compression_workers=compression_workers) as f:
+        for file in files:
+            f.add(file)
+    # the compression is detected, all streams of a parallel compressor are read
+    with aestar.AESTarFile(passphrase=passphrase, file=tmp_path / 'aestarfile.tar.aes', mode='rb',
+                           bufsize=4096) as f:
+        extracted = f.extract(tmp_path / 'extracted',
+                              select=lambda member: member.name != 'test_archive_folder/123.txt')
+    assert [member.name for member in extracted] == [file.as_posix() for file in files
+                                                     if file.as_posix() != 'test_archive_folder/123.txt']
+    assert not (tmp_path / 'extracted/test_archive_folder/123.txt').exists()
+    for file in files:
+        if file.is_file() and file.name != '123.txt':
+            assert filecmp.cmp(file, tmp_path / 'extracted' / file, shallow=False)
+
+
+def test_extract_at(passphrase, tmp_path):
+    files = [file for file in sorted(Path('test_archive_folder').rglob('*')) if file.is_file()]
+    file_queue = queue.Queue()
+    for file in files:
+        file_queue.put(FileInfo({'path': file.as_posix()}))
+    file_queue.put(None)
+    committed = []
+    archive = aestar.AESTarFile(passphrase=passphrase, file=tmp_path / 'aestarfile.tar.aes')
+    assert aestar.save_to_archive(aestar.PendingQueue(file_queue), archive, commit_callback=committed.append) == 0
+    # headers start at sector boundaries of the uncompressed archive
+    for item in committed:
+        assert item.info_dict['tar_offset'] == item.info_dict['sector'] * 512
+    target = committed[-2].info_dict
+    extracted = aestar.extract_at(passphrase, tmp_path / 'aestarfile.tar.aes', target['tar_offset'],
+                                  path=tmp_path / 'extracted')
+    assert [member.name for member in extracted] == [target['path']]
+    assert (tmp_path / 'extracted' / target['path']).read_bytes() == Path(target['path']).read_bytes()
+
+    class Stream(io.FileIO):
+        # like a tape device, only reads forward
+        def seekable(self):
+            return False
+
+    # a stream can only be skipped forward by reading
+    ciphertext = (tmp_path / 'aestarfile.tar.aes').read_bytes()
+    aesfile = aestar.AESFile(passphrase, fileobj=Stream(tmp_path / 'aestarfile.tar.aes'), mode='rb', bufsize=1024)
+    offset = target['tar_offset'] + 100
+    assert aesfile.seek(offset) == offset
+    assert aesfile.read(412) == aes_decrypt_reference(ciphertext[offset - 100:offset + 412], passphrase,
+                                                      first_sector=target['sector'])[100:]
+    with pytest.raises(io.UnsupportedOperation):
+        aesfile.seek(0)
+    aesfile.close()
+
+
+class FakeTape:
+    """
+    Tape device in fixed block mode: reads return whole records, lseek() succeeds without moving the tape
+    """
+    def __init__(self, data, record_size):
+        self.data = data
+        self.record_size = record_size
+        self.position = 0
+        self.closed = False
+
+    def forward_records(self, count, device=None):
+        self.position += count * self.record_size
+
+    def seekable(self):
+        return True
+
+    def seek(self, offset, whence=0):
+        return self.position
+
+    def read(self, size=-1):
+        assert size % self.record_size == 0
+        data = self.data[self.position:self.position + size]
+        self.position += len(data)
+        return data
+
+    def close(self):
+        self.closed = True
+
+
+def test_extract_at_tape(passphrase, tmp_path, monkeypatch):
+    files = [file for file in sorted(Path('test_archive_folder').rglob('*')) if file.is_file()]
+    file_queue = queue.Queue()
+    for file in files:
+        file_queue.put(FileInfo({'path': file.as_posix()}))
+    file_queue.put(None)
+    committed = []
+    archive = aestar.AESTarFile(passphrase=passphrase, file=tmp_path / 'aestarfile.tar.aes')
+    assert aestar.save_to_archive(aestar.PendingQueue(file_queue), archive, commit_callback=committed.append) == 0
+    record_size = 4096
+    # headers that do not start in the first sector of their record
+    targets = [item.info_dict for item in committed if item.info_dict['tar_offset'] % record_size]
+    assert targets
+    for target in targets:
+        tape = FakeTape((tmp_path / 'aestarfile.tar.aes').read_bytes(), record_size)
+        monkeypatch.setattr(mt, 'forward_records', tape.forward_records)
+        extracted = aestar.extract_at(passphrase, '/dev/nst0', target['tar_offset'], path=tmp_path / 'extracted',
+                                      record_size=record_size, bufsize=10000, fileobj=tape)
+        assert [member.name for member in extracted] == [target['path']]
+        assert (tmp_path / 'extracted' / target['path']).read_bytes() == Path(target['path']).read_bytes()
+        assert tape.closed
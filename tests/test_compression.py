@@ -0,0 +1,86 @@
+import bz2
+import gzip
+import io
+import lzma
+import os
+
+import pytest
+
+from aestar.compression import ParallelCompressor, is_incompressible
+
+
+class CommittingFile(io.BytesIO):
+    def __init__(self):
+        super().__init__()
+        # only what has been flushed counts as committed
+        self.committed = 0
+
+    def flush(self):
+        self.committed = self.tell()
+
+
+@pytest.mark.parametrize('compression, decompress', [('gz', gzip.decompress), ('bz2', bz2.decompress),
+                                                     ('xz', lzma.decompress)])
+def test_parallel_compressor(compression, decompress):
+    data = os.urandom(100000) + b'0123456789' * 50000 + os.urandom(123)
+    out = CommittingFile()
+    compressor = ParallelCompressor(out, compression, block_size=65536, workers=4)
+    for i in range(0, len(data), 7000):
+        assert compressor.write(data[i:i + 7000]) == len(data[i:i + 7000])
+    assert compressor.tell() == len(data)
+    assert compressor.committed == 0
+    out.flush()
+    # only whole blocks that have been written to the file are committed
+    assert compressor.committed % 65536 == 0
+    assert compressor.committed < len(data)
+    compressor.close()
+    out.flush()
+    assert compressor.committed == len(data)
+    assert decompress(out.getvalue()) == data
+
+
+def test_parallel_compressor_flush():
+    out = CommittingFile()
+    compressor = ParallelCompressor(out, 'gz', block_size=65536, workers=2)
+    compressor.write(b'abc')
+    compressor.flush()
+    assert compressor.committed == 3
+    compressor.write(b'def')
+    compressor.close()
+    assert gzip.decompress(out.getvalue()) == b'abcdef'
+
+
+def test_parallel_compressor_bypass():
+    random = os.urandom(200000)
+    data = b'0123456789' * 10000 + random + b'0123456789' * 10000
+    out = CommittingFile()
+    compressor = ParallelCompressor(out, 'gz', block_size=65536, workers=2)
+    compressor.mark_incompressible(100000, 300000)
+    for i in range(0, len(data), 7000):
+        compressor.write(data[i:i + 7000])
+    compressor.close()
+    # blocks are cut at the range boundaries, so exactly the range is bypassed
+    assert compressor.bytes_bypassed == len(random)
+    assert gzip.decompress(out.getvalue()) == data
+    # stored deflate blocks are barely larger than the data
+    assert len(out.getvalue()) < len(random) * 1.01
+
+
+@pytest.mark.parametrize('compression', ['bz2', 'xz'])
+def test_parallel_compressor_no_bypass(compression):
+    compressor = ParallelCompressor(CommittingFile(), compression, workers=1)
+    with pytest.raises(ValueError):
+        compressor.mark_incompressible(0, 100)
+    compressor.close()
+
+
+def test_is_incompressible(tmp_path):
+    assert is_incompressible('photo.JPG')
+    assert is_incompressible('random', io.BytesIO(os.urandom(100000)))
+    assert is_incompressible('no_extension', io.BytesIO(b'PK\x03\x04' + bytes(1000)))
+    text = io.BytesIO(b'0123456789' * 10000)
+    text.seek(10)
+    assert not is_incompressible('text.txt', text)
+    # the position is restored after sampling
+    assert text.tell() == 10
+    assert not is_incompressible('empty', io.BytesIO())
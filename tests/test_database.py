@@ -0,0 +1,157 @@
+import sqlite3
+from pathlib import Path
+
+import pytest
+
+from aestar import database
+
+
+def test_hash_cache_roundtrip():
+    db = database.BackupDatabase(':memory:')
+    assert db.load_hash_cache() == {}
+    db.update_hash_cache([(1, 2, 3, 4, 5, b'a'), (1, 3, 3, 4, 5, b'b')])
+    db.update_hash_cache([(1, 2, 6, 7, 8, b'c')])
+    assert db.load_hash_cache() == {(1, 2): (6, 7, 8, b'c'), (1, 3): (3, 4, 5, b'b')}
+
+
+def test_file_index():
+    index = database.FileIndex([('a', 1, 10, 100, b'x'), ('b', 2, 20, 200, None), ('a', 1, 11, 110, b'y')])
+    # later rows replace earlier ones
+    assert index.contains({'path': 'a', 'st_ino': 1, 'st_size': 11, 'st_mtime': 110, 'sha1': b'y'})
+    assert not index.contains({'path': 'a', 'st_ino': 1, 'st_size': 10, 'st_mtime': 100, 'sha1': b'x'})
+    # the checksum takes precedence over size and mtime
+    assert index.contains({'path': 'a', 'st_ino': 1, 'st_size': 11, 'st_mtime': 999, 'sha1': b'y'})
+    assert index.contains({'path': 'b', 'st_ino': 2, 'st_size': 20, 'st_mtime': 200})
+    assert not index.contains({'path': 'b', 'st_ino': 2, 'st_size': 20, 'st_mtime': 201})
+    assert not index.contains({'path': 'b', 'st_ino': 3, 'st_size': 20, 'st_mtime': 200})
+
+
+def test_reference_backups():
+    db = database.BackupDatabase(':memory:')
+    root = Path('/data')
+    assert db.reference_backups(root, 'incremental') is None
+    ids = []
+    for level in ('full', 'incremental', 'incremental'):
+        backup_id = db.create_backup(root, level=level)
+        partial_backup_id = db.create_partial_backup(backup_id, 'volume')
+        db.add_backed_up_file({'path': f'/data/{level}{backup_id}', 'st_ino': backup_id, 'st_size': 1,
+                               'st_mtime': 1, 'sha1': bytes([backup_id])}, partial_backup_id)
+        db.commit()
+        db.complete_backup(backup_id)
+        ids.append(backup_id)
+    assert db.reference_backups(root, 'differential') == ids[:1]
+    assert db.reference_backups(root, 'incremental') == ids
+    assert len(db.load_file_index(ids)) == 3
+    assert len(db.load_file_index(ids[:1])) == 1
+
+
+def test_dedup_index():
+    db = database.BackupDatabase(':memory:')
+    backup_id = db.create_backup(Path('/data'))
+    for volume, sha1 in (('good', b'a'), ('bad', b'b'), ('unknown', b'c')):
+        partial_backup_id = db.create_partial_backup(backup_id, volume)
+        db.add_backed_up_file({'path': f'/data/{volume}', 'st_ino': 1, 'sha1': sha1}, partial_backup_id)
+    db.insert({'voltag': 'good'}, 'volumes')
+    db.insert({'voltag': 'bad', 'error': 1}, 'volumes')
+    # a reference to deduplicated content does not hold the content itself
+    db.add_backed_up_file({'path': '/data/copy', 'st_ino': 2, 'sha1': b'd'}, partial_backup_id,
+                          deduplicated=('/data/good', 1, b'a'))
+    db.commit()
+    assert db.load_dedup_index() == {b'a': ('/data/good', 1), b'c': ('/data/unknown', 1)}
+
+
+def test_batched_backed_up_files(tmp_path):
+    db = database.BackupDatabase(tmp_path / 'catalogue.sqlite', batch_size=3)
+    assert db.connection.execute('PRAGMA journal_mode').fetchone()[0] == 'wal'
+    backup_id = db.create_backup(tmp_path)
+    partial_backup_id = db.create_partial_backup(backup_id, 'volume')
+    db.commit()
+    db.add_backed_up_file({'path': 'a', 'st_ino': 1, 'sha1': b'x', 'st_size': 1}, partial_backup_id)
+    db.add_backed_up_file({'path': 'b', 'st_ino': 2, 'sha1': None}, partial_backup_id)
+    other = database.BackupDatabase(tmp_path / 'catalogue.sqlite')
+    count = 'SELECT count(*) FROM backed_up_files'
+    # nothing is visible before the batch is full
+    assert other.connection.execute(count).fetchone()[0] == 0
+    db.add_backed_up_file({'path': 'c', 'st_ino': 3, 'sha1': b'x'}, partial_backup_id, deduplicated=('a', 1, b'x'))
+    assert other.connection.execute(count).fetchone()[0] == 3
+    next_partial_backup_id = db.create_partial_backup(backup_id, 'next volume')
+    db.add_backed_up_file({'path': 'a', 'st_ino': 1, 'sha1': b'x'}, next_partial_backup_id)
+    db.close()
+    rows = other.connection.execute('SELECT files.path, files.st_size, partial_backup_id, deduplication_file_id '
+                                    'FROM backed_up_files JOIN files ON files.id = file_id ORDER BY backed_up_files.rowid').fetchall()
+    assert [tuple(row) for row in rows] == [('a', 1, partial_backup_id, None), ('b', None, partial_backup_id, None),
+                                            ('c', None, partial_backup_id, 1), ('a', 1, next_partial_backup_id, None)]
+
+
+def test_backed_up_files_without_checksum():
+    db = database.BackupDatabase(':memory:')
+    partial_backup_ids = []
+    for mtime in (100, 200):
+        backup_id = db.create_backup(Path('/data'))
+        partial_backup_id = db.create_partial_backup(backup_id, 'volume')
+        # directories have no checksum, so every backup inserts a new row
+        db.add_backed_up_file({'path': '/data/dir', 'st_ino': 1, 'sha1': None, 'is_dir': 1, 'st_mtime': mtime},
+                              partial_backup_id)
+        db.add_backed_up_file({'path': '/data/dir', 'st_ino': 1, 'sha1': None, 'is_dir': 1, 'st_mtime': mtime},
+                              partial_backup_id)
+        db.commit()
+        partial_backup_ids.append(partial_backup_id)
+    rows = db.connection.execute('SELECT partial_backup_id, files.id, st_mtime FROM backed_up_files '
+                                 'JOIN files ON files.id = file_id ORDER BY partial_backup_id').fetchall()
+    # each backup refers to the metadata it has written, a file added twice is recorded once
+    assert [tuple(row) for row in rows] == [(partial_backup_ids[0], 2, 100), (partial_backup_ids[1], 4, 200)]
+
+
+def test_locate_files():
+    db = database.BackupDatabase(':memory:')
+    backup_id = db.create_backup(Path('/data'))
+    first = db.create_partial_backup(backup_id, 'first', tape_file_index=0)
+    db.add_backed_up_file({'path': '/data/a', 'st_ino': 1, 'sha1': b'a', 'tar_offset': 1024, 'sector': 2}, first)
+    second = db.create_partial_backup(backup_id, 'second', tape_file_index=1)
+    db.add_backed_up_file({'path': '/data/a', 'st_ino': 1, 'sha1': b'b', 'tar_offset': 512, 'sector': 1}, second)
+    # the content of a deduplicated file is located in the archive of the original
+    db.add_backed_up_file({'path': '/data/copy', 'st_ino': 2, 'sha1': b'a'}, second, deduplicated=('/data/a', 1, b'a'))
+    db.commit()
+    located = db.locate_files(['/data/a', '/data/copy', '/data/missing'])
+    assert [tuple(row) for row in located] == [('/data/a', None, 'second', 1, second, 512, 1, '/data/a'),
+                                               ('/data/copy', None, 'first', 0, first, 1024, 2, '/data/a')]
+
+
+def test_migrate_tables(tmp_path):
+    connection = sqlite3.connect(tmp_path / 'catalogue.sqlite')
+    # backed_up_files as created by earlier versions
+    connection.execute('CREATE TABLE backed_up_files (file_id INTEGER NOT NULL, partial_backup_id INTEGER NOT NULL, '
+                       'deduplication_file_id INTEGER, PRIMARY KEY(file_id, partial_backup_id))')
+    connection.execute('INSERT INTO backed_up_files VALUES (1, 1, NULL)')
+    connection.commit()
+    connection.close()
+    db = database.BackupDatabase(tmp_path / 'catalogue.sqlite')
+    row = db.connection.execute('SELECT * FROM backed_up_files').fetchone()
+    assert tuple(row) == (1, 1, None, None, None)
+    assert row.keys() == ['file_id', 'partial_backup_id', 'deduplication_file_id', 'tar_offset', 'sector']
+    db.close()
+
+
+def test_catalogue_writer(tmp_path):
+    writer = database.CatalogueWriter(tmp_path / 'catalogue.sqlite', batch_size=1000)
+    backup_id = writer.call('create_backup', tmp_path)
+    partial_backup_id = writer.call('create_partial_backup', backup_id, 'volume')
+    for i in range(10):
+        writer.add_backed_up_file({'path': str(i), 'st_ino': i, 'sha1': bytes([i])}, partial_backup_id)
+    writer.add_hash_cache_entry((1, 2, 3, 4, 5, b'a'))
+    writer.barrier()
+    other = database.BackupDatabase(tmp_path / 'catalogue.sqlite')
+    assert other.connection.execute('SELECT count(*) FROM backed_up_files').fetchone()[0] == 10
+    assert other.load_hash_cache() == {(1, 2): (3, 4, 5, b'a')}
+    writer.close()
+
+
+def test_catalogue_writer_error(tmp_path):
+    writer = database.CatalogueWriter(tmp_path / 'catalogue.sqlite')
+    # the partial backup does not exist
+    writer.add_backed_up_file({'path': 'a', 'st_ino': 1}, 1)
+    with pytest.raises(sqlite3.IntegrityError):
+        writer.barrier()
+    with pytest.raises(sqlite3.IntegrityError):
+        writer.add_backed_up_file({'path': 'b', 'st_ino': 2}, 1)
+    writer.close()
@@ -0,0 +1,96 @@
+import os
+import pickle
+import queue
+from pathlib import Path
+
+import pytest
+
+from aestar import fileinfo
+
+
+def drain(file_queue):
+    return list(iter(file_queue.get, None))
+
+
+@pytest.mark.parametrize('hash_workers', [1, 4])
+def test_file_processor(hash_workers):
+    file_queue = queue.Queue()
+    fileinfo.FileProcessor(file_queue, 'test_archive_folder', hash_workers=hash_workers).run()
+    items = drain(file_queue)
+    assert file_queue.empty()
+    assert sorted(item.info_dict['path'] for item in items) == \
+        sorted(p.as_posix() for p in Path('test_archive_folder').rglob('*'))
+    for item in items:
+        if item.info_dict['is_dir']:
+            assert 'sha1' not in item.info_dict
+        else:
+            assert item.info_dict['sha1'] == fileinfo.checksum(item.info_dict['path'], hex=False)
+
+
+def test_hash_cache(tmp_path):
+    path = tmp_path / 'file.txt'
+    path.write_bytes(b'123')
+    item = fileinfo.FileInfo.from_file(path)
+    assert not item.hash_cached
+    assert item.hash_cache_entry == item.stat_key + (fileinfo.checksum(path, hex=False),)
+    # an unchanged file gets the cached checksum without being read
+    hash_cache = {item.stat_key[:2]: item.stat_key[2:] + (b'cached',)}
+    cached_item = fileinfo.FileInfo.from_file(path, calculate_checksum=False, hash_cache=hash_cache)
+    assert cached_item.hash_cached
+    assert cached_item.info_dict['sha1'] == b'cached'
+    # a modified file is hashed again
+    path.write_bytes(b'1234')
+    modified_item = fileinfo.FileInfo.from_file(path, hash_cache=hash_cache)
+    assert not modified_item.hash_cached
+    assert modified_item.info_dict['sha1'] == fileinfo.checksum(path, hex=False)
+
+
+def test_record_roundtrip():
+    item = fileinfo.FileInfo.from_file('test_archive_folder/lorem.txt')
+    directory = fileinfo.FileInfo.from_file('test_archive_folder/folder')
+    extra = fileinfo.FileInfo({'path': 'a', 'custom': 1})
+    for original in (item, directory, extra):
+        for copy in (fileinfo.FileInfo.decode(fileinfo.FileInfo.encode(original)),
+                     pickle.loads(pickle.dumps(original))):
+            assert copy.info_dict == original.info_dict
+            assert copy.stat_key == original.stat_key
+            assert copy.hash_cached == original.hash_cached
+            assert copy.prefetched is None
+    # other items are passed through unchanged
+    error = OSError('error')
+    assert fileinfo.FileInfo.decode(fileinfo.FileInfo.encode(error)) is error
+
+
+def test_walker():
+    def walk(**kwargs):
+        return [path for path, _stat_result in fileinfo.Walker('test_archive_folder', **kwargs)]
+    assert walk() == [p.as_posix() for p in Path('test_archive_folder').rglob('*')]
+    assert walk(pattern='*.txt') == [p.as_posix() for p in Path('test_archive_folder').rglob('*.txt')]
+    # an excluded directory is pruned entirely
+    assert not any(path.startswith('test_archive_folder/folder') for path in walk(excludes=['fold*']))
+    # patterns with a slash are matched against the relative path
+    assert walk(excludes=['folder/123.txt']) == [path for path in walk() if path != 'test_archive_folder/folder/123.txt']
+    assert 'test_archive_folder/123.txt' not in walk(excludes=['123.txt'])
+    assert walk(one_file_system=True) == walk()
+    for path, stat_result in fileinfo.Walker('test_archive_folder'):
+        assert stat_result.st_ino == os.stat(path).st_ino
+
+
+@pytest.mark.parametrize('workers', [1, 2, 8])
+def test_parallel_walker(workers):
+    expected = sorted(fileinfo.Walker('test_archive_folder', excludes=['*.png']))
+    assert sorted(fileinfo.ParallelWalker('test_archive_folder', workers=workers, excludes=['*.png'])) == expected
+    # a walk that is not exhausted stops its threads
+    walk = iter(fileinfo.ParallelWalker('test_archive_folder', workers=workers))
+    next(walk)
+    walk.close()
+
+
+def test_file_processor_parallel_walk():
+    file_queue = queue.Queue()
+    fileinfo.FileProcessor(file_queue, 'test_archive_folder', walk_workers=4).run()
+    items = drain(file_queue)
+    # exactly one sentinel
+    assert file_queue.empty()
+    assert sorted(item.info_dict['path'] for item in items) == \
+        sorted(p.as_posix() for p in Path('test_archive_folder').rglob('*'))
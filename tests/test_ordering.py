@@ -0,0 +1,57 @@
+import queue
+import stat
+from pathlib import Path
+
+import pytest
+
+from aestar import ordering
+from aestar.fileinfo import FileInfo
+from aestar.prefetch import Prefetcher
+
+
+def file_queue(items):
+    q = queue.Queue()
+    for item in items:
+        q.put(item)
+    q.put(None)
+    return q
+
+
+@pytest.mark.parametrize('key', ['inode', 'extent'])
+@pytest.mark.parametrize('window', [1, 3, 100])
+def test_reordering_queue(key, window):
+    items = [FileInfo.from_file(p) for p in Path('test_archive_folder').rglob('*')]
+    error = OSError('error')
+    items.insert(2, error)
+    reordering_queue = ordering.ReorderingQueue(file_queue(items), window=window, key=key)
+    result = list(iter(reordering_queue.get, None))
+    assert reordering_queue.get() is None
+    assert len(result) == len(items)
+    for start in range(0, len(items), window):
+        chunk = result[start:start + window]
+        assert set(map(id, chunk)) == set(map(id, items[start:start + window]))
+        regular = [item for item in chunk if item is not error and stat.S_ISREG(item.info_dict['st_mode'])]
+        other = [item for item in items[start:start + window] if item not in regular]
+        # other items keep their order and come first
+        assert chunk[:len(other)] == other
+        if key == 'inode':
+            assert [item.info_dict['st_ino'] for item in regular] == \
+                sorted(item.info_dict['st_ino'] for item in regular)
+
+
+def test_first_physical_offset(tmp_path):
+    path = tmp_path / 'file'
+    path.write_bytes(b'x' * 4096)
+    try:
+        offset = ordering.first_physical_offset(path)
+    except OSError:
+        pytest.skip('FIEMAP is not supported')
+    assert offset is None or offset >= 0
+
+
+def test_reordering_prefetch():
+    items = [FileInfo.from_file(p) for p in Path('test_archive_folder').rglob('*')]
+    prefetcher = Prefetcher(ordering.ReorderingQueue(file_queue(items), window=4), num_files=2)
+    result = list(iter(prefetcher.get, None))
+    prefetcher.close()
+    assert sorted(map(id, result)) == sorted(map(id, items))
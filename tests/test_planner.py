@@ -0,0 +1,167 @@
+import io
+from pathlib import Path
+
+from aestar import aestar, mt
+from aestar.planner import RestorePlan, archived_size
+
+
+def row(path, volume, partial_backup_id, tar_offset, st_size=1000, tape_file_index=None, content_path=None):
+    # the columns of BackupDatabase.locate_files()
+    return {'path': path, 'st_size': st_size, 'volume': volume, 'tape_file_index': tape_file_index,
+            'partial_backup_id': partial_backup_id, 'tar_offset': tar_offset,
+            'sector': None if tar_offset is None else tar_offset // 512, 'content_path': content_path or path}
+
+
+def test_restore_plan():
+    located = [row('/b/far', 'B', 2, 10 ** 10),
+               row('/a/second', 'A', 1, 4096),
+               row('/b/near', 'B', 2, 0),
+               row('/a/first', 'A', 1, 0),
+               row('/b/next_to_near', 'B', 2, 8192),
+               row('/a/other_tape_file', 'A', 3, 0, tape_file_index=1),
+               row('/c/compressed', 'C', 4, None)]
+    plan = RestorePlan(located, tape_file_sizes={4: 10 ** 9}, load_seconds=100, locate_seconds=10, read_rate=10 ** 6)
+    # every volume is loaded once, in the order the volumes have been written
+    assert [volume_pass.volume for volume_pass in plan.passes] == ['A', 'B', 'C']
+    volume_a, volume_b, volume_c = plan.passes
+    # tape files in order, files of a tape file by offset
+    assert [(run.tape_file_index, run.start, run.names) for run in volume_a.runs] == [
+        (0, 0, ['a/first', 'a/second']), (1, 0, ['a/other_tape_file'])]
+    # a short gap is read through, a long one is located
+    assert [(run.start, run.names) for run in volume_b.runs] == [(0, ['b/near', 'b/next_to_near']),
+                                                                 (10 ** 10, ['b/far'])]
+    assert volume_b.runs[0].num_bytes == 8192 + archived_size(1000)
+    # without offsets, the whole tape file is read
+    assert [(run.start, run.names, run.num_bytes) for run in volume_c.runs] == [(None, ['c/compressed'], 10 ** 9)]
+    estimate = plan.estimate()
+    assert estimate['loads'] == 3
+    assert estimate['locates'] == 5
+    assert estimate['seconds'] == 300 + 50 + estimate['bytes'] / 10 ** 6
+    assert plan.num_files == len(located)
+    report = plan.report()
+    assert 'Volume B: 3 files in 2 runs' in report
+    assert report.splitlines()[-1].startswith('Total: 7 files, 3 loads')
+
+
+def test_restore_plan_empty():
+    plan = RestorePlan([])
+    assert plan.passes == []
+    assert plan.estimate()['seconds'] == 0
+
+
+class FakeChangerTape:
+    """
+    Volumes of tape files in fixed block mode with the block numbering of `mt tell`: one block per record and
+    one per file mark. Opened devices read from the current position and ignore seek(), like the st driver.
+    """
+    def __init__(self, volumes, record_size):
+        self.volumes = volumes
+        self.record_size = record_size
+        self.loads = []
+        self.volume = None
+        self.tape_file = 0
+        self.position = 0
+
+    def _records(self, data):
+        return -(-len(data) // self.record_size)
+
+    def load(self, volume):
+        self.loads.append(volume)
+        self.volume = volume
+        self.rewind()
+
+    def rewind(self, device=None):
+        self.tape_file, self.position = 0, 0
+
+    def forward_files(self, count, device=None):
+        self.tape_file, self.position = self.tape_file + count, 0
+
+    def forward_records(self, count, device=None):
+        self.position += count * self.record_size
+
+    def tell(self, device=None):
+        tape_files = self.volumes[self.volume]
+        return sum(self._records(data) + 1 for data in tape_files[:self.tape_file]) + \
+            self.position // self.record_size
+
+    def seek(self, block, device=None):
+        self.rewind()
+        for data in self.volumes[self.volume]:
+            if block <= self._records(data):
+                break
+            block -= self._records(data) + 1
+            self.tape_file += 1
+        self.position = block * self.record_size
+
+    def open(self):
+        tape = self
+
+        class Device:
+            closed = False
+
+            def seekable(self):
+                return True
+
+            def seek(self, offset, whence=0):
+                return tape.position
+
+            def read(self, size=-1):
+                assert size % tape.record_size == 0
+                data = tape.volumes[tape.volume][tape.tape_file][tape.position:tape.position + size]
+                tape.position += len(data)
+                return data
+
+            def close(self):
+                self.closed = True
+        return Device()
+
+
+def test_restore_plan_execute(tmp_path, monkeypatch, caplog):
+    passphrase = b'restore plan test passphrase'
+    files = [file.as_posix() for file in sorted(Path('test_archive_folder').rglob('*')) if file.is_file()]
+    record_size = 4096
+
+    def archive(paths, compression=None):
+        output = io.BytesIO()
+        output.close = lambda: None
+        locations = {}
+        with aestar.AESTarFile(passphrase, fileobj=output, compression=compression) as tar:
+            for file in paths:
+                tar.add(file)
+                locations[file] = tar.last_location[0]
+        data = output.getvalue()
+        # the drive pads the last record
+        return data + bytes(-len(data) % record_size), locations
+
+    tape_files = [archive(files), archive(files[::-1]), archive(files, compression='gz')]
+    tape = FakeChangerTape({'A': [tape_files[0][0], tape_files[1][0]], 'B': [tape_files[2][0]]}, record_size)
+    for name in ('rewind', 'forward_files', 'forward_records', 'tell', 'seek'):
+        monkeypatch.setattr(mt, name, getattr(tape, name))
+
+    def row(path, volume, tape_file_index, partial_backup_id, tar_offset, content_path=None):
+        content_path = content_path or path
+        return {'path': path, 'st_size': 1, 'volume': volume, 'tape_file_index': tape_file_index,
+                'partial_backup_id': partial_backup_id, 'tar_offset': tar_offset,
+                'sector': None if tar_offset is None else tar_offset // 512, 'content_path': content_path}
+
+    # files from both tape files of volume A and the compressed archive on volume B,
+    # deduplicated files are restored from the member holding their content
+    located = [row(files[-1], 'A', 0, 1, tape_files[0][1][files[-1]]),
+               row(files[1], 'A', 0, 1, tape_files[0][1][files[1]]),
+               row('restored/copy', 'A', 0, 1, tape_files[0][1][files[1]], content_path=files[1]),
+               row(files[0], 'A', 1, 2, tape_files[1][1][files[0]]),
+               row('restored/lost', 'A', 1, 2, tape_files[1][1][files[0]], content_path='not/archived'),
+               row(files[2], 'B', 0, 3, None),
+               row('restored/compressed_copy', 'B', 0, 3, None, content_path=files[2])]
+    # every content is a run of its own
+    plan = RestorePlan(located, locate_seconds=0)
+    assert plan.num_runs == 4
+    extracted = plan.execute(passphrase, '/dev/nst0', tape.load, path=tmp_path, record_size=record_size,
+                             bufsize=10000, open_device=tape.open)
+    assert tape.loads == ['A', 'B']
+    restored = [row for row in located if row['path'] != 'restored/lost']
+    assert sorted(member.name for member in extracted) == sorted(row['path'] for row in restored)
+    for row in restored:
+        assert (tmp_path / row['path']).read_bytes() == Path(row['content_path']).read_bytes()
+    # content that is not where the catalogue says is reported
+    assert 'restored/lost' in caplog.text
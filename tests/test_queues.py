@@ -0,0 +1,73 @@
+import threading
+import time
+from pathlib import Path
+
+from aestar.fileinfo import FileInfo, FileProcessor, FileFilter, HashCacheEntry
+from aestar.queues import BatchQueue
+
+
+def test_batch_queue_pipeline():
+    unfiltered_queue = BatchQueue(batch_size=4, encode=FileInfo.encode, decode=FileInfo.decode)
+    file_queue = BatchQueue(batch_size=4, encode=FileInfo.encode, decode=FileInfo.decode)
+    processor = FileProcessor(unfiltered_queue, 'test_archive_folder')
+    file_filter = FileFilter(unfiltered_queue, file_queue, lambda item: not item.info_dict['is_dir'])
+    processor.start()
+    file_filter.start()
+    items = list(iter(file_queue.get, None))
+    processor.join()
+    file_filter.join()
+    assert [item.info_dict['path'] for item in items] == \
+        [p.as_posix() for p in Path('test_archive_folder').rglob('*') if not p.is_dir()]
+    assert all(item.info_dict['sha1'] is not None for item in items)
+
+
+def test_file_filter_hash_cache_entries():
+    unfiltered_queue = BatchQueue(batch_size=4, encode=FileInfo.encode, decode=FileInfo.decode)
+    file_queue = BatchQueue(batch_size=4, encode=FileInfo.encode, decode=FileInfo.decode)
+    FileProcessor(unfiltered_queue, 'test_archive_folder').run()
+    # only directories pass, the checksums of the dropped files are still sent for the hash cache
+    FileFilter(unfiltered_queue, file_queue, lambda item: item.info_dict['is_dir'], cache_hashes=True).run()
+    items = list(iter(file_queue.get, None))
+    entries = [item.entry for item in items if isinstance(item, HashCacheEntry)]
+    files = [p for p in Path('test_archive_folder').rglob('*') if not p.is_dir()]
+    assert sorted(entry[1] for entry in entries) == sorted(p.stat().st_ino for p in files)
+    assert all(entry[5] is not None for entry in entries)
+    assert all(item.info_dict['is_dir'] for item in items if isinstance(item, FileInfo))
+
+
+def test_batch_queue_flush():
+    batch_queue = BatchQueue(batch_size=100, max_delay=3600)
+    batch_queue.put(1)
+    batch_queue.put(2)
+    assert batch_queue.queue.empty()
+    batch_queue.flush()
+    assert batch_queue.get() == 1
+    # the sentinel sends the batch
+    batch_queue.put(None)
+    assert batch_queue.get() == 2
+    assert batch_queue.get() is None
+
+
+def test_batch_queue_max_delay():
+    batch_queue = BatchQueue(batch_size=100, max_delay=0.05)
+    batch_queue.put(1)
+    # sent by the flusher thread although nothing else is put
+    assert batch_queue.get(timeout=5) == 1
+    batch_queue.put(None)
+    assert batch_queue.get(timeout=5) is None
+
+
+def test_batch_queue_backpressure():
+    batch_queue = BatchQueue(batch_size=2, max_items=4, max_delay=3600)
+    producer = threading.Thread(target=batch_queue.put_many, args=(list(range(10)) + [None],))
+    producer.start()
+    time.sleep(0.2)
+    # the producer is blocked once max_items are in transit
+    assert producer.is_alive()
+    assert batch_queue.in_transit()[0] == 4
+    assert batch_queue.qsize() == 4
+    received = list(iter(batch_queue.get, None))
+    producer.join()
+    assert received == list(range(10))
+    assert batch_queue.in_transit() == (0, 0)
+    assert batch_queue.qsize() == 0
@@ -0,0 +1,46 @@
+import os
+
+import pytest
+
+from aestar import aestar, database
+from restore import restore_located
+
+
+@pytest.mark.parametrize('compression', [None, 'gz'])
+def test_restore_deduplicated(tmp_path, compression):
+    passphrase = b'deduplicated restore test passphrase'
+    source = tmp_path / 'src'
+    source.mkdir()
+    original = source / 'a'
+    original.write_bytes(os.urandom(10000))
+    other = source / 'b'
+    other.write_bytes(os.urandom(10000))
+    archive_file = tmp_path / 'archive.tar.aes'
+    catalogue = database.BackupDatabase(tmp_path / 'catalogue.sqlite')
+    backup_id = catalogue.create_backup(source)
+    partial_backup_id = catalogue.create_partial_backup(backup_id, 'volume')
+    with aestar.AESTarFile(passphrase, file=archive_file, compression=compression) as archive:
+        for file in (original, other):
+            archive.add(file)
+            tar_offset, sector = archive.last_location
+            catalogue.add_backed_up_file({'path': file.as_posix(), 'st_ino': file.stat().st_ino,
+                                          'sha1': file.name.encode(), 'tar_offset': tar_offset, 'sector': sector},
+                                         partial_backup_id)
+    # the copy has the content of the original, which is archived once
+    copy = (source / 'copy').as_posix()
+    catalogue.add_backed_up_file({'path': copy, 'st_ino': 1, 'sha1': b'a'}, partial_backup_id,
+                                 deduplicated=(original.as_posix(), original.stat().st_ino, b'a'))
+    catalogue.close()
+    destination = tmp_path / 'restored'
+    extracted = restore_located([copy], archive_file, passphrase, destination, tmp_path / 'catalogue.sqlite',
+                                None, 131072, 1, {})
+    assert [member.name for member in extracted] == [copy.strip('/')]
+    assert (destination / copy.strip('/')).read_bytes() == original.read_bytes()
+    # only the requested path is restored, not the original it has been deduplicated to
+    assert not (destination / original.as_posix().strip('/')).exists()
+
+    # the original and its copy are restored from the same member
+    extracted = restore_located([original.as_posix(), copy], archive_file, passphrase, destination,
+                                tmp_path / 'catalogue.sqlite', None, 131072, 1, {})
+    assert sorted(member.name for member in extracted) == sorted([original.as_posix().strip('/'), copy.strip('/')])
+    assert (destination / original.as_posix().strip('/')).read_bytes() == original.read_bytes()
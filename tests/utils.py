@@ -1,5 +1,9 @@
+import hashlib
 import subprocess
 
+from Crypto.Cipher import AES
+
+
 def aespipe_decrypt(ciphertext_bytes, passphrase_file):
     aespipe = subprocess.Popen(['aespipe', '-d', '-P', passphrase_file], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
     result = aespipe.communicate(input=ciphertext_bytes, timeout=10)
@@ -20,3 +24,17 @@ def untar(tarfile, directory=None):
 def diff(a, b):
     result = subprocess.run(['diff', a, b], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
     return result
+
+
+def aes_encrypt_reference(plaintext, passphrase, first_sector=0):
+    # straightforward aespipe single-key mode encryption, one CBC cipher per 512 byte sector
+    key = hashlib.sha256(passphrase).digest()[:16]
+    plaintext = plaintext.ljust(-(-len(plaintext) // 512) * 512, b'\x00')
+    return b''.join(AES.new(key, AES.MODE_CBC, IV=(first_sector + i).to_bytes(16, byteorder='little'))
+                    .encrypt(plaintext[512 * i:512 * (i + 1)]) for i in range(len(plaintext) // 512))
+
+
+def aes_decrypt_reference(ciphertext, passphrase, first_sector=0):
+    key = hashlib.sha256(passphrase).digest()[:16]
+    return b''.join(AES.new(key, AES.MODE_CBC, IV=(first_sector + i).to_bytes(16, byteorder='little'))
+                    .decrypt(ciphertext[512 * i:512 * (i + 1)]) for i in range(len(ciphertext) // 512))